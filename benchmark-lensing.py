@@ -0,0 +1,47 @@
+"""Compare the speed and accuracy of the CMB lensing models taylens
+and grid_lensing.
+
+Both models lens the same realization of the nominal c1 CMB. Their
+accuracy is measured against grid_lensing with a high oversampling and
+quintic interpolation, as the rms difference of (T, Q, U) relative to the
+rms of the lensing contribution (lensed minus unlensed maps).
+
+Usage: python benchmark-lensing.py [nside ...]
+"""
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from pysm import components, common
+from pysm.nominal import models
+
+def lensed(nside, model, **kwargs):
+    config = models('c1', nside)[0]
+    config['model'] = model
+    config.update(kwargs)
+    common.clear_template_cache()
+    start = time.time()
+    cmb = components.CMB(config).signal()(100.)
+    return cmb, time.time() - start
+
+def unlensed(nside):
+    config = models('c1', nside)[0]
+    cl_tebp_arr, synlmax = components.CMB(config).lensing_spectra()
+    cmb, _ = components.simulate_tebp_correlated(cl_tebp_arr, nside, synlmax, config['cmb_seed'])
+    return cmb * components.cmb_scaling(np.array([[100.]]))
+
+def main(nsides):
+    print("%6s | %-36s | %8s | %8s | %8s | %8s" % ("nside", "model", "time (s)", "err T", "err Q", "err U"))
+    for nside in nsides:
+        reference, _ = lensed(nside, 'grid_lensing', lensing_oversampling = 8, interpolation_order = 5)
+        lensing = np.sqrt(np.mean((reference - unlensed(nside)) ** 2, axis = -1))
+        runs = [('taylens', {})]
+        runs += [('grid_lensing', {'lensing_oversampling' : oversampling, 'interpolation_order' : order}) for oversampling in (2, 4) for order in (3, 5)]
+        for model, kwargs in runs:
+            cmb, seconds = lensed(nside, model, **kwargs)
+            error = np.sqrt(np.mean((cmb - reference) ** 2, axis = -1)) / lensing
+            name = model + "".join(" %s=%s" % (k.split('_')[-1], v) for k, v in sorted(kwargs.items()))
+            print("%6d | %-36s | %8.2f | %8.2e | %8.2e | %8.2e" % ((nside, name, seconds) + tuple(error)))
+
+if __name__ == '__main__':
+    main([int(nside) for nside in sys.argv[1:]] or [64, 128, 256])
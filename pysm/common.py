@@ -9,25 +9,52 @@
 from __future__ import print_function
 import healpy as hp
 import numpy as np
+from astropy.io import fits
 import scipy.constants as constants
 import scipy.integrate
+import scipy.interpolate
+import scipy.sparse
+import collections
+import hashlib
+import os
 import sys
+import tempfile
 
 def FloatOrArray(model):
     """Decorator to modify models to allow computation across an array of
     frequencies, and for a single float.
 
+    The decorated function also accepts an `out` keyword. If given, the
+    emission is added in place to `out`, which must have shape (3, Npix)
+    for a single frequency or (Nfreq, 3, Npix) for an array, and `out`
+    is returned.
+
+    It also accepts a `weights` keyword, see
+    :func:`pysm.common.weighted_sum`. In that case the model is summed
+    over the frequencies one at a time, and the returned maps have shape
+    (3, Npix).
+
+    Finally, a `pixels` keyword selects a subset of the pixels of the
+    output. As the model is not aware of it, it is evaluated over all
+    the pixels, and the subset is then taken. The decorated function has
+    a `full_sky` attribute recording this, so that
+    :meth:`pysm.pysm.Instrument.observe_chunked` evaluates it only once.
+
     :param model: model function which we will decorate.
     :type model: function
     :return: wrapped function -- function
 
     """
-    def decorator(nu, **kwargs):
+    def decorator(nu, out = None, weights = None, pixels = None, **kwargs):
         """Evaluate if nu is a float."""
+        if pixels is not None:
+            return add_to_output(out, decorator(nu, weights = weights, **kwargs)[..., pixels])
+        if weights is not None:
+            return weighted_sum(model, nu, weights, out = out, **kwargs)
         try:
             nu_float = float(nu)
             nu_float = np.array(nu)
-            return model(nu_float, **kwargs) 
+            return add_to_output(out, model(nu_float, **kwargs))
         except TypeError:
             try:
                 """If not float, check if nu is one dimensional"""
@@ -35,15 +62,355 @@ def FloatOrArray(model):
                 if not (nu_1darray.ndim == 1):
                     print("Frequencies must be float or convertable to 1d array.")
                     sys.exit(1)
-                    """If it is 1d array evaluate model function over all its elements."""
-                return np.array([model(x, **kwargs) for x in nu_1darray])
+                    """If it is 1d array evaluate model function over all its elements,
+                    filling the output one frequency at a time."""
+                accumulate = out is not None
+                for i, x in enumerate(nu_1darray):
+                    maps = model(x, **kwargs)
+                    if accumulate:
+                        out[i] += maps
+                    else:
+                        if out is None:
+                            out = np.empty((len(nu_1darray),) + np.shape(maps))
+                        out[i] = maps
+                    del maps
+                return out
             except ValueError:
                 """Fail if not convertable to 1d array"""
                 print("Frequencies must be either float or convertable to array.")
                 raise
                 sys.exit(1)
+    decorator.full_sky = True
     return decorator
 
+"""Number of frequencies evaluated together by a vectorized model when
+summing over a bandpass. This bounds the size of the intermediate
+(Nfreq, Npix) scaling arrays."""
+FREQUENCY_BLOCK = 8
+
+def FloatOrArrayVectorized(model):
+    """Decorator for models able to evaluate a whole vector of
+    frequencies in one call, rather than looping over them as in
+    :func:`pysm.common.FloatOrArray`.
+
+    The decorated model receives the frequencies as a column vector of
+    shape (Nfreq, 1), so that it broadcasts directly against templates
+    of shape (Npix,), and must return maps of shape (Nfreq, 3, Npix).
+    It also receives an `out` keyword, which is either None or an array
+    of shape (Nfreq, 3, Npix) to which the emission must be added in
+    place, e.g. with :func:`pysm.common.scale_templates`.
+
+    If the decorated function is called with a `weights` keyword, the
+    model also receives it, and must return the weighted sum of its
+    emission over frequency, shape (3, Npix), which
+    :func:`pysm.common.scale_templates` does by combining the scaling
+    factors before applying them to the templates. The frequencies are
+    then passed to the model in blocks of at most `FREQUENCY_BLOCK`.
+
+    Any other keyword, such as `pixels`, the subset of pixels at which
+    to evaluate the model (see :func:`pysm.common.pixel_subset`), is
+    passed on to the model.
+
+    :param model: model function which we will decorate.
+    :type model: function
+    :return: wrapped function -- function
+
+    """
+    def decorator(nu, out = None, weights = None, **kwargs):
+        nu_array = np.asarray(nu, dtype=np.float64)
+        if nu_array.ndim > 1:
+            print("Frequencies must be float or convertable to 1d array.")
+            sys.exit(1)
+        if weights is not None:
+            nu_array = nu_array.reshape(-1, 1)
+            weights = np.asarray(weights, dtype=np.float64)
+            for start in range(0, len(nu_array), FREQUENCY_BLOCK):
+                block = slice(start, start + FREQUENCY_BLOCK)
+                out = model(nu_array[block], out = out, weights = weights[block], **kwargs)
+            return out
+        if nu_array.ndim == 0:
+            output = model(nu_array.reshape(-1, 1), out = None if out is None else out[np.newaxis], **kwargs)
+            return output[0] if out is None else out
+        return model(nu_array.reshape(-1, 1), out = out, **kwargs)
+    return decorator
+
+def weighted_sum(model, nu, weights, out = None, **kwargs):
+    """Sum the emission of a model over frequency, weighting each
+    frequency by the given weights, evaluating one frequency at a time.
+    This is used to integrate models over a bandpass without keeping
+    the maps at each frequency.
+
+    :param model: function returning (T, Q, U) maps at a single frequency.
+    :type model: function
+    :param nu: frequencies at which to evaluate the model.
+    :type nu: numpy.ndarray.
+    :param weights: weights of each frequency, shape (Nfreq,), or (Nfreq, 3) for separate weights of T, Q, and U.
+    :type weights: numpy.ndarray.
+    :param out: if given, array of shape (3, Npix) to which the sum is added in place.
+    :type out: numpy.ndarray.
+    :return: numpy.ndarray -- weighted sum of the maps, shape (3, Npix).
+
+    """
+    for x, w in zip(np.atleast_1d(nu), np.asarray(weights, dtype=np.float64)):
+        maps = model(x, **kwargs)
+        maps = maps * np.reshape(w, (-1, 1))
+        if out is None:
+            out = maps
+        else:
+            out += maps
+        del maps
+    return out
+
+def add_to_output(out, maps):
+    """Add maps in place to an existing output array. If there is no
+    output array yet, the maps themselves become the output.
+
+    :param out: output array to which maps are added, or None.
+    :type out: numpy.ndarray.
+    :param maps: maps to add.
+    :type maps: numpy.ndarray.
+    :return: numpy.ndarray -- the output array.
+
+    """
+    if out is None:
+        return maps
+    out += maps
+    return out
+
+def add_population(population, nu, out = None, **kwargs):
+    """Add the emission of a population of a sky component in place to
+    an existing output array, or, if there is none yet, return it as
+    the output.
+
+    Populations with a `full_sky` attribute, legacy models decorated
+    with :func:`pysm.common.FloatOrArray` and components added with
+    :meth:`pysm.pysm.Sky.add_component`, may return an array shared
+    with the model, e.g. a read-only template or the same array on
+    every call. Their emission is copied when it becomes the output, so
+    that adding the other populations to it does not modify the model.
+
+    :param population: signal function of the population.
+    :type population: function
+    :param nu: frequencies at which to evaluate the population.
+    :type nu: float, numpy.ndarray.
+    :param out: output array to which the emission is added, or None.
+    :type out: numpy.ndarray.
+    :return: numpy.ndarray -- the output array.
+
+    """
+    if out is None and getattr(population, 'full_sky', False):
+        return np.array(population(nu, **kwargs), dtype = np.float64)
+    return population(nu, out = out, **kwargs)
+
+def scale_templates(templates, scalings, out = None, weights = None, pixels = None):
+    """Scale (T, Q, U) templates by their respective scaling laws,
+    writing directly into a single preallocated output array.
+
+    If `weights` are given, the scalings are first summed over
+    frequency with these weights, and the templates are scaled once by
+    the resulting effective scaling, giving the weighted sum of the
+    maps over frequency.
+
+    :param templates: T, Q, and U templates, shape (Npix,), or floats.
+    :type templates: tuple
+    :param scalings: scaling factors of each of T, Q, and U, shape (Nfreq, Npix) or (Nfreq, 1).
+    :type scalings: tuple
+    :param out: if given, array of shape (Nfreq, 3, Npix), or (3, Npix) if using weights, to which the scaled templates are added in place.
+    :type out: numpy.ndarray.
+    :param weights: weights of each frequency, shape (Nfreq,), or (Nfreq, 3) for separate weights of T, Q, and U.
+    :type weights: numpy.ndarray.
+    :param pixels: if given, subset of pixels of the templates to scale, the scalings being already restricted to these pixels.
+    :type pixels: slice, numpy.ndarray.
+    :return: numpy.ndarray -- scaled maps, shape (Nfreq, 3, Npix), or (3, Npix) if using weights.
+
+    """
+    if pixels is not None:
+        templates = tuple(pixel_subset(template, pixels) for template in templates)
+    if weights is not None:
+        effective_scalings = []
+        for i, scaling in enumerate(scalings):
+            w = weights if weights.ndim == 1 else weights[:, i]
+            if i > 0 and (scaling is scalings[i - 1]) and (weights.ndim == 1 or np.array_equal(w, weights[:, i - 1])):
+                effective_scalings.append(effective_scalings[-1])
+            else:
+                effective_scalings.append(np.dot(w, scaling)[np.newaxis])
+        output = scale_templates(templates, effective_scalings, out = None if out is None else out[np.newaxis])
+        return output[0] if out is None else out
+    if out is None:
+        shape = np.broadcast(*(tuple(templates) + tuple(scalings))).shape
+        out = np.empty((shape[0], 3) + shape[1:])
+        for i, (template, scaling) in enumerate(zip(templates, scalings)):
+            np.multiply(template, scaling, out = out[:, i])
+        return out
+    for i, (template, scaling) in enumerate(zip(templates, scalings)):
+        if np.any(template):
+            out[:, i] += template * scaling
+    return out
+
+def constant_value(parameter):
+    """Reduce a model parameter that takes the same value in every pixel
+    to a float, so that the SED it defines is computed once per
+    frequency rather than once per pixel.
+
+    :param parameter: model parameter, map or float.
+    :type parameter: numpy.ndarray, float.
+    :return: float if the parameter is constant, otherwise the parameter unchanged.
+
+    """
+    parameter_array = np.asarray(parameter)
+    if parameter_array.ndim == 0:
+        return float(parameter_array)
+    if parameter_array.size > 0 and np.all(parameter_array == parameter_array.flat[0]):
+        return float(parameter_array.flat[0])
+    return parameter
+
+def set_separable(model, templates, scalings):
+    """Record on a model that its emission is separable, i.e. the
+    product of fixed (T, Q, U) templates and an SED depending only on
+    frequency.
+
+    The model then has two extra attributes: `templates`, the (T, Q,
+    U) templates, and `sed`, a function of frequency, float or 1d
+    array, returning the scaling of each of T, Q, and U, shape (3,) or
+    (Nfreq, 3). The SED is only evaluated when `sed` is called.
+
+    :param model: model function to which the separable form is attached.
+    :type model: function
+    :param templates: T, Q, and U templates, shape (Npix,), or floats.
+    :type templates: tuple
+    :param scalings: function of frequencies of shape (Nfreq, 1), returning the T, Q, and U scalings, each of shape (Nfreq, 1).
+    :type scalings: function
+    :return: function -- the model.
+
+    """
+    def sed(nu):
+        nu_array = np.asarray(nu, dtype=np.float64)
+        nu_column = nu_array.reshape(-1, 1)
+        sed_array = np.concatenate([np.broadcast_to(scaling, nu_column.shape) for scaling in scalings(nu_column)], axis = 1)
+        return sed_array[0] if nu_array.ndim == 0 else sed_array
+    model.templates = templates
+    model.sed = sed
+    return model
+
+def pixel_subset(parameter, pixels):
+    """Select a subset of pixels of a model parameter, which may also be
+    a float, constant over the sky.
+
+    :param parameter: model parameter, map or float.
+    :type parameter: numpy.ndarray, float.
+    :param pixels: pixels to select, or None for all of them.
+    :type pixels: slice, numpy.ndarray.
+    :return: the parameter in the selected pixels -- numpy.ndarray, float.
+
+    """
+    if pixels is None or np.ndim(parameter) == 0:
+        return parameter
+    return parameter[pixels]
+
+"""Number of pixels processed at a time when looping over a map."""
+PIXEL_CHUNK = 65536
+
+"""Number of log-spaced frequencies sampled to build an SED approximation."""
+SED_APPROXIMATION_SAMPLES = 64
+
+def low_rank_sed(scalings, npix, nu_range, rank, verbose = False):
+    """Approximate spatially varying SEDs by a small number of basis SEDs.
+
+    The (T, Q, U) scalings are sampled on a log-spaced grid of
+    frequencies within `nu_range`, normalised at each frequency by
+    their root mean square over the sky, and decomposed through the
+    eigenvectors of their Gram matrix, accumulated over chunks of
+    pixels. The `rank` leading eigenvectors are the basis SEDs, which
+    are interpolated in log frequency, and each pixel is described by
+    its `rank` coefficients. The scaling at any frequency in the range
+    is then a sum of `rank` coefficient maps, rather than an evaluation
+    of the SED in every pixel.
+
+    The maximum relative error with respect to the exact scalings,
+    evaluated halfway between the sampled frequencies, is stored in the
+    `max_relative_error` attribute of the returned function, and
+    printed in verbose mode.
+
+    :param scalings: function of frequencies of shape (Nfreq, 1) and of a slice of pixels, returning the exact T, Q, and U scalings, each of shape (Nfreq, Npix).
+    :type scalings: function
+    :param npix: number of pixels.
+    :type npix: int.
+    :param nu_range: minimum and maximum frequencies in GHz at which the approximation is used.
+    :type nu_range: tuple.
+    :param rank: number of basis SEDs.
+    :type rank: int.
+    :param verbose: run in verbose mode.
+    :type verbose: bool.
+    :return: function -- scales templates at frequencies nu as :func:`pysm.common.scale_templates`, with arguments (templates, nu, out, weights, pixels), and with attributes `covers`, a function checking frequencies are within the range, and `max_relative_error`.
+
+    """
+    nu_min, nu_max = nu_range
+    rank = int(min(rank, SED_APPROXIMATION_SAMPLES))
+    log_nu = np.linspace(np.log(nu_min), np.log(nu_max), SED_APPROXIMATION_SAMPLES)
+    log_nu_mid = 0.5 * (log_nu[1:] + log_nu[:-1])
+    chunks = [slice(start, min(start + PIXEL_CHUNK, npix)) for start in range(0, npix, PIXEL_CHUNK)]
+    # scalings shared between Stokes parameters, e.g. Q and U, are only decomposed once.
+    first_scalings = scalings(np.exp(log_nu[:1, np.newaxis]), chunks[0])
+    owners = [[j for j in range(i + 1) if first_scalings[j] is first_scalings[i]][0] for i in range(len(first_scalings))]
+    unique = sorted(set(owners))
+    # first pass over the pixels to accumulate the Gram matrices in frequency.
+    gram = dict((i, np.zeros((len(log_nu), len(log_nu)))) for i in unique)
+    for chunk in chunks:
+        sampled = scalings(np.exp(log_nu[:, np.newaxis]), chunk)
+        for i in unique:
+            sample = np.broadcast_to(sampled[i], (len(log_nu), chunk.stop - chunk.start))
+            gram[i] += np.dot(sample, sample.T)
+    norm, basis = {}, {}
+    for i in unique:
+        norm[i] = np.sqrt(np.diag(gram[i]) / npix)
+        norm[i][norm[i] == 0.] = 1.
+        eigenvalues, eigenvectors = np.linalg.eigh(gram[i] / np.outer(norm[i], norm[i]))
+        basis[i] = eigenvectors[:, ::-1][:, :rank]
+    # second pass to project every pixel onto the basis SEDs.
+    coefficients = dict((i, np.empty((rank, npix))) for i in unique)
+    for chunk in chunks:
+        sampled = scalings(np.exp(log_nu[:, np.newaxis]), chunk)
+        for i in unique:
+            coefficients[i][:, chunk] = np.dot(basis[i].T, sampled[i] / norm[i][:, np.newaxis])
+    log_norm_interp = dict((i, scipy.interpolate.interp1d(log_nu, np.log(norm[i]), kind = 'cubic')) for i in unique)
+    basis_interp = dict((i, scipy.interpolate.interp1d(log_nu, basis[i], kind = 'cubic', axis = 0)) for i in unique)
+
+    def basis_seds(nu):
+        log_nu_eval = np.log(np.ravel(nu))
+        return dict((i, np.exp(log_norm_interp[i](log_nu_eval))[:, np.newaxis] * basis_interp[i](log_nu_eval)) for i in unique)
+
+    # third pass to estimate the error of the approximation between the sampled frequencies.
+    max_relative_error = 0.
+    seds_mid = basis_seds(np.exp(log_nu_mid))
+    for chunk in chunks:
+        exact = scalings(np.exp(log_nu_mid[:, np.newaxis]), chunk)
+        for i in unique:
+            approximation = np.dot(seds_mid[i], coefficients[i][:, chunk])
+            error = np.abs(approximation - exact[i]) / np.maximum(np.abs(exact[i]), np.finfo(np.float64).tiny)
+            max_relative_error = max(max_relative_error, float(np.max(error)))
+    if verbose:
+        print("SED approximation of rank %d between %.1f and %.1f GHz, maximum relative error %.2e."%(rank, nu_min, nu_max, max_relative_error))
+
+    def scale(templates, nu, out = None, weights = None, pixels = None):
+        seds = basis_seds(nu)
+        pixel_coefficients = dict((i, coefficients[i] if pixels is None else coefficients[i][:, pixels]) for i in unique)
+        if weights is None:
+            approximate_scalings = dict((i, np.dot(seds[i], pixel_coefficients[i])) for i in unique)
+            return scale_templates(templates, [approximate_scalings[owner] for owner in owners], out = out, pixels = pixels)
+        effective_scalings = []
+        for i, owner in enumerate(owners):
+            w = weights if weights.ndim == 1 else weights[:, i]
+            effective_scalings.append(np.dot(np.dot(w, seds[owner]), pixel_coefficients[owner])[np.newaxis])
+        output = scale_templates(templates, effective_scalings, out = None if out is None else out[np.newaxis], pixels = pixels)
+        return output[0] if out is None else out
+
+    def covers(nu):
+        return bool(np.all((np.asarray(nu) >= nu_min) & (np.asarray(nu) <= nu_max)))
+
+    scale.covers = covers
+    scale.max_relative_error = max_relative_error
+    return scale
+
 def write_map(fname, output_map, nside=None, pixel_indices=None):
     """Convenience function wrapping healpy's write_map and handling of partial sky
 
@@ -65,6 +432,429 @@ def write_map(fname, output_map, nside=None, pixel_indices=None):
 
     hp.write_map(fname, full_map, overwrite=True)
 
+"""Names of the columns of (T, Q, U) maps in files written by healpy."""
+MAP_COLUMNS = ('TEMPERATURE', 'Q_POLARISATION', 'U_POLARISATION')
+
+def create_map_file(fname, nside, fill = hp.UNSEEN):
+    """Create a FITS file holding a full sky (T, Q, U) map in RING
+    ordering, in the same format as :func:`pysm.common.write_map`, and
+    return its data memory mapped, so that the map can be written a
+    chunk of pixels at a time without holding it in memory.
+
+    The returned array has one record per pixel, with fields given by
+    `MAP_COLUMNS`, e.g. `data['TEMPERATURE'][pixels] = T`. Changes are
+    written to disk when the array is flushed or deleted.
+
+    :param fname: path to fits file.
+    :type fname: str.
+    :param nside: nside of the map.
+    :type nside: int.
+    :param fill: initial value of all pixels.
+    :type fill: float.
+    :return: numpy.memmap -- memory mapped data of the map, shape (Npix,).
+
+    """
+    npix = hp.nside2npix(nside)
+    dtype = np.dtype([(name, '>f8') for name in MAP_COLUMNS])
+    table = fits.BinTableHDU.from_columns([fits.Column(name = name, format = 'D') for name in MAP_COLUMNS], nrows = 0)
+    header = table.header
+    header['NAXIS2'] = npix
+    header['PIXTYPE'] = ('HEALPIX', 'HEALPIX pixelisation')
+    header['ORDERING'] = ('RING', 'Pixel ordering scheme, either RING or NESTED')
+    header['EXTNAME'] = ('xtension', 'name of this binary table extension')
+    header['NSIDE'] = (nside, 'Resolution parameter of HEALPIX')
+    header['FIRSTPIX'] = (0, 'First pixel # (0 based)')
+    header['LASTPIX'] = (npix - 1, 'Last pixel # (0 based)')
+    header['INDXSCHM'] = ('IMPLICIT', 'Indexing: IMPLICIT or EXPLICIT')
+    header['OBJECT'] = ('FULLSKY', 'Sky coverage, either FULLSKY or PARTIAL')
+    primary_header = fits.PrimaryHDU().header.tostring().encode('ascii')
+    table_header = header.tostring().encode('ascii')
+    data_size = npix * dtype.itemsize
+    padded_size = int(np.ceil(data_size / 2880.)) * 2880
+    with open(fname, 'wb') as f:
+        f.write(primary_header)
+        f.write(table_header)
+        f.seek(len(primary_header) + len(table_header) + padded_size - 1)
+        f.write(b'\0')
+    data = np.memmap(fname, dtype = dtype, mode = 'r+', offset = len(primary_header) + len(table_header), shape = (npix,))
+    for start in range(0, npix, PIXEL_CHUNK):
+        for name in MAP_COLUMNS:
+            data[name][start : start + PIXEL_CHUNK] = fill
+    return data
+
+"""Directory in which :func:`pysm.common.read_map_cached` stores the maps
+it has read. If None, maps are not cached."""
+TEMPLATE_CACHE_DIR = os.environ.get("PYSM_TEMPLATE_CACHE_DIR")
+
+TEMPLATE_MEMORY_BUDGET = int(os.environ.get("PYSM_TEMPLATE_MEMORY_BUDGET", 2 ** 31))
+
+_template_memory = collections.OrderedDict()
+
+def clear_template_cache(fname = None):
+    """Drop maps from the in-process template cache used by
+    :func:`pysm.common.read_map_cached` and
+    :func:`pysm.common.cached_realization`, arrays from that used by
+    :func:`pysm.common.cached_arrays`, and, if `fname` is None, the
+    matrices of :func:`pysm.common.convolution_matrices`.
+
+    :param fname: path to file whose maps or derived arrays are dropped.
+     If None, the whole cache is emptied.
+    :type fname: str.
+    :returns: None.
+    """
+    if fname is None:
+        _template_memory.clear()
+        _cached_arrays.clear()
+        _random_states.clear()
+        _convolution_matrices.clear()
+        return
+    fname = os.path.abspath(fname)
+    for key in [key for key in _template_memory if key[0] == fname]:
+        del _template_memory[key]
+    for key in [key for key in _cached_arrays if fname in [each[0] for each in key[1]]]:
+        del _cached_arrays[key]
+
+def _memoize_template(key, template_map):
+    """Add a map to the in-process template cache, evicting the least
+    recently used maps until the cache fits in `TEMPLATE_MEMORY_BUDGET`
+    bytes.
+    """
+    template_map.setflags(write = False)
+    if template_map.nbytes > TEMPLATE_MEMORY_BUDGET:
+        return
+    _template_memory[key] = template_map
+    while sum(each.nbytes for each in _template_memory.values()) > TEMPLATE_MEMORY_BUDGET:
+        _template_memory.popitem(last = False)
+
+def _read_map_disk_cached(fname, nside, field, verbose):
+    """Read and up / downgrade the given fields of a fits file, going
+    through the .npy files in `TEMPLATE_CACHE_DIR` if it is set, one per
+    field, so that reads of overlapping fields share them. The fields
+    missing from the disk cache are read from the fits file in a single
+    call. Returns a list of len(field) maps.
+    """
+    if TEMPLATE_CACHE_DIR is None:
+        output_map = hp.ud_grade(hp.read_map(fname, field = field, verbose = verbose), nside_out = nside)
+        return list(np.asarray(output_map, dtype=np.float64).reshape(len(field), -1))
+    stat = os.stat(fname)
+    cache_files = []
+    for each in field:
+        key = repr((os.path.abspath(fname), stat.st_mtime, stat.st_size, each, nside, "RING"))
+        cache_files.append(os.path.join(TEMPLATE_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy"))
+    maps = {}
+    for each, cache_file in zip(field, cache_files):
+        try:
+            maps[each] = np.load(cache_file, mmap_mode = "r")
+        except IOError:
+            pass
+    missing = [each for each in field if each not in maps]
+    if missing:
+        output_map = np.asarray(hp.ud_grade(hp.read_map(fname, field = tuple(missing), verbose = verbose), nside_out = nside), dtype=np.float64).reshape(len(missing), -1)
+        for each, single_map in zip(missing, output_map):
+            cache_file = cache_files[list(field).index(each)]
+            _write_cache_file(cache_file, lambda f: np.save(f, single_map))
+            maps[each] = np.load(cache_file, mmap_mode = "r")
+    return [maps[each] for each in field]
+
+def _write_cache_file(cache_file, write):
+    """Write a file of the cache directory with the function `write` of
+    an open file. It is written to a temporary file first, so that other
+    processes never see a partial file.
+    """
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR)
+    except OSError: # already exists
+        pass
+    fd, tmp_file = tempfile.mkstemp(dir = TEMPLATE_CACHE_DIR, suffix = os.path.splitext(cache_file)[1])
+    with os.fdopen(fd, "wb") as f:
+        write(f)
+    os.rename(tmp_file, cache_file)
+
+_cached_arrays = {}
+
+def cached_arrays(fnames, compute, name, mpi_comm = None):
+    """Return arrays derived from some files, e.g. parsed tables or
+    fitted coefficients, computing them only once.
+
+    The arrays are kept in memory and, if `TEMPLATE_CACHE_DIR` is set,
+    on disk as a .npz file, identified by `name` and the path,
+    modification time and size of the files, so that later calls, also
+    from other processes, load them instead of computing them again.
+    The arrays are shared between calls and so read-only.
+
+    :param fnames: paths to the files from which the arrays are computed.
+    :type fnames: list of str.
+    :param compute: function without arguments returning a dictionary of numpy arrays.
+    :type compute: function.
+    :param name: name of the computation.
+    :type name: str.
+    :param mpi_comm: compute or load on rank 0 and broadcast over MPI.
+    :type mpi_comm: mpi4py MPI Communicator.
+    :returns: dict -- the arrays.
+    """
+    if (mpi_comm is not None and mpi_comm.rank==0) or (mpi_comm is None):
+        key = (name, tuple((os.path.abspath(fname), os.stat(fname).st_mtime, os.stat(fname).st_size) for fname in fnames))
+        try:
+            arrays = _cached_arrays[key]
+        except KeyError:
+            arrays = None
+            if TEMPLATE_CACHE_DIR is not None:
+                cache_file = os.path.join(TEMPLATE_CACHE_DIR, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npz")
+                try:
+                    with np.load(cache_file) as f:
+                        arrays = dict(f)
+                except IOError:
+                    pass
+            if arrays is None:
+                arrays = dict((k, np.asarray(v)) for k, v in compute().items())
+                if TEMPLATE_CACHE_DIR is not None:
+                    _write_cache_file(cache_file, lambda f: np.savez(f, **arrays))
+            for each in arrays.values():
+                each.setflags(write = False)
+            _cached_arrays[key] = arrays
+    elif mpi_comm is not None and mpi_comm.rank>0:
+        arrays = None
+
+    if mpi_comm is not None:
+        arrays = mpi_comm.bcast(arrays, root=0)
+
+    return arrays
+
+_random_states = {}
+
+def _realization_key(name, parameters):
+    """Hash the name and parameters of a random realization, arrays by
+    their shape and contents, other parameters by their repr.
+    """
+    digest = hashlib.sha1(name.encode("utf-8"))
+    for parameter in parameters:
+        if isinstance(parameter, np.ndarray) or isinstance(parameter, (list, tuple)):
+            parameter = np.ascontiguousarray(parameter, dtype = np.float64)
+            digest.update(repr(parameter.shape).encode("utf-8"))
+            digest.update(parameter.tobytes())
+        else:
+            digest.update(repr(parameter).encode("utf-8"))
+    return name + "_" + digest.hexdigest()
+
+def cached_realization(name, parameters, compute):
+    """Return a random realization, e.g. of the CMB, computing it only
+    once for given parameters.
+
+    The realization is identified by `name` and the contents of
+    `parameters`, which must include the random seed. It is kept in the
+    in-process cache of :func:`pysm.common.read_map_cached` and, if
+    `TEMPLATE_CACHE_DIR` is set, on disk as a .npy file that is returned
+    read-only memory mapped, so that later calls, also from other
+    processes, load it instead of computing it again. The state of
+    numpy's global random number generator after the computation is
+    stored with it and restored when it is loaded, so that subsequent
+    random draws do not depend on whether the realization was cached.
+
+    :param name: name of the realization.
+    :type name: str.
+    :param parameters: parameters which fully determine the realization, floats, strings or arrays.
+    :type parameters: list.
+    :param compute: function without arguments returning the realization.
+    :type compute: function.
+    :returns: numpy.ndarray -- the read-only realization.
+    """
+    key = _realization_key(name, parameters)
+    memory_key = ("realization", key)
+    if memory_key in _template_memory:
+        _template_memory[memory_key] = _template_memory.pop(memory_key)
+        np.random.set_state(_random_states[key])
+        return _template_memory[memory_key]
+    realization = None
+    if TEMPLATE_CACHE_DIR is not None:
+        cache_file = os.path.join(TEMPLATE_CACHE_DIR, key + ".npy")
+        state_file = os.path.join(TEMPLATE_CACHE_DIR, key + "_random_state.npz")
+        try:
+            with np.load(state_file) as f:
+                random_state = (str(f["name"]), f["keys"], int(f["pos"]), int(f["has_gauss"]), float(f["cached_gaussian"]))
+            realization = np.load(cache_file, mmap_mode = "r")
+        except IOError:
+            pass
+    if realization is None:
+        realization = np.asarray(compute(), dtype = np.float64)
+        random_state = np.random.get_state()
+        if TEMPLATE_CACHE_DIR is not None:
+            # the state is written first, so that it exists whenever the realization does.
+            _write_cache_file(state_file, lambda f: np.savez(f, name = random_state[0], keys = random_state[1], pos = random_state[2], has_gauss = random_state[3], cached_gaussian = random_state[4]))
+            _write_cache_file(cache_file, lambda f: np.save(f, realization))
+            realization = np.load(cache_file, mmap_mode = "r")
+    np.random.set_state(random_state)
+    _random_states[key] = random_state
+    _memoize_template(memory_key, realization)
+    return realization
+
+def read_map_cached(fname, nside, field = (0), verbose = False):
+    """Read a map with healpy's read_map and up / downgrade it, keeping
+    the result in memory and, if `TEMPLATE_CACHE_DIR` is set, on disk as
+    a .npy file.
+
+    Each field is kept in an in-process least recently used cache of at
+    most `TEMPLATE_MEMORY_BUDGET` bytes (set through the
+    PYSM_TEMPLATE_MEMORY_BUDGET environment variable, 0 disables it), so
+    that models sharing a template, e.g. the nominal dust models, only
+    read it once. Fields missing from that cache are read from the fits
+    file in a single call. Maps are identified by the path, modification
+    time and size of the fits file, so a modified file is read again;
+    :func:`pysm.common.clear_template_cache` drops maps explicitly.
+
+    The disk cache holds one .npy file per field and nside, returned
+    read-only memory mapped, so that subsequent calls from other
+    processes, also for other combinations of the fields, do not read
+    the fits file again or redo the change of resolution. The cache directory can also
+    be set through the PYSM_TEMPLATE_CACHE_DIR environment variable.
+
+    :param fname: path to fits file.
+    :type fname: str.
+    :param nside: nside to which we up or down grade.
+    :type nside: int.
+    :param field: fields of fits file from which to read.
+    :type field: tuple of ints.
+    :param verbose: run in verbose mode.
+    :type verbose: bool.
+    :returns: numpy.ndarray -- the read-only maps that have been read, in RING ordering.
+    """
+    fields = np.atleast_1d(field).tolist()
+    stat = os.stat(fname)
+    keys = [(os.path.abspath(fname), stat.st_mtime, stat.st_size, each, nside) for each in fields]
+    missing = [f for f, key in zip(fields, keys) if key not in _template_memory]
+    if missing:
+        read = dict(zip(missing, _read_map_disk_cached(fname, nside, tuple(missing), verbose)))
+        for f, key in zip(fields, keys):
+            if f in read:
+                _memoize_template(key, read[f])
+    maps = []
+    for f, key in zip(fields, keys):
+        if key in _template_memory:
+            _template_memory[key] = _template_memory.pop(key)
+            maps.append(_template_memory[key])
+        else: # larger than the budget
+            maps.append(read[f])
+    if len(fields) == 1: # as healpy, also for a single field in a tuple.
+        return maps[0]
+    output_map = np.array(maps)
+    output_map.setflags(write = False)
+    return output_map
+
+def read_map_pixels(fname, nside, pixel_indices, field = (0)):
+    """Read a subset of the pixels of a map, equal to what
+    :func:`pysm.common.read_map_cached` followed by indexing with
+    `pixel_indices` returns, without reading the full sky.
+
+    The fits table is memory mapped and only the rows holding the
+    required pixels are read: the pixels themselves if the map is at
+    `nside`, their children if it has to be downgraded, averaged as
+    healpy's ud_grade does, or their parents if it has to be upgraded.
+
+    :param fname: path to fits file.
+    :type fname: str.
+    :param nside: nside at which the pixels are defined.
+    :type nside: int.
+    :param pixel_indices: pixels to read in RING ordering.
+    :type pixel_indices: array of ints.
+    :param field: fields of fits file from which to read.
+    :type field: tuple of ints.
+    :returns: numpy.ndarray -- the pixels that have been read.
+    :raises: ValueError -- if the file is not a full sky HEALPix map.
+    """
+    pixel_indices = np.asarray(pixel_indices)
+    if pixel_indices.dtype.kind not in "iu":
+        raise ValueError("pixel_indices must be an array of integers.")
+    with fits.open(fname, memmap = True) as hdulist:
+        hdu = hdulist[1]
+        header = hdu.header
+        if "NSIDE" not in header or header.get("INDXSCHM", "IMPLICIT").strip() != "IMPLICIT":
+            raise ValueError("%s is not a full sky HEALPix map." % fname)
+        nside_in = header["NSIDE"]
+        nest = header.get("ORDERING", "RING").strip().startswith("NEST")
+        if nside_in == nside:
+            file_pixels = hp.ring2nest(nside, pixel_indices) if nest else pixel_indices
+        else:
+            nest_pixels = hp.ring2nest(nside, pixel_indices)
+            if nside_in > nside: # children
+                rat2 = (nside_in // nside) ** 2
+                file_pixels = nest_pixels[..., None] * rat2 + np.arange(rat2)
+            else: # parents
+                file_pixels = nest_pixels // ((nside // nside_in) ** 2)
+            if not nest:
+                file_pixels = hp.nest2ring(nside_in, file_pixels)
+        output_map = []
+        for f in np.atleast_1d(field):
+            column = hdu.data.field(f)
+            # index the rows of the memory mapped column, so that only
+            # the rows holding the pixels are read.
+            if column.ndim == 1:
+                m = column[file_pixels]
+            else:
+                m = column[file_pixels // column.shape[1], file_pixels % column.shape[1]]
+            m = m.astype(m.dtype.newbyteorder("="))
+            try:
+                m[hp.mask_bad(m)] = hp.UNSEEN
+            except OverflowError:
+                pass
+            if nside_in > nside: # average the good children, as ud_grade.
+                goods = ~(hp.mask_bad(m) | (~np.isfinite(m)))
+                nhit = goods.sum(axis = -1)
+                m = np.sum(m * goods, axis = -1).astype(m.dtype)
+                m[nhit != 0] = m[nhit != 0] / nhit[nhit != 0]
+                m[nhit == 0] = hp.UNSEEN
+            output_map.append(np.asarray(m, dtype = np.float64))
+    if len(output_map) == 1:
+        return output_map[0]
+    return np.array(output_map)
+
+def read_map_distributed(fname, nside, pixel_indices, mpi_comm, field = (0), verbose = False):
+    """Read the pixels each MPI process needs from a map, without any
+    process holding the full sky map.
+
+    This is a collective call: every process passes the pixels it needs,
+    rank 0 gathers them, reads them with
+    :func:`pysm.common.read_map_pixels`, and scatters each process its
+    own pixels with Scatterv.
+
+    :param fname: path to fits file.
+    :type fname: str.
+    :param nside: nside to which we up or down grade.
+    :type nside: int.
+    :param pixel_indices: pixels needed by this process in RING ordering.
+    :type pixel_indices: array of ints.
+    :param mpi_comm: communicator over which the map is distributed.
+    :type mpi_comm: mpi4py MPI Communicator.
+    :param field: fields of fits file from which to read.
+    :type field: tuple of ints.
+    :param verbose: run in verbose mode.
+    :type verbose: bool.
+    :returns: numpy.ndarray -- the pixels of this process.
+    """
+    pixel_indices = np.asarray(pixel_indices)
+    if pixel_indices.dtype == bool:
+        pixel_indices = np.flatnonzero(pixel_indices)
+    pixel_indices = pixel_indices.astype(np.int64)
+    ncomp = len(np.atleast_1d(field))
+    counts = np.array(mpi_comm.allgather(len(pixel_indices)))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    all_indices = None
+    send_buffer = None
+    if mpi_comm.rank == 0:
+        all_indices = np.empty(offsets[-1], dtype=np.int64)
+    mpi_comm.Gatherv(pixel_indices, [all_indices, counts], root=0)
+    if mpi_comm.rank == 0:
+        try:
+            values = read_map_pixels(fname, nside, all_indices, field = field)
+        except ValueError: # not a full sky map, read it all on this process only.
+            values = np.asarray(read_map_cached(fname, nside, field = field, verbose = verbose))[..., all_indices]
+        values = values.reshape(ncomp, -1)
+        # the pixels of each process are contiguous in the send buffer.
+        send_buffer = np.concatenate([values[:, start:stop].ravel() for start, stop in zip(offsets[:-1], offsets[1:])])
+    output_map = np.empty((ncomp, len(pixel_indices)), dtype=np.float64)
+    mpi_comm.Scatterv([send_buffer, counts * ncomp], output_map, root=0)
+    if ncomp == 1:
+        return output_map[0]
+    return output_map
+
 def read_map(fname, nside, field = (0), pixel_indices=None, mpi_comm=None, verbose = False):
     """Convenience function wrapping healpy's read_map and upgrade /
     downgrade in one function.
@@ -77,14 +867,30 @@ def read_map(fname, nside, field = (0), pixel_indices=None, mpi_comm=None, verbo
     :type field: tuple of ints.  
     :param pixel_indices: read only a subset of pixels in RING ordering
     :type field: array of ints.
-    :param mpi_comm: Read on rank 0 and broadcast over MPI
+    :param mpi_comm: Read on rank 0 and broadcast over MPI, or, if
+     pixel_indices is given (on every process), distribute the pixels
+     with :func:`pysm.common.read_map_distributed`.
     :type field: mpi4py MPI Communicator.
     :param verbose: run in verbose mode.  
     :type verbose: bool.
-    :returns: numpy.ndarray -- the maps that have been read. 
+    :returns: numpy.ndarray -- the maps that have been read. They are
+     shared with the template cache (see :func:`pysm.common.read_map_cached`)
+     and so read-only, unless selecting pixel_indices or using mpi_comm.
+    Without mpi_comm, selecting pixel_indices only reads those pixels from
+    the file, see :func:`pysm.common.read_map_pixels`.
     """
+    if pixel_indices is not None and mpi_comm is not None:
+        return read_map_distributed(fname, nside, pixel_indices, mpi_comm, field = field, verbose = verbose)
+    if pixel_indices is not None:
+        try:
+            return read_map_pixels(fname, nside, pixel_indices, field = field)
+        except ValueError: # not a full sky map or not an array of pixels.
+            pass
     if (mpi_comm is not None and mpi_comm.rank==0) or (mpi_comm is None):
-        output_map = hp.ud_grade(hp.read_map(fname, field = field, verbose = verbose), nside_out = nside)
+        output_map = read_map_cached(fname, nside, field = field, verbose = verbose)
+        if mpi_comm is not None:
+            # the broadcast buffer must be writeable.
+            output_map = np.array(output_map, dtype=np.float64)
     elif mpi_comm is not None and mpi_comm.rank>0:
         npix = hp.nside2npix(nside)
         try:
@@ -445,3 +1251,74 @@ def build_full_map(pixel_indices, pixel_values, nside):
     full_map = hp.UNSEEN * np.ones(output_shape, dtype=np.float64)
     full_map[..., pixel_indices] = pixel_values
     return full_map
+
+_convolution_matrices = {}
+
+def _local_basis(nside, pixel_indices):
+    """Unit vectors of the centres of pixels and of the local south and
+    east directions there, each of shape (Npix, 3).
+    """
+    theta, phi = hp.pix2ang(nside, pixel_indices)
+    vectors = np.array([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)]).T
+    e_theta = np.array([np.cos(theta) * np.cos(phi), np.cos(theta) * np.sin(phi), -np.sin(theta)]).T
+    e_phi = np.array([-np.sin(phi), np.cos(phi), np.zeros_like(phi)]).T
+    return vectors, e_theta, e_phi
+
+def convolution_matrices(nside, pixel_indices, fwhm, radius, kernel = None):
+    """Sparse matrices convolving maps defined on a set of pixels with a
+    radial kernel, truncated at a given radius.
+
+    Each pixel of the output is the average of the pixels of the set
+    within `radius` of it, found with `hp.query_disc`, weighted by the
+    kernel of their angular distance, so that the kernel is normalised
+    over the pixels of the set and the edges of a patch are not
+    dimmed. The first matrix applies to intensity, the second, complex,
+    to Q + iU, which it parallel transports along the geodesics between
+    the pixels before averaging them. The matrices are cached in memory
+    for each nside, set of pixels, beam, radius and kernel.
+
+    :param nside: nside of the maps.
+    :type nside: int.
+    :param pixel_indices: pixels on which the maps are defined.
+    :type pixel_indices: numpy.ndarray.
+    :param fwhm: FWHM of the beam in radians.
+    :type fwhm: float.
+    :param radius: radius at which the kernel is truncated, in radians.
+    :type radius: float.
+    :param kernel: function of the angular distance and of `fwhm`, in radians, giving the kernel, a Gaussian of FWHM `fwhm` if None.
+    :type kernel: function.
+    :returns: tuple(scipy.sparse.csr_matrix) -- matrices of the convolution of T and of Q + iU.
+    """
+    key = (nside, _realization_key("pixels", [pixel_indices]), fwhm, radius, kernel)
+    if key in _convolution_matrices:
+        return _convolution_matrices[key]
+    pixel_indices = np.asarray(pixel_indices)
+    order = np.argsort(pixel_indices)
+    sorted_pixels = pixel_indices[order]
+    vectors, e_theta, e_phi = _local_basis(nside, pixel_indices)
+    rows = []
+    columns = []
+    for i, vector in enumerate(vectors):
+        disc = hp.query_disc(nside, vector, radius)
+        position = np.minimum(np.searchsorted(sorted_pixels, disc), len(sorted_pixels) - 1)
+        inside = sorted_pixels[position] == disc
+        columns.append(order[position[inside]])
+        rows.append(np.full(np.count_nonzero(inside), i))
+    rows = np.concatenate(rows)
+    columns = np.concatenate(columns)
+    distance = 2. * np.arcsin(np.minimum(0.5 * np.sqrt(np.sum((vectors[rows] - vectors[columns]) ** 2, axis = 1)), 1.))
+    if kernel is None:
+        sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+        weights = np.exp(-0.5 * (distance / sigma) ** 2)
+    else:
+        weights = np.asarray(kernel(distance, fwhm), dtype = np.float64)
+    weights /= np.bincount(rows, weights = weights, minlength = len(pixel_indices))[rows]
+    # the polarization angle relative to the geodesic is unchanged by parallel transport.
+    # angle from south towards east of the geodesic from the first pixel to the second.
+    bearing = lambda first, second: np.arctan2(np.einsum("ij,ij->i", vectors[second], e_phi[first]), np.einsum("ij,ij->i", vectors[second], e_theta[first]))
+    rotation = bearing(rows, columns) - bearing(columns, rows)
+    shape = (len(pixel_indices), len(pixel_indices))
+    matrices = (scipy.sparse.csr_matrix((weights, (rows, columns)), shape = shape),
+                scipy.sparse.csr_matrix((weights * np.exp(2j * rotation), (rows, columns)), shape = shape))
+    _convolution_matrices[key] = matrices
+    return matrices
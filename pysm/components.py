@@ -10,12 +10,18 @@ from __future__ import absolute_import, print_function
 import numpy as np
 import healpy as hp
 import os, sys, time
+from multiprocessing.pool import ThreadPool
+import collections
 import scipy.constants as constants
-from scipy.interpolate import interp1d, RectBivariateSpline
+from scipy.interpolate import interp1d, RectBivariateSpline, BSpline
 from scipy.special import factorial, comb
-from .common import read_key, convert_units, FloatOrArray, invert_safe, B, read_map
+from .common import read_key, convert_units, FloatOrArrayVectorized, scale_templates, constant_value, set_separable, pixel_subset, low_rank_sed, invert_safe, B, read_map, cached_arrays, cached_realization, PIXEL_CHUNK
 from .nominal import template
 
+def hd_data_files():
+    """Paths to the tables of the Hensley and Draine 2017 dust model."""
+    return [template("sil_fe00_2.0.dat"), template("sil_fe05_2.0.dat"), template("car_1.0.dat")]
+
 class Synchrotron(object):
     """Class defining attributes and scaling laws of the synchrotron
     component, instantiated with a configuration dictionary containing
@@ -33,6 +39,8 @@ class Synchrotron(object):
     - `Spectral_Index` : spectral index used in power law and curved power law -- numpy.ndarray or float.
     - `Spectral_Curvature` -- numpy.ndarray or float.
     - `Nu_Curve` -- pivot frequency of curvature.
+    - `Sed_Approximation_Rank` : optional, number of basis SEDs used to approximate a spatially varying SED, see :func:`pysm.common.low_rank_sed` -- int.
+    - `Sed_Approximation_Range` : minimum and maximum frequencies in GHz over which the SED is approximated, required if `Sed_Approximation_Rank` is set -- tuple.
 
     """
     def __init__(self, config):
@@ -112,6 +120,21 @@ class Synchrotron(object):
             print("Synchrotron attribute 'Nu_Curve' not set.")
             sys.exit(1)
 
+    @property
+    def Sed_Approximation_Rank(self):
+        try:
+            return self.__sed_approximation_rank
+        except AttributeError:
+            return None
+
+    @property
+    def Sed_Approximation_Range(self):
+        try:
+            return self.__sed_approximation_range
+        except AttributeError:
+            print("Synchrotron attribute 'Sed_Approximation_Range' not set.")
+            sys.exit(1)
+
     def signal(self):
         """Function to return the selected SED.
 
@@ -131,18 +154,34 @@ class Synchrotron(object):
         :return: power law model -- function
 
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
+        spectral_index = constant_value(self.Spectral_Index)
+
+        def scalings(nu, pixels = None):
+            scaling_I = power_law(nu, self.Nu_0_I, pixel_subset(spectral_index, pixels))
+            scaling_P = power_law(nu, self.Nu_0_P, pixel_subset(spectral_index, pixels))
+            return scaling_I, scaling_P, scaling_P
+
+        separable = np.ndim(spectral_index) == 0
+        sed_approximation = None
+        if self.Sed_Approximation_Rank is not None and not separable:
+            sed_approximation = low_rank_sed(scalings, np.size(spectral_index), self.Sed_Approximation_Range, self.Sed_Approximation_Rank)
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Power law scaling model.
 
-            :param nu: frequency at which to calculate the map.
-            :type nu: float.
-            :return: power law scaled maps, shape (3, Npix) -- numpy.ndarray shape
+            :param nu: frequencies at which to calculate the maps, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: power law scaled maps, shape (Nfreq, 3, Npix) -- numpy.ndarray shape
 
             """
-            scaling_I = power_law(nu, self.Nu_0_I, self.Spectral_Index)
-            scaling_P = power_law(nu, self.Nu_0_P, self.Spectral_Index)
-            return np.array([self.A_I * scaling_I, self.A_Q * scaling_P, self.A_U * scaling_P])
+            if sed_approximation is not None and sed_approximation.covers(nu):
+                return sed_approximation((self.A_I, self.A_Q, self.A_U), nu, out = out, weights = weights, pixels = pixels)
+            return scale_templates((self.A_I, self.A_Q, self.A_U), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if separable:
+            set_separable(model, (self.A_I, self.A_Q, self.A_U), scalings)
+        if sed_approximation is not None:
+            model.max_relative_error = sed_approximation.max_relative_error
         return model
 
     def curved_power_law(self):
@@ -155,17 +194,34 @@ class Synchrotron(object):
         :return: power law model -- function
 
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
+        spectral_index = constant_value(self.Spectral_Index)
+        spectral_curvature = constant_value(self.Spectral_Curvature)
+
+        def scalings(nu, pixels = None):
+            curvature_term = np.log(power_law(nu, self.Nu_Curve, pixel_subset(spectral_curvature, pixels)))
+            scaling_I = power_law(nu, self.Nu_0_I, pixel_subset(spectral_index, pixels) + curvature_term)
+            scaling_P = power_law(nu, self.Nu_0_P, pixel_subset(spectral_index, pixels) + curvature_term)
+            return scaling_I, scaling_P, scaling_P
+
+        separable = np.ndim(spectral_index) == 0 and np.ndim(spectral_curvature) == 0
+        sed_approximation = None
+        if self.Sed_Approximation_Rank is not None and not separable:
+            sed_approximation = low_rank_sed(scalings, np.broadcast(spectral_index, spectral_curvature).size, self.Sed_Approximation_Range, self.Sed_Approximation_Rank)
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Power law scaling model.
-            :param nu: frequency at which to calculate the map.
-            :type nu: float.
-            :return: power law scaled maps, shape (3, Npix) -- numpy.ndarray shape
+            :param nu: frequencies at which to calculate the maps, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: power law scaled maps, shape (Nfreq, 3, Npix) -- numpy.ndarray shape
             """
-            curvature_term = np.log(power_law(nu, self.Nu_Curve, self.Spectral_Curvature))
-            scaling_I = power_law(nu, self.Nu_0_I, self.Spectral_Index + curvature_term)
-            scaling_P = power_law(nu, self.Nu_0_P, self.Spectral_Index + curvature_term)
-            return np.array([self.A_I * scaling_I, self.A_Q * scaling_P, self.A_U * scaling_P])
+            if sed_approximation is not None and sed_approximation.covers(nu):
+                return sed_approximation((self.A_I, self.A_Q, self.A_U), nu, out = out, weights = weights, pixels = pixels)
+            return scale_templates((self.A_I, self.A_Q, self.A_U), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if separable:
+            set_separable(model, (self.A_I, self.A_Q, self.A_U), scalings)
+        if sed_approximation is not None:
+            model.max_relative_error = sed_approximation.max_relative_error
         return model
 
 class Dust(object):
@@ -191,6 +247,8 @@ class Dust(object):
     - `Fcar` : mass fraction of carbonaceous grains relative to silicate grains. Required by Hensley and Draine model.
     - `Add_Decorrelation` : add stochastic frequency decorrelation to the SED -- bool.
     - `Corr_Len` : correlation length to use in decorrelation model -- float.
+    - `Sed_Approximation_Rank` : optional, number of basis SEDs used to approximate a spatially varying modified black body, see :func:`pysm.common.low_rank_sed` -- int.
+    - `Sed_Approximation_Range` : minimum and maximum frequencies in GHz over which the SED is approximated, required if `Sed_Approximation_Rank` is set -- tuple.
 
     """
     def __init__(self, config, mpi_comm=None):
@@ -337,6 +395,21 @@ class Dust(object):
             print("Dust attribute 'nside' not set.")
             sys.exit(1)
 
+    @property
+    def Sed_Approximation_Rank(self):
+        try:
+            return self.__sed_approximation_rank
+        except AttributeError:
+            return None
+
+    @property
+    def Sed_Approximation_Range(self):
+        try:
+            return self.__sed_approximation_range
+        except AttributeError:
+            print("Dust attribute 'Sed_Approximation_Range' not set.")
+            sys.exit(1)
+
     def signal(self, **kwargs):
         """Function to return the selected SED.
 
@@ -356,21 +429,40 @@ class Dust(object):
         :return: function -- model (T, Q, U) maps.
 
         """
+        spectral_index = constant_value(self.Spectral_Index)
+        temp = constant_value(self.Temp)
+
+        def scalings(nu, pixels = None):
+            scaling_I = power_law(nu, self.Nu_0_I, pixel_subset(spectral_index, pixels) - 2) * black_body(nu, self.Nu_0_I, pixel_subset(temp, pixels))
+            scaling_P = power_law(nu, self.Nu_0_P, pixel_subset(spectral_index, pixels) - 2) * black_body(nu, self.Nu_0_P, pixel_subset(temp, pixels))
+            return scaling_I, scaling_P, scaling_P
+
+        separable = np.ndim(spectral_index) == 0 and np.ndim(temp) == 0
+        sed_approximation = None
+        if self.Sed_Approximation_Rank is not None and not separable:
+            sed_approximation = low_rank_sed(scalings, np.broadcast(spectral_index, temp).size, self.Sed_Approximation_Range, self.Sed_Approximation_Rank)
+
         @Add_Decorrelation(self)
-        @FloatOrArray
-        def model(nu, **kwargs):
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Black body model
 
-            :param nu: frequency at which to evaluate model.
-            :type nu: float.
-            :return: modified black body scaling of maps, shape (3, Npix).
+            :param nu: frequencies at which to evaluate model, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: modified black body scaling of maps, shape (Nfreq, 3, Npix).
 
             """
-            scaling_I = power_law(nu, self.Nu_0_I, self.Spectral_Index - 2) * black_body(nu, self.Nu_0_I, self.Temp)
-            scaling_P = power_law(nu, self.Nu_0_P, self.Spectral_Index - 2) * black_body(nu, self.Nu_0_P, self.Temp)
-            expected_length = hp.nside2npix(self.nside) if self.pixel_indices is None else len(self.pixel_indices)
-            assert len(scaling_I) == expected_length, "{} scaling different from expected {}".format(len(scaling_I), expected_length)
-            return np.array([self.A_I * scaling_I, self.A_Q * scaling_P, self.A_U * scaling_P])
+            if sed_approximation is not None and sed_approximation.covers(nu):
+                return sed_approximation((self.A_I, self.A_Q, self.A_U), nu, out = out, weights = weights, pixels = pixels)
+            scaling_I, scaling_P, _ = scalings(nu, pixels)
+            if pixels is None:
+                expected_length = hp.nside2npix(self.nside) if self.pixel_indices is None else len(self.pixel_indices)
+                assert scaling_I.shape[-1] in (1, expected_length), "{} scaling different from expected {}".format(scaling_I.shape[-1], expected_length)
+            return scale_templates((self.A_I, self.A_Q, self.A_U), (scaling_I, scaling_P, scaling_P), out = out, weights = weights, pixels = pixels)
+        if separable and not self.Add_Decorrelation:
+            set_separable(model, (self.A_I, self.A_Q, self.A_U), scalings)
+        if sed_approximation is not None:
+            model.max_relative_error = sed_approximation.max_relative_error
         return model
 
     @staticmethod
@@ -378,10 +470,7 @@ class Dust(object):
         #Use Planck MBB temperature data to draw realisations of the temperature and spectral
         #index from normal distribution with mean equal to the maximum likelihood commander value,
         # and standard deviation equal to the commander std.
-        T_mean = read_map(template("COM_CompMap_dust-commander_0256_R2.00.fits"), 256, field = 3, mpi_comm=mpi_comm, verbose = False)
-        T_std = read_map(template("COM_CompMap_dust-commander_0256_R2.00.fits"), 256, field = 5, mpi_comm=mpi_comm, verbose = False)
-        beta_mean = read_map(template("COM_CompMap_dust-commander_0256_R2.00.fits"), 256, field = 6, mpi_comm=mpi_comm, verbose = False)
-        beta_std = read_map(template("COM_CompMap_dust-commander_0256_R2.00.fits"), 256, field = 8, mpi_comm=mpi_comm, verbose = False)
+        T_mean, T_std, beta_mean, beta_std = read_map(template("COM_CompMap_dust-commander_0256_R2.00.fits"), 256, field = (3, 5, 6, 8), mpi_comm=mpi_comm, verbose = False)
 
         #draw the realisations
         np.random.seed(seed)
@@ -401,25 +490,115 @@ class Dust(object):
     def read_hd_data(mpi_comm=None):
         # Read in precomputed dust emission properties in infrared as a function of U
         # the radiation field strength for a given grain composition and grain size distribution.
-        if (mpi_comm is not None and mpi_comm.rank==0) or (mpi_comm is None):
+        # The parsed tables are cached, see pysm.common.cached_arrays.
+        fnames = hd_data_files()
+        def parse():
             data = dict()
             #data_sil contains the emission properties for silicon grains with no iron inclusions.
-            data["sil"] = np.genfromtxt(template("sil_fe00_2.0.dat"))
+            data["sil"] = np.genfromtxt(fnames[0])
             #data_silfe containts the emission properties for sillicon grains with 5% iron inclusions.
-            data["silfe"] = np.genfromtxt(template("sil_fe05_2.0.dat"))
+            data["silfe"] = np.genfromtxt(fnames[1])
             #data_car contains the emission properties of carbonaceous grains.
-            data["car"] = np.genfromtxt(template("car_1.0.dat"))
-        elif mpi_comm is not None and mpi_comm.rank>0:
-            data = None
-
-        if mpi_comm is not None:
-            data = mpi_comm.bcast(data, root=0)
+            data["car"] = np.genfromtxt(fnames[2])
+            return data
+        data = cached_arrays(fnames, parse, "hd_data", mpi_comm=mpi_comm)
 
         #get the wavelength and the set of field strengths over which these values were calculated.
         wav = data["sil"][:, 0]
         uvec = np.arange(-3., 5.01, 0.1)
         return data["sil"], data["silfe"], data["car"], wav, uvec
 
+    @staticmethod
+    def read_hd_splines(mpi_comm=None):
+        """Splines of the emission of each grain type of the Hensley and Draine
+        2017 model as a function of (U, wavelength), in Jy/sr/H. The splines
+        are fitted once and cached with their tables, see
+        :func:`pysm.common.cached_arrays`.
+
+        :param mpi_comm: fit on rank 0 and broadcast over MPI.
+        :type mpi_comm: mpi4py MPI Communicator.
+        :return: dict -- knots in U, `knots_U`, and in wavelength, `knots_lambda`, shared by all the splines, and coefficients of the splines of the intensity and polarisation of each grain type, e.g. `sil_i` and `sil_p`, of shape (len(knots_U) - 4, len(knots_lambda) - 4).
+        """
+        def fit():
+            data_sil, data_silfe, data_car, wav, uvec = Dust.read_hd_data()
+            splines = dict()
+            #interpolate the pre-computed solutions for the emissivity as a function of grain composition F_fe, Fcar, and
+            #field strenth U, to get emissivity as a function of (U, wavelength).
+            for grain, data in [("sil", data_sil), ("silfe", data_silfe), ("car", data_car)]:
+                for stokes, columns in [("i", slice(3, 84)), ("p", slice(84, 165))]:
+                    spline = RectBivariateSpline(uvec, wav, (data[:, columns] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
+                    knots_U, knots_lambda, coefficients = spline.tck[:3]
+                    splines[grain + "_" + stokes] = coefficients.reshape(len(knots_U) - 4, len(knots_lambda) - 4)
+            splines["knots_U"] = knots_U
+            splines["knots_lambda"] = knots_lambda
+            return splines
+        return cached_arrays(hd_data_files(), fit, "hd_splines", mpi_comm=mpi_comm)
+
+    @staticmethod
+    def hd_emission(fcar, f_fe, mpi_comm=None):
+        """Emission of the Hensley and Draine 2017 model for a given grain
+        composition, in Jy/sr/H.
+
+        :param fcar: mass fraction of carbonaceous grains relative to silicate grains.
+        :type fcar: float.
+        :param f_fe: fraction of silicate grains with iron inclusions.
+        :type f_fe: float.
+        :param mpi_comm: read the tables on rank 0 and broadcast over MPI.
+        :type mpi_comm: mpi4py MPI Communicator.
+        :return: tuple of functions -- emission in intensity and polarisation, functions of the frequencies in GHz, shape (Nfreq,), and uval, shape (Npix,), returning arrays of shape (Nfreq, Npix).
+        """
+        splines = Dust.read_hd_splines(mpi_comm=mpi_comm)
+
+        #The splines are cubic in both U and wavelength, on the same grid, so that at a given wavelength
+        #they reduce to a cubic spline in U. Its coefficients are obtained for each frequency by combining
+        #those of the grain compositions, and each pixel is then only interpolated in U. As for the splines
+        #the wavelength and U are clipped to the range of the tables.
+        knots_U = splines["knots_U"]
+        knots_lambda = splines["knots_lambda"]
+        def composition_spline(stokes):
+            coefficients = (1. - f_fe) * splines["sil_" + stokes] + fcar * splines["car_" + stokes] + f_fe * splines["silfe_" + stokes]
+            return BSpline(knots_lambda, coefficients.T, 3)
+        sed_I = composition_spline("i")
+        sed_P = composition_spline("p")
+
+        #Interpolation is done in wavelength and PySM uses nu in GHz so we must convert from fequency
+        #in GHz to wavelength in microns.
+        nu_to_lambda = lambda x: np.clip(1.e-3 * constants.c / x, knots_lambda[3], knots_lambda[-4]) #Note this is in SI units.
+        def emission(sed):
+            return lambda nu, uval: BSpline(knots_U, sed(nu_to_lambda(nu)).T, 3)(np.clip(uval, knots_U[3], knots_U[-4])).T
+        return emission(sed_I), emission(sed_P)
+
+    @staticmethod
+    def uval_index(npix_uval, nside, pixel_indices = None):
+        """Indices in a map of uval of the pixels of the templates, shape
+        (Npix, N), where N is 1 unless uval is at a higher resolution than
+        the templates, in which case the N pixels of uval within each
+        template pixel are given.
+
+        :param npix_uval: number of pixels of uval, either a full sky map, or the pixels in `pixel_indices`.
+        :type npix_uval: int.
+        :param nside: nside of the templates.
+        :type nside: int.
+        :param pixel_indices: pixels of the templates, if they are not a full sky map.
+        :type pixel_indices: numpy.ndarray.
+        :return: numpy.ndarray -- indices of the pixels of uval.
+        """
+        npix = hp.nside2npix(nside)
+        if pixel_indices is None:
+            pixels = np.arange(npix)
+        else:
+            pixels = np.asarray(pixel_indices)
+            if npix_uval != npix and npix_uval == len(pixels):
+                return np.arange(npix_uval)[:, np.newaxis]
+        nside_uval = hp.npix2nside(npix_uval)
+        if nside_uval == nside:
+            return pixels[:, np.newaxis]
+        nest_pixels = hp.ring2nest(nside, pixels)
+        if nside_uval < nside:
+            return hp.nest2ring(nside_uval, nest_pixels // (nside // nside_uval) ** 2)[:, np.newaxis]
+        nchildren = (nside_uval // nside) ** 2
+        return hp.nest2ring(nside_uval, nest_pixels[:, np.newaxis] * nchildren + np.arange(nchildren))
+
     def hensley_draine_2017(self, *args, **kwargs):
         """Returns dust (T, Q, U) maps as a function of observing frequenvy in GHz, nu. Uses the Hensley and Draine 2017 model.
 
@@ -442,94 +621,74 @@ class Dust(object):
         :return: function - model (T, Q, U) maps.
 
         """
-        data_sil, data_silfe, data_car, wav, uvec = self.read_hd_data(mpi_comm=self.mpi_comm)
+        emission_I, emission_P = self.hd_emission(self.Fcar, self.F_fe, mpi_comm=self.mpi_comm)
 
-        #interpolate the pre-computed solutions for the emissivity as a function of grain composition F_fe, Fcar, and
-        #field strenth U, to get emissivity as a function of (U, wavelength).
-        sil_i = RectBivariateSpline(uvec, wav, (data_sil[:, 3 : 84] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-        car_i = RectBivariateSpline(uvec, wav, (data_car[:, 3 : 84] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-        silfe_i = RectBivariateSpline(uvec, wav, (data_silfe[:, 3 : 84] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-
-        sil_p = RectBivariateSpline(uvec, wav, (data_sil[:, 84 : 165] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-        car_p = RectBivariateSpline(uvec, wav, (data_car[:, 84 : 165] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-        silfe_p = RectBivariateSpline(uvec, wav, (data_silfe[:, 84 : 165] * (wav[:, np.newaxis] * 1.e-6 / constants.c) * 1.e23).T) # to Jy/sr/H
-
-        #now draw the random realisation of uval if draw_uval = true
+        #now draw the random realisation of uval if draw_uval = true. uval is drawn from nside 256 maps,
+        #and so the emission is evaluated at that resolution if the sky is at a higher one.
         if self.Draw_Uval:
-            self.Uval = self.draw_uval(self.Draw_Uval_Seed, self.nside, mpi_comm=self.mpi_comm)
+            self.Uval = self.draw_uval(self.Draw_Uval_Seed, min(self.nside, 256), mpi_comm=self.mpi_comm)
         elif not self.Draw_Uval:
             pass
         else:
             print("Hensley_Draine_2017 model selected, but draw_uval not set. Set 'draw_uval' to True or False.")
 
-        @FloatOrArray
-        def model(nu, **kwargs):
+        #the values of uval in which the emission is evaluated, and, if uval is a map, the indices in
+        #them of each pixel of the templates.
+        if np.ndim(self.Uval) == 0:
+            uval_index = None
+            uval = np.atleast_1d(self.Uval)
+        else:
+            index = self.uval_index(len(self.Uval), self.nside, self.pixel_indices)
+            needed, uval_index = np.unique(index.ravel(), return_inverse = True)
+            uval_index = uval_index.reshape(index.shape)
+            uval = np.asarray(self.Uval)[needed]
+
+        #the emission at the reference frequencies.
+        reference_I = convert_units("Jysr", "uK_RJ", self.Nu_0_I) * emission_I(np.array([self.Nu_0_I]), uval)
+        reference_P = convert_units("Jysr", "uK_RJ", self.Nu_0_P) * emission_P(np.array([self.Nu_0_P]), uval)
+
+        """The interpolation above is only valid for nu > 10GHz. Therefore for frequencies below this
+        we implement a fudge and use the Rayleigh Jeans formula. The dust signal at this point should
+        be negligible in any case.
+        nu_break is the lowest frequency in the interpolation files given for the HD17 model.
+        """
+        nu_break = 10.
+
+        def scalings(nu, pixels = None):
+            #calculate the RJ scaling factor for frequencies below nu_break. At these frequencies
+            #dust is largely irrelevant, and so we just use a constant spectral index of 1.54.
+            nu_eval = np.maximum(nu, nu_break).ravel()
+            factor = np.where(nu <= nu_break, (nu / nu_break) ** 1.54, 1.) * convert_units("Jysr", "uK_RJ", nu_eval).reshape(nu.shape)
+            index = None if uval_index is None else pixel_subset(uval_index, pixels)
+            needed = slice(None)
+            if index is not None and pixels is not None:
+                needed, index_needed = np.unique(index.ravel(), return_inverse = True)
+                index = index_needed.reshape(index.shape)
+            scaling_I = factor * emission_I(nu_eval, uval[needed]) / reference_I[:, needed]
+            scaling_P = factor * emission_P(nu_eval, uval[needed]) / reference_P[:, needed]
+            if index is not None:
+                #average over the pixels of uval within each pixel of the templates, if it is at a higher resolution.
+                scaling_I = scaling_I[:, index].mean(axis = -1)
+                scaling_P = scaling_P[:, index].mean(axis = -1)
+            return scaling_I, scaling_P, scaling_P
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Model of Hensley and Draine 2017.
 
-            :param nu: frequency in GHz at which to evaluate the model.
-            :type nu: float.
-            :return: maps produced using Hensley and Draine 2017 SED.
+            :param nu: frequencies at which to evaluate the model, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: maps produced using Hensley and Draine 2017 SED, shape (Nfreq, 3, Npix).
 
             """
-
             if ('use_bandpass' in kwargs) and (kwargs['use_bandpass']):
-                return np.zeros((3, len(self.A_I)))
-
-            #Interpolation is done in wavelength and PySMvuses nu in GHz so we must convert from fequency
-            #in GHz to wavelength in microns for both the evaluation frequencies and reference frequencies.
-            nu_to_lambda = lambda x: 1.e-3 * constants.c / x #Note this is in SI units.
-
-            #Define lambda functions for the evaluation of the intensity and polarisation models.
-            #Note that the HD model intepolates in units of Jysr, so we convert to uK_RJ to match the
-            #other scalings.
-            eval_HD17_I = lambda nu, nu_0: convert_units("Jysr", "uK_RJ", nu) / convert_units("Jysr", "uK_RJ", nu_0) *(
-                (1. - self.F_fe) * sil_i.ev(self.Uval, nu_to_lambda(nu))
-                + self.Fcar * car_i.ev(self.Uval, nu_to_lambda(nu))
-                + self.F_fe * silfe_i.ev(self.Uval, nu_to_lambda(nu)) ) / (
-                    (1. - self.F_fe) * sil_i.ev(self.Uval, nu_to_lambda(nu_0))
-                    + self.Fcar * car_i.ev(self.Uval, nu_to_lambda(nu_0))
-                    + self.F_fe * silfe_i.ev(self.Uval, nu_to_lambda(nu_0))
-                )
-            eval_HD17_P = lambda nu, nu_0: convert_units("Jysr", "uK_RJ", nu) / convert_units("Jysr", "uK_RJ", nu_0) *(
-                (1. - self.F_fe) * sil_p.ev(self.Uval, nu_to_lambda(nu))
-                + self.Fcar * car_p.ev(self.Uval, nu_to_lambda(nu))
-                + self.F_fe * silfe_p.ev(self.Uval, nu_to_lambda(nu)) ) / (
-                    (1. - self.F_fe) * sil_p.ev(self.Uval, nu_to_lambda(nu_0))
-                    + self.Fcar * car_p.ev(self.Uval, nu_to_lambda(nu_0))
-                    + self.F_fe * silfe_p.ev(self.Uval, nu_to_lambda(nu_0))
-                )
-
-            """The interpolation above is only valid for nu > 10GHz. Therefore for frequencies below this
-            we implement a fudge and use the Rayleigh Jeans formula. The dust signal at this point should
-            be negligible in any case.
-            nu_break is the lowest frequency in the interpolation files given for the HD17 model.
-            """
-            nu_break = 10.
-            if (nu <= nu_break):
-                #calculate the RJ scaling factor for frequencies below nu_break. At these frequencies
-                #dust is largely irrelevant, and so we just use a constant spectral index of 1.54.
-                RJ_factor = (nu / nu_break) ** 1.54
-
-                #calculate the HD17  model at the break frequency.
-                scaling_I = RJ_factor * eval_HD17_I(nu_break, self.Nu_0_I)
-                scaling_P = RJ_factor * eval_HD17_P(nu_break, self.Nu_0_P)
-
-            else:
-
-                #calculate the intensity scaling from reference frequency
-                #self.Nu_0_I to frequency nu.
-                scaling_I = eval_HD17_I(nu, self.Nu_0_I)
-                scaling_P = eval_HD17_P(nu, self.Nu_0_P)
-
-            try:
-                scaling_I = hp.ud_grade(scaling_I, nside_out = self.nside)
-                scaling_P = hp.ud_grade(scaling_P, nside_out = self.nside)
-                if not self.pixel_indices is None:
-                    scaling_I = scaling_I[self.pixel_indices]
-                    scaling_P = scaling_P[self.pixel_indices]
-            except IndexError:
-                pass
-            return np.array([scaling_I * self.A_I, scaling_P * self.A_Q, scaling_P * self.A_U])
+                if out is not None:
+                    return out
+                shape = (3, len(pixel_subset(self.A_I, pixels)))
+                return np.zeros(shape if weights is not None else (len(nu),) + shape)
+            return scale_templates((self.A_I, self.A_Q, self.A_U), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if uval_index is None:
+            set_separable(model, (self.A_I, self.A_Q, self.A_U), scalings)
         return model
 
 class AME(object):
@@ -638,38 +797,96 @@ class AME(object):
         """
         return getattr(self, self.Model)()
 
-    def spdust_scaling(self, nu):
+    def spdust_scaling(self, nu, nu_peak = None, reference = None):
         """Returns AME SED at frequency in GHz, nu.
         Implementation of the SpDust2 code of (Ali-Haimoud et al 2012), evaluated for a
         Cold Neutral Medium.
 
         :param nu: frequency at which to calculate SED.
-        :type nu: float.
-        :return: spdust SED - float.
+        :type nu: float, numpy.ndarray.
+        :param nu_peak: peak frequency to use instead of Nu_Peak.
+        :type nu_peak: float, numpy.ndarray.
+        :param reference: emissivity at the reference frequency for nu_peak, as
+        returned by :meth:`spdust_reference`, computed if not given.
+        :type reference: float, numpy.ndarray.
+        :return: spdust SED - float, numpy.ndarray.
 
         """
-        J = interp1d(self.Emissivity[0], self.Emissivity[1], bounds_error = False, fill_value = 0)
-        arg1 = nu * self.Nu_Peak_0 / self.Nu_Peak
-        arg2 = self.Nu_0_I * self.Nu_Peak_0 / self.Nu_Peak
-        scaling = ((self.Nu_0_I / nu) ** 2) * (J(arg1) / J(arg2))
+        if nu_peak is None:
+            nu_peak = self.Nu_Peak
+        if reference is None:
+            reference = self.spdust_reference(nu_peak)
+        J = self.emissivity_interpolator()
+        arg1 = nu * self.Nu_Peak_0 / nu_peak
+        scaling = ((self.Nu_0_I / nu) ** 2) * (J(arg1) / reference)
         return scaling
 
+    def emissivity_interpolator(self):
+        """Returns the interpolator of the SpDust2 emissivity, built once per
+        instance from `Emissivity`.
+
+        :return: scipy.interpolate.interp1d -- emissivity as a function of frequency in GHz.
+
+        """
+        try:
+            return self.__emissivity_interpolator
+        except AttributeError:
+            self.__emissivity_interpolator = interp1d(self.Emissivity[0], self.Emissivity[1], bounds_error = False, fill_value = 0)
+            return self.__emissivity_interpolator
+
+    def spdust_reference(self, nu_peak):
+        """Returns the emissivity at the reference frequency `Nu_0_I`, which
+        normalises the spdust SED, for the given peak frequency.
+
+        :param nu_peak: peak frequency.
+        :type nu_peak: float, numpy.ndarray.
+        :return: emissivity at the reference frequency -- float, numpy.ndarray.
+
+        """
+        return self.emissivity_interpolator()(self.Nu_0_I * self.Nu_Peak_0 / nu_peak)
+
+    def pol_templates(self):
+        """Returns the Q and U templates of the polarised AME model, computed
+        once per instance from `A_I`, `Pol_Frac` and the polarisation angle of
+        `Angle_Q` and `Angle_U`.
+
+        :return: tuple(numpy.ndarray) -- Q and U templates.
+
+        """
+        try:
+            return self.__pol_templates
+        except AttributeError:
+            pol_angle = np.arctan2(self.Angle_U, self.Angle_Q)
+            self.__pol_templates = (self.A_I * self.Pol_Frac * np.cos(pol_angle),
+                                    self.A_I * self.Pol_Frac * np.sin(pol_angle))
+            return self.__pol_templates
+
     def spdust(self):
         """Returns AME (T, Q, U) maps as a function of observing frequency, nu.
 
         :return: function -- AME spdust2 scaling as a function of frequency.
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
+        nu_peak = constant_value(self.Nu_Peak)
+
+        reference = self.spdust_reference(nu_peak)
+
+        def scalings(nu, pixels = None):
+            scaling = self.spdust_scaling(nu, pixel_subset(nu_peak, pixels), pixel_subset(reference, pixels))
+            return scaling, scaling, scaling
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Spdust2 unpolarised model.
 
-            :param nu: frequency in GHz at which to calculate the AME maps using
-            spdust2.
-            :type nu: float.
-            :return: AME maps at frequency nu, shape (3, Npix) -- numpy.ndarray.
+            :param nu: frequencies in GHz at which to calculate the AME maps using
+            spdust2, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: AME maps at frequencies nu, shape (Nfreq, 3, Npix) -- numpy.ndarray.
 
             """
-            return np.array([self.spdust_scaling(nu) * self.A_I, np.zeros_like(self.A_I), np.zeros_like(self.A_I)])
+            return scale_templates((self.A_I, 0., 0.), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if np.ndim(nu_peak) == 0:
+            set_separable(model, (self.A_I, 0., 0.), scalings)
         return model
 
     def spdust_pol(self):
@@ -681,23 +898,32 @@ class AME(object):
 
         :return: function -- polarised spdust2 model as a function of frequency.
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
+        nu_peak = constant_value(self.Nu_Peak)
+
+        reference = self.spdust_reference(nu_peak)
+
+        def scalings(nu, pixels = None):
+            scaling = self.spdust_scaling(nu, pixel_subset(nu_peak, pixels), pixel_subset(reference, pixels))
+            return scaling, scaling, scaling
+
+        A_Q, A_U = self.pol_templates()
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """We use input Q and U from dust templates in order to make the
             polarisation angle consistent after down or up grading
             resolution. Downgrading polarisatoin angle templates gives
             a different result to downgrading Q and U maps then
             calculating polarisation angle.
 
-            :param nu: frequency in GHz at which to evaluate the model.
-            :type nu: float.
-            :return: numpy.ndarray -- maps of polarised AME model, shape (3, Npix).
+            :param nu: frequencies in GHz at which to evaluate the model, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: numpy.ndarray -- maps of polarised AME model, shape (Nfreq, 3, Npix).
 
             """
-            pol_angle = np.arctan2(self.Angle_U, self.Angle_Q)
-            A_Q = self.A_I * self.Pol_Frac * np.cos(pol_angle)
-            A_U = self.A_I * self.Pol_Frac * np.sin(pol_angle)
-            return self.spdust_scaling(nu) * np.array([self.A_I, A_Q, A_U])
+            return scale_templates((self.A_I, A_Q, A_U), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if np.ndim(nu_peak) == 0:
+            set_separable(model, (self.A_I, A_Q, A_U), scalings)
         return model
 
 class Freefree(object):
@@ -769,18 +995,24 @@ class Freefree(object):
         :return: function -- power law model.
 
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
+        spectral_index = constant_value(self.Spectral_Index)
+
+        def scalings(nu, pixels = None):
+            scaling = power_law(nu, self.Nu_0_I, pixel_subset(spectral_index, pixels))
+            return scaling, scaling, scaling
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
             """Power law scaling model.
 
-            :param nu: frequency at which to calculate the map.
-            :type nu: float.
-            :return: numpy.ndarray -- power law scaled maps, shape (3, Npix).
+            :param nu: frequencies at which to calculate the maps, shape (Nfreq, 1).
+            :type nu: numpy.ndarray.
+            :return: numpy.ndarray -- power law scaled maps, shape (Nfreq, 3, Npix).
 
             """
-            scaling = power_law(nu, self.Nu_0_I, self.Spectral_Index)
-            zeros = np.zeros_like(self.A_I)
-            return np.array([self.A_I * scaling, zeros, zeros])
+            return scale_templates((self.A_I, 0., 0.), scalings(nu, pixels), out = out, weights = weights, pixels = pixels)
+        if np.ndim(spectral_index) == 0:
+            set_separable(model, (self.A_I, 0., 0.), scalings)
         return model
 
 class CMB(object):
@@ -800,6 +1032,8 @@ class CMB(object):
     - `nside` : nside at which to generate CMB.
     - `cmb_seed` : random seed for CMB generation.
     - `cmb_specs_lensed` : input lensed cls in CAMB format` -- numpy.ndarray
+    - `lensing_oversampling` : factor by which the nside of the grid_lensing unlensed maps exceeds nside, 4 if not set -- int
+    - `interpolation_order` : order of the grid_lensing interpolation, 3 (cubic, default) or 5 (quintic) -- int
 
     """
     def __init__(self, config):
@@ -863,6 +1097,20 @@ class CMB(object):
             print("CMB attribute 'CMB_Seed' not set.")
             sys.exit(1)
 
+    @property
+    def Lensing_Oversampling(self):
+        try:
+            return self.__lensing_oversampling
+        except AttributeError:
+            return None
+
+    @property
+    def Interpolation_Order(self):
+        try:
+            return self.__interpolation_order
+        except AttributeError:
+            return None
+
     @property
     def A_I(self):
         try:
@@ -899,12 +1147,12 @@ class CMB(object):
         """
         return getattr(self, self.Model)()
 
-    def taylens(self):
-        """Returns CMB (T, Q, U) maps as a function of observing frequency, nu.
-
-        This code is extracted from the taylens code (reference).
+    def lensing_spectra(self):
+        """Returns the spectra of T, E, B and the lensing potential used to
+        simulate the lensed CMB, and the maximum multipole of the
+        simulation.
 
-        :return: function -- CMB maps.
+        :return: numpy.ndarray, int -- spectra in the order of healpy's synalm, and lmax.
         """
         synlmax = 8 * self.Nside #this used to be user-defined.
         data = self.CMB_Specs
@@ -931,42 +1179,87 @@ class CMB(object):
             cl_tebp_arr[6,:] =np.zeros(lmax_cl+1)                                       #BP
             cl_tebp_arr[8,2:] = 2 * np.pi * data[7] / (l[2:] * (l[2:] + 1)) ** 1.5      #EP
             cl_tebp_arr[9,2:] = 2 * np.pi * data[6] / (l[2:] * (l[2:] + 1)) ** 1.5      #TP
+        return cl_tebp_arr, synlmax
 
-        # Coordinates of healpix pixel centers
-        ipos = np.array(hp.pix2ang(self.Nside, np.arange(12 * (self.Nside ** 2))))
+    def taylens(self):
+        """Returns CMB (T, Q, U) maps as a function of observing frequency, nu.
 
-        # Simulate a CMB and lensing field
-        cmb, aphi = simulate_tebp_correlated(cl_tebp_arr, self.Nside, synlmax, self.CMB_Seed)
+        This code is extracted from the taylens code (reference).
 
-        if cmb.ndim == 1:
-            cmb = np.reshape(cmb, [1, cmb.size])
+        :return: function -- CMB maps.
+        """
+        def realization():
+            cl_tebp_arr, synlmax = self.lensing_spectra()
 
-        # Compute the offset positions
-        phi, phi_dtheta, phi_dphi = hp.alm2map_der1(aphi, self.Nside, lmax = synlmax)
+            # Simulate a CMB and lensing field
+            cmb, aphi = simulate_tebp_correlated(cl_tebp_arr, self.Nside, synlmax, self.CMB_Seed)
 
-        del aphi
+            if cmb.ndim == 1:
+                cmb = np.reshape(cmb, [1, cmb.size])
 
-        opos, rot = offset_pos(ipos, phi_dtheta, phi_dphi, pol=True, geodesic=False) #geodesic used to be used defined.
-        del phi, phi_dtheta, phi_dphi
+            # Compute the gradient of the lensing potential
+            phi, phi_dtheta, phi_dphi = hp.alm2map_der1(aphi, self.Nside, lmax = synlmax)
 
-        # Interpolate maps one at a time
-        maps  = []
-        for comp in cmb:
-            for m in taylor_interpol_iter(comp, opos, 3, verbose=False, lmax=None): #lmax here needs to be fixed. order of taylor expansion is fixed to 3.
-                pass
-            maps.append(m)
-        del opos, cmb
-        #save the map computed for future referemce.
-        rm = apply_rotation(maps, rot)
+            del aphi, phi
 
-        @FloatOrArray
-        def model(nu, **kwargs):
-            cmb_map = np.array(rm) * convert_units("uK_CMB", "uK_RJ", nu)
-            if self.pixel_indices is None:
-                return cmb_map
-            else:
-                return cmb_map[:, self.pixel_indices]
-        return model
+            # order of taylor expansion is fixed to 3. lmax here needs to be fixed.
+            return lens_maps(cmb, phi_dtheta, phi_dphi, order = 3, lmax = None, pixels = self.pixel_indices)
+
+        parameters = [self.Nside, self.CMB_Seed, self.CMB_Specs, self.Delens]
+        if self.Delens:
+            parameters.append(self.Delensing_Ells)
+        if self.pixel_indices is not None:
+            # only the requested pixels are lensed.
+            parameters.append(self.pixel_indices)
+        rm = cached_realization("taylens", parameters, realization)
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
+            return scale_templates(rm, cmb_scalings(nu), out = out, weights = weights, pixels = pixels)
+        return set_separable(model, tuple(rm), cmb_scalings)
+
+    def grid_lensing(self):
+        """Returns CMB (T, Q, U) maps as a function of observing frequency, nu.
+
+        The realization of :meth:`taylens` is lensed differently: the
+        unlensed maps are computed on an oversampled grid, at
+        `Lensing_Oversampling` times the nside, and interpolated at the
+        lensed position of each pixel by :func:`grid_lens_maps`. This
+        only takes a few spherical harmonic transforms, where taylens
+        needs several per order of the Taylor expansion, and so is faster
+        at high nside.
+
+        :return: function -- CMB maps.
+        """
+        oversampling = 4 if self.Lensing_Oversampling is None else self.Lensing_Oversampling
+        order = 3 if self.Interpolation_Order is None else self.Interpolation_Order
+
+        def realization():
+            cl_tebp_arr, synlmax = self.lensing_spectra()
+
+            # Simulate a CMB and lensing field
+            acmb, aphi = simulate_tebp_alms(cl_tebp_arr, self.Nside, synlmax, self.CMB_Seed)
+
+            # Compute the gradient of the lensing potential
+            phi, phi_dtheta, phi_dphi = hp.alm2map_der1(aphi, self.Nside, lmax = synlmax)
+
+            del aphi, phi
+
+            # the unlensed alms are cut above 3 * nside.
+            lmax = min(3 * self.Nside - 1, synlmax)
+            return grid_lens_maps(acmb, phi_dtheta, phi_dphi, oversampling = oversampling, order = order, lmax = lmax, pixels = self.pixel_indices)
+
+        parameters = [self.Nside, self.CMB_Seed, self.CMB_Specs, self.Delens, oversampling, order]
+        if self.Delens:
+            parameters.append(self.Delensing_Ells)
+        if self.pixel_indices is not None:
+            parameters.append(self.pixel_indices)
+        rm = cached_realization("grid_lensing", parameters, realization)
+
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
+            return scale_templates(rm, cmb_scalings(nu), out = out, weights = weights, pixels = pixels)
+        return set_separable(model, tuple(rm), cmb_scalings)
 
     def synfast(self):
         """Function for the calculation of lensed CMB maps directly from
@@ -989,18 +1282,19 @@ class CMB(object):
         cl_teb[4, 2:] = 0.
         cl_teb[5, 2:] = 0.
 
-        np.random.seed(self.CMB_Seed)
-        T, Q, U = hp.synfast(cl_teb, self.Nside, pol=True, new=True, verbose=False)
+        def realization():
+            np.random.seed(self.CMB_Seed)
+            return np.array(hp.synfast(cl_teb, self.Nside, pol=True, new=True, verbose=False))
 
-        @FloatOrArray
-        def model(nu, **kwargs):
-            cmb_map = np.array([T, Q, U]) * convert_units("uK_CMB", "uK_RJ", nu)
-            if self.pixel_indices is None:
-                return cmb_map
-            else:
-                return cmb_map[:, self.pixel_indices]
+        cmb_map = cached_realization("synfast", [self.Nside, self.CMB_Seed, self.CMB_Specs], realization)
+        if self.pixel_indices is not None:
+            cmb_map = cmb_map[:, self.pixel_indices]
 
-        return model
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
+            return scale_templates(cmb_map, cmb_scalings(nu), out = out, weights = weights, pixels = pixels)
+
+        return set_separable(model, tuple(cmb_map), cmb_scalings)
 
     def pre_computed(self):
         """Returns a CMB (T, Q, U) maps as a function of observing frequency, nu.
@@ -1009,10 +1303,10 @@ class CMB(object):
         it to some new frequency.
 
         """
-        @FloatOrArray
-        def model(nu, **kwargs):
-            return np.array([self.A_I, self.A_Q, self.A_U]) * convert_units("uK_CMB", "uK_RJ", nu)
-        return model
+        @FloatOrArrayVectorized
+        def model(nu, out = None, weights = None, pixels = None, **kwargs):
+            return scale_templates((self.A_I, self.A_Q, self.A_U), cmb_scalings(nu), out = out, weights = weights, pixels = pixels)
+        return set_separable(model, (self.A_I, self.A_Q, self.A_U), cmb_scalings)
 
 def power_law(nu, nu_0, b):
     """Calculate scaling factor for power-law SED.
@@ -1047,7 +1341,66 @@ def black_body(nu, nu_0, T):
     """
     return B(nu, T) / B(nu_0, T)
 
-def get_decorrelation_matrices(freqs,freq_ref,corrlen) :
+def cmb_scaling(nu):
+    """Calculate scaling factor for the CMB from thermodynamic units to
+    Rayleigh-Jeans units.
+
+    :param nu: frequencies being scaled to, shape (Nfreq, 1).
+    :type nu: numpy.ndarray.
+    :return: numpy.ndarray -- uK_CMB to uK_RJ conversion factors, shape (Nfreq, 1).
+
+    """
+    return convert_units("uK_CMB", "uK_RJ", nu.ravel()).reshape(nu.shape)
+
+def cmb_scalings(nu):
+    """Calculate the scaling factors of the CMB T, Q, and U, which are
+    all given by :func:`pysm.components.cmb_scaling`.
+
+    :param nu: frequencies being scaled to, shape (Nfreq, 1).
+    :type nu: numpy.ndarray.
+    :return: tuple -- T, Q, and U scaling factors, each of shape (Nfreq, 1).
+
+    """
+    scaling = cmb_scaling(nu)
+    return scaling, scaling, scaling
+
+"""Number of sets of decorrelation matrices kept by
+:func:`get_decorrelation_matrices`."""
+DECORRELATION_CACHE_SIZE = 256
+
+_decorrelation_matrices = collections.OrderedDict()
+
+def get_decorrelation_matrices(freqs, freq_ref, corrlen):
+    """Function to compute the mean and covariance for the decorrelation,
+    see :func:`compute_decorrelation_matrices`.
+
+    The matrices are memoized by frequencies, rounded to 1e-9 GHz,
+    reference frequency and correlation length, so that they are only
+    computed once for a given set of frequencies. They are therefore
+    read-only.
+
+    :param freqs: frequencies at which to calculate covariance structure.
+    :type freqs: numpy.array.
+    :param freq_ref: reference frequency for constrained map.
+    :type freq_ref: float.
+    :corrlen: correlation length of imposed Gaussian decorrelation.
+    :return: numpy.ndarray(len(freqs), len(freqs)), nump.ndarray(len(freqs)) -- the output covariance and mean.
+
+    """
+    key = (tuple(np.round(np.asarray(freqs, dtype = np.float64), 9)), float(freq_ref), float(corrlen))
+    try:
+        return _decorrelation_matrices[key]
+    except KeyError:
+        pass
+    matrices = compute_decorrelation_matrices(freqs, freq_ref, corrlen)
+    for matrix in matrices:
+        matrix.setflags(write = False)
+    _decorrelation_matrices[key] = matrices
+    if len(_decorrelation_matrices) > DECORRELATION_CACHE_SIZE:
+        _decorrelation_matrices.popitem(last = False)
+    return matrices
+
+def compute_decorrelation_matrices(freqs,freq_ref,corrlen) :
     """Function to compute the mean and covariance for the decorrelation
 
     :param freqs: frequencies at which to calculate covariance structure.
@@ -1058,7 +1411,7 @@ def get_decorrelation_matrices(freqs,freq_ref,corrlen) :
     :return: numpy.ndarray(len(freqs), len(freqs)), nump.ndarray(len(freqs)) -- the output covariance and mean.
 
     """
-    if corrlen <= 0:
+    if corrlen <= 0 or np.all(np.asarray(freqs) == freq_ref):
         rho_mean = np.ones([len(freqs), 1])
         rho_covar = np.zeros([len(freqs), len(freqs)])
     else:
@@ -1125,34 +1478,54 @@ def Add_Decorrelation(Component):
             once the add_decorrelation function is evaluated.
 
             """
-            def wrapper(nu, **kwargs):
-                try:
-                    N_freqs = len(nu)
-                except TypeError: # nu is a single value
-                    N_freqs = 1
-                    nu = np.array([nu])
+            def decorrelation_factors(nu):
+                """Draw the decorrelation of T, Q, and U at frequencies nu, shape
+                (Nfreq,), correlated between the frequencies, returned with
+                shape (Nfreq, 3).
+
+                """
                 rho_cov_I, rho_m_I = get_decorrelation_matrices(nu, Component.Nu_0_I, Component.Corr_Len)
                 rho_cov_P, rho_m_P = get_decorrelation_matrices(nu, Component.Nu_0_P, Component.Corr_Len)
-                extra_I = np.dot(rho_cov_I, np.random.randn(N_freqs))
-                extra_P = np.dot(rho_cov_P, np.random.randn(N_freqs))
-                decorr = np.zeros((N_freqs, 3))
+                extra_I = np.dot(rho_cov_I, np.random.randn(len(nu)))
+                extra_P = np.dot(rho_cov_P, np.random.randn(len(nu)))
+                decorr = np.zeros((len(nu), 3))
                 decorr[:, 0, None] = rho_m_I + extra_I[:, None]
                 decorr[:, 1, None] = rho_m_P + extra_P[:, None]
                 decorr[:, 2, None] = rho_m_P + extra_P[:, None]
-                decorrelated = decorr[..., None] * model(nu, **kwargs)
+                return decorr
+
+            def wrapper(nu, out = None, weights = None, **kwargs):
+                if weights is not None:
+                    # the frequencies of the weighted sum, e.g. a bandpass, are
+                    # decorrelated together with a single correlated draw, as
+                    # when evaluating them without weights, and the
+                    # decorrelation is absorbed into the weights of T, Q, and U.
+                    nu = np.asarray(nu, dtype = np.float64)
+                    weights = np.reshape(weights, (len(nu), -1)) * decorrelation_factors(nu)
+                    return model(nu, out = out, weights = weights, **kwargs)
+                try:
+                    N_freqs = len(nu)
+                except TypeError: # nu is a single value
+                    N_freqs = 1
+                    nu = np.array([nu])
+                decorrelated = model(nu, **kwargs)
+                decorrelated *= decorrelation_factors(nu)[..., None]
                 if N_freqs == 1:
-                    return decorrelated[0]
-                else:
+                    decorrelated = decorrelated[0]
+                if out is None:
                     return decorrelated
+                out += decorrelated
+                return out
+            # a legacy model, see pysm.common.FloatOrArray, is still
+            # evaluated over the full sky when decorrelated.
+            wrapper.full_sky = getattr(model, 'full_sky', False)
             return wrapper
         return decorrelation
 
     else:
         """If decorrelation not required do nothing with the decorator."""
         def decorrelation(model):
-            def wrapper(nu, **kwargs):
-                return model(nu, **kwargs)
-            return wrapper
+            return model
         return decorrelation
 
 """The following code is edited from the taylens code: Naess,
@@ -1165,6 +1538,15 @@ https://github.com/amaurea/taylens
 def simulate_tebp_correlated(cl_tebp_arr, nside, lmax, seed):
         """This generates correlated T,E,B and Phi maps
 
+        """
+        acmb, aphi = simulate_tebp_alms(cl_tebp_arr, nside, lmax, seed)
+        cmb=np.array(hp.alm2map(acmb, nside, pol = True, verbose = False))
+        return cmb, aphi
+
+def simulate_tebp_alms(cl_tebp_arr, nside, lmax, seed):
+        """This generates correlated T,E,B and Phi alms, those of T,E,B
+        being cut above the resolution of maps at the given nside.
+
         """
         np.random.seed(seed)
         alms=hp.synalm(cl_tebp_arr, lmax = lmax, new = True)
@@ -1174,8 +1556,291 @@ def simulate_tebp_correlated(cl_tebp_arr, nside, lmax, seed):
         beam_cut=np.ones(3 * nside)
         for ac in acmb:
                 hp.almxfl(ac, beam_cut, inplace = True)
-        cmb=np.array(hp.alm2map(acmb, nside, pol = True, verbose = False))
-        return cmb, aphi
+        return acmb, aphi
+
+"""Number of threads used by :func:`lens_maps` to lens the T, Q, and U
+maps concurrently, 1 by default, so that lensing only uses more cores
+when asked to through the PYSM_LENSING_THREADS environment variable."""
+LENSING_THREADS = int(os.environ.get("PYSM_LENSING_THREADS", 1))
+
+"""Approximate number of bytes that :func:`lens_maps` may use, besides its
+inputs and outputs. It limits the number of maps lensed concurrently, and
+whether the lensed positions are kept or computed again for each order of
+the Taylor expansion."""
+LENSING_MEMORY_BUDGET = int(os.environ.get("PYSM_LENSING_MEMORY_BUDGET", 2 ** 33))
+
+def lensing_geometry(nside, dtheta, dphi, pixels):
+    """Compute, for some pixels, the quantities used to lens a map by the
+    deflection field with gradient dtheta, dphi/sintheta: the pixel
+    closest to the lensed position, the offset of the lensed position
+    from its center, and the rotation of (Q, U), as in
+    :func:`offset_pos` and :func:`taylor_interpol_iter`.
+
+    :param nside: nside of the maps.
+    :type nside: int.
+    :param dtheta: theta derivative of the lensing potential, full sky.
+    :type dtheta: numpy.ndarray.
+    :param dphi: phi derivative over sintheta of the lensing potential, full sky.
+    :type dphi: numpy.ndarray.
+    :param pixels: pixels to compute.
+    :type pixels: slice, numpy.ndarray.
+    :return: closest pixels, shape (Npix,), offsets, shape (2, Npix), and rotation, shape (2, Npix) -- numpy.ndarray.
+
+    """
+    if isinstance(pixels, slice):
+        ipos = np.array(hp.pix2ang(nside, np.arange(*pixels.indices(12 * nside ** 2))))
+    else:
+        ipos = np.array(hp.pix2ang(nside, pixels))
+    opos, rot = offset_pos_helper(ipos, dtheta[pixels], dphi[pixels], True)
+    del ipos
+    ipix = hp.ang2pix(nside, opos[0], opos[1])
+    pos0 = np.array(hp.pix2ang(nside, ipix))
+    dpos = opos - pos0
+    # Take wrapping into account
+    bad = dpos[1] > np.pi
+    dpos[1, bad] = dpos[1, bad] - 2 * np.pi
+    bad = dpos[1] <- np.pi
+    dpos[1, bad] = dpos[1, bad] + 2 * np.pi
+    # Expand in terms of dphi*sintheta, see taylor_interpol_iter.
+    dpos[1] *= np.sin(pos0[0])
+    return ipix, dpos, rot
+
+def lens_maps(maps, dtheta, dphi, order = 3, lmax = None, threads = None, memory_budget = None, pixels = None):
+    """Lens healpix maps (T, Q, U) by the deflection field with gradient
+    dtheta, dphi/sintheta, using harmonic Taylor interpolation to the
+    given order.
+
+    The result is the same as that of :func:`offset_pos`,
+    :func:`taylor_interpol_iter` for each map and
+    :func:`apply_rotation`. The maps are however lensed concurrently in
+    a pool of `threads` threads, the derivatives of each order are
+    computed once and then used for all pixels, and the per-pixel stages
+    are done over chunks of pixels. `memory_budget` bounds the number of
+    maps lensed at the same time, each of which needs about 2 * order + 2
+    full sky maps, and the lensed positions are only kept between orders
+    if they also fit.
+
+    If `pixels` is given, only those pixels are lensed: the derivatives
+    are still computed over the full sky, but the per-pixel stages only
+    cost in proportion to the number of pixels.
+
+    :param maps: maps to lens, shape (Nmaps, Npix).
+    :type maps: numpy.ndarray.
+    :param dtheta: theta derivative of the lensing potential.
+    :type dtheta: numpy.ndarray.
+    :param dphi: phi derivative over sintheta of the lensing potential.
+    :type dphi: numpy.ndarray.
+    :param order: order of the Taylor expansion.
+    :type order: int.
+    :param lmax: maximum multipole of the derivatives, 3 * nside if None.
+    :type lmax: int.
+    :param threads: number of threads, `LENSING_THREADS` if None.
+    :type threads: int.
+    :param memory_budget: approximate number of bytes to use, `LENSING_MEMORY_BUDGET` if None.
+    :type memory_budget: int.
+    :param pixels: pixels to lens, all if None.
+    :type pixels: numpy.ndarray.
+    :return: numpy.ndarray -- lensed maps, shape (Nmaps, Npix), or (Nmaps, len(pixels)).
+
+    """
+    if threads is None:
+        threads = LENSING_THREADS
+    if memory_budget is None:
+        memory_budget = LENSING_MEMORY_BUDGET
+    maps = np.asarray(maps)
+    nside = hp.npix2nside(maps.shape[-1])
+    npix = maps.shape[-1] if pixels is None else len(pixels)
+    # chunks of the output, and the pixels they contain.
+    chunks = [slice(start, min(start + PIXEL_CHUNK, npix)) for start in range(0, npix, PIXEL_CHUNK)]
+    if pixels is None:
+        chunk_pixels = chunks
+    else:
+        chunk_pixels = [np.asarray(pixels)[chunk] for chunk in chunks]
+
+    # closest pixel, offset and rotation take 40 bytes per pixel.
+    map_bytes = (2 * order + 2) * 8 * maps.shape[-1]
+    geometry = None
+    if memory_budget >= 40 * npix + map_bytes:
+        geometry = [lensing_geometry(nside, dtheta, dphi, each) for each in chunk_pixels]
+        memory_budget -= 40 * npix
+    threads = int(max(1, min(threads, len(maps), memory_budget // map_bytes)))
+
+    def chunk_geometry(i):
+        if geometry is not None:
+            return geometry[i]
+        return lensing_geometry(nside, dtheta, dphi, chunk_pixels[i])
+
+    lensed = np.empty((len(maps), npix))
+    def lens(n):
+        for i, chunk in enumerate(chunks):
+            lensed[n, chunk] = maps[n][chunk_geometry(i)[0]]
+        for o, derivs in enumerate(taylor_derivatives(maps[n], order, lmax), 1):
+            for i, chunk in enumerate(chunks):
+                ipix, dpos, _ = chunk_geometry(i)
+                res = lensed[n, chunk]
+                for j in range(o + 1):
+                    N = comb(o, j) / factorial(o)
+                    res += N * derivs[j][ipix] * dpos[0]**(o-j) * dpos[1]**j
+            del derivs
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(lens, range(len(maps)))
+        finally:
+            pool.close()
+    else:
+        for n in range(len(maps)):
+            lens(n)
+
+    for i, chunk in enumerate(chunks):
+        lensed[:, chunk] = apply_rotation(lensed[:, chunk], chunk_geometry(i)[2])
+    return lensed
+
+def grid_lens_maps(alms, dtheta, dphi, oversampling = 4, order = 3, lmax = None, threads = None, pixels = None):
+    """Lens the (T, E, B) alms by the deflection field with gradient
+    dtheta, dphi/sintheta, given at the nside of the output, by
+    interpolation of the unlensed maps.
+
+    The unlensed (T, Q, U) maps are computed with a single transform at
+    `oversampling` times the output nside, and interpolated at the
+    lensed position of each pixel by :func:`ring_interpolate`. (Q, U)
+    are then rotated as in :func:`lens_maps`. The interpolation is done
+    over chunks of pixels, in a pool of `threads` threads.
+
+    :param alms: unlensed T, E, and B alms.
+    :type alms: numpy.ndarray.
+    :param dtheta: theta derivative of the lensing potential.
+    :type dtheta: numpy.ndarray.
+    :param dphi: phi derivative over sintheta of the lensing potential.
+    :type dphi: numpy.ndarray.
+    :param oversampling: ratio of the nside of the unlensed maps to that of the output.
+    :type oversampling: int.
+    :param order: order of the interpolation, 3 for cubic, 5 for quintic.
+    :type order: int.
+    :param lmax: maximum multipole of the unlensed maps, that of the alms if None.
+    :type lmax: int.
+    :param threads: number of threads, `LENSING_THREADS` if None.
+    :type threads: int.
+    :param pixels: pixels to lens, all if None.
+    :type pixels: numpy.ndarray.
+    :return: numpy.ndarray -- lensed maps, shape (3, Npix), or (3, len(pixels)).
+
+    """
+    if threads is None:
+        threads = LENSING_THREADS
+    nside = hp.npix2nside(len(dtheta))
+    if lmax is not None:
+        alm_lmax = hp.Alm.getlmax(len(alms[0]))
+        alms = [hp.resize_alm(alm, alm_lmax, alm_lmax, lmax, lmax) for alm in alms]
+    grid = np.array(hp.alm2map(alms, oversampling * nside, pol = True, verbose = False))
+    npix = len(dtheta) if pixels is None else len(pixels)
+    chunks = [slice(start, min(start + PIXEL_CHUNK, npix)) for start in range(0, npix, PIXEL_CHUNK)]
+    lensed = np.empty((len(grid), npix))
+
+    def lens(chunk):
+        if pixels is None:
+            chunk_pixels = np.arange(*chunk.indices(npix))
+        else:
+            chunk_pixels = np.asarray(pixels)[chunk]
+        ipos = np.array(hp.pix2ang(nside, chunk_pixels))
+        opos, rot = offset_pos_helper(ipos, dtheta[chunk_pixels], dphi[chunk_pixels], True)
+        lensed[:, chunk] = apply_rotation(ring_interpolate(grid, opos, order), rot)
+
+    if threads > 1 and len(chunks) > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(lens, chunks)
+        finally:
+            pool.close()
+    else:
+        for chunk in chunks:
+            lens(chunk)
+    return lensed
+
+def lagrange_weights(x, nodes):
+    """Weights of the values at the given nodes in the Lagrange
+    interpolation at x, with nodes along the last axis.
+
+    """
+    weights = np.ones(nodes.shape)
+    for a in range(nodes.shape[-1]):
+        for b in range(nodes.shape[-1]):
+            if a != b:
+                weights[..., a] *= (x - nodes[..., b]) / (nodes[..., a] - nodes[..., b])
+    return weights
+
+def ring_interpolate(maps, pos, order = 3):
+    """Interpolate healpix maps m[..., npix], in RING ordering, at the
+    positions pos[{theta,phi},...], by Lagrange interpolation of the
+    given order in phi along each of the order + 1 closest rings, which
+    are equally spaced in phi, and then in theta across the rings.
+
+    Rings beyond the poles are taken from the other side of the pole,
+    which leaves spin 0 and spin 2 fields unchanged.
+
+    """
+    nside = hp.npix2nside(maps.shape[-1])
+    nrings = 4 * nside - 1
+    startpix, ringpix, costheta, sintheta, shifted = hp.ringinfo(nside, np.arange(1, nrings + 1))
+    ring_theta = np.arctan2(sintheta, costheta)
+    offsets = np.arange(order + 1) - order // 2
+    theta, phi = pos[0], pos[1]
+
+    # rings around theta, those beyond the poles being reflected.
+    rings = np.searchsorted(ring_theta, theta)[:, None] - 1 + offsets
+    north, south = rings < 0, rings >= nrings
+    rings = np.where(north, -1 - rings, np.where(south, 2 * nrings - 1 - rings, rings))
+    nodes = np.where(north, -ring_theta[rings], np.where(south, 2 * np.pi - ring_theta[rings], ring_theta[rings]))
+    ring_phi = phi[:, None] + np.pi * (north | south)
+
+    # pixels around phi along each ring.
+    position = (ring_phi / (2 * np.pi) * ringpix[rings] - 0.5 * shifted[rings]) % ringpix[rings]
+    closest = np.floor(position)
+    phi_weights = lagrange_weights(position - closest, np.broadcast_to(offsets, closest.shape + offsets.shape).astype(np.float64))
+    ring_pixels = startpix[rings][..., None] + (closest[..., None].astype(np.int64) + offsets) % ringpix[rings][..., None]
+
+    values = np.sum(maps[..., ring_pixels] * phi_weights, axis = -1)
+    return np.sum(values * lagrange_weights(theta, nodes), axis = -1)
+
+def taylor_derivatives(m, order = 3, lmax = None):
+    """Successively yields, for each order o from 1 to the given one, the
+    list of o + 1 derivatives of order o, d^o m / dtheta^(o-j) dphi^j
+    for j from 0 to o, of a healpix map m[npix], with phi derivatives
+    over sintheta, as used by :func:`taylor_interpol_iter`.
+
+    A mixed derivative computed from two maps of the previous order is
+    yielded as computed from the first of them, and the next order is
+    computed from the second, as in the original Taylens code.
+
+    """
+    nside = hp.npix2nside(m.size)
+    if lmax is None:
+        lmax = 3 * nside
+    derivs = [m]
+    for o in range(1, order + 1):
+            # Compute our derivatives
+            derivs2 = [None for i in range(o+1)]
+            used = [None for i in range(o+1)]
+            # Loop through previous level in steps of two (except last)
+            for i in range(o):
+                    # Each alm2map_der1 provides two derivatives, so avoid
+                    # doing double work.
+                    if i < o-1 and i % 2 == 1:
+                            continue
+                    a = hp.map2alm(derivs[i], use_weights = True, lmax = lmax, iter = 0)
+                    derivs[i] = None
+                    dtheta, dphi = hp.alm2map_der1(a, nside, lmax = lmax)[-2:]
+                    derivs2[i : i + 2] = [dtheta, dphi]
+                    # Mixed derivatives are used from the first map they
+                    # are computed from.
+                    for j in range(i, min(i + 2, o + 1)):
+                            if used[j] is None:
+                                used[j] = derivs2[j]
+                    del a, dtheta, dphi
+            derivs = derivs2
+            yield used
+            del used
 
 def taylor_interpol_iter(m, pos, order=3, verbose=False, lmax=None):
     """Given a healpix map m[npix], and a set of positions
@@ -1207,39 +1872,15 @@ def taylor_interpol_iter(m, pos, order=3, verbose=False, lmax=None):
 
     # We will now Taylor expand our healpix field to
     # get approximations for the values at our chosen
-    # locations. The structure of this section is
-    # somewhat complicated by the fact that alm2map_der1 returns
-    # two different derivatives at the same time.
-    derivs = [[m]]
+    # locations.
     res = m[ipos]
     yield res
-    for o in range(1, order + 1):
-            # Compute our derivatives
-            derivs2 = [None for i in range(o+1)]
-            used    = [False for i in range(o+1)]
-            # Loop through previous level in steps of two (except last)
+    for o, derivs in enumerate(taylor_derivatives(m, order, lmax), 1):
             if verbose: tprint("order %d" % o)
-            for i in range(o):
-                    # Each alm2map_der1 provides two derivatives, so avoid
-                    # doing double work.
-                    if i < o-1 and i % 2 == 1:
-                            continue
-                    a = hp.map2alm(derivs[i], use_weights = True, lmax = lmax, iter = 0)
-                    derivs[i] = None
-                    dtheta, dphi = hp.alm2map_der1(a, nside, lmax = lmax)[-2:]
-                    derivs2[i : i + 2] = [dtheta, dphi]
-                    del a, dtheta, dphi
-                    # Use these to compute the next level
-                    for j in range(i, min(i + 2, o + 1)):
-                            if used[j]:
-                                continue
-                            N = comb(o, j) / factorial(o)
-                            res += N * derivs2[j][ipos] * dpos[0]**(o-j) * dpos[1]**j
-                            used[j] = True
-                            # If we are at the last order, we don't need to waste memory
-                            # storing the derivatives any more
-                            if o == order: derivs2[j] = None
-            derivs = derivs2
+            for j in range(o + 1):
+                    N = comb(o, j) / factorial(o)
+                    res += N * derivs[j][ipos] * dpos[0]**(o-j) * dpos[1]**j
+            del derivs
             yield res
 
 """The following functions are support routines for reading input
@@ -7,13 +7,14 @@
 """
 
 from __future__ import absolute_import, print_function
-from scipy import interpolate, integrate
+from scipy import integrate
 import numpy as np
 import healpy as hp
-import scipy.constants as constants
 import os, sys
+import collections
+from multiprocessing.pool import ThreadPool
 from .components import Dust, Synchrotron, Freefree, AME, CMB
-from .common import read_key, convert_units, bandpass_convert_units, check_lengths, write_map, build_full_map
+from .common import read_key, convert_units, bandpass_convert_units, check_lengths, write_map, build_full_map, convolution_matrices, weighted_sum, add_to_output, add_population, pixel_subset, create_map_file, MAP_COLUMNS
 
 class Sky(object):
     """Model sky signal of Galactic foregrounds.
@@ -107,18 +108,71 @@ class Sky(object):
             print("Sky attribute 'Components' not set.")
             sys.exit(1)
 
-    def signal(self, **kwargs):
+    def signal(self, exclude = None, **kwargs):
         """Returns the sky as a function of frequency.
 
         This returns a function which is the sum of all the requested 
-        sky components at the given frequency: (T, Q, U)(nu)."""
-        def signal(nu):
-            sig = 0.
-            for component in self.Components:
-                sig += getattr(self, component)(nu, **kwargs)
-            return sig
+        sky components at the given frequency: (T, Q, U)(nu).
+
+        The first component evaluated allocates the output array, and
+        every subsequent component adds its emission to it in place, see
+        :func:`pysm.common.add_population`.
+        The returned function also accepts an `out` keyword, an
+        existing array of the output shape to which the emission of all
+        the components is added.
+
+        If the returned function is given a `weights` keyword, an array
+        of the same length as nu, it returns the weighted sum over
+        frequency of the sky emission, shape (3, Npix), without
+        computing the maps at each frequency. This is used to integrate
+        the sky over a bandpass.
+
+        A `pixels` keyword, a slice or array of indices into the pixels
+        of the maps, restricts the evaluation to that subset of pixels.
+
+        :param exclude: populations, as returned by
+         :meth:`pysm.pysm.Sky.populations`, left out of the sum. If all
+         the populations are left out the function returns None.
+        :type exclude: list."""
+        exclude = [] if exclude is None else exclude
+        populations = [p for p in self.populations() if not any(p is e for e in exclude)]
+        def signal(nu, out = None, weights = None, pixels = None):
+            for population in populations:
+                out = add_population(population, nu, out = out, weights = weights, pixels = pixels, **kwargs)
+            return out
         return signal
 
+    def populations(self):
+        """Returns the signal functions of each population of each sky
+        component, which sum to the signal of the sky. A component added
+        with :meth:`pysm.pysm.Sky.add_component` is a single population.
+
+        :return: list of functions -- the population signals.
+        """
+        populations = []
+        for component in self.Components:
+            component_signal = getattr(self, component)
+            populations += getattr(component_signal, 'populations', [component_signal])
+        return populations
+
+    def separable_populations(self, use_bandpass = False):
+        """Returns the populations whose emission is separable, the product
+        of fixed templates and an SED, see
+        :func:`pysm.common.set_separable`.
+
+        :param use_bandpass: whether the sky is integrated over bandpasses,
+         in which case the Hensley-Draine 2017 dust, integrated separately
+         by `HD_17_bpass`, is not included.
+        :type use_bandpass: bool.
+        :return: list of functions -- the separable population signals, with `templates` and `sed` attributes.
+        """
+        populations = []
+        for component in self.Components:
+            if use_bandpass and component == 'dust' and self.Uses_HD17:
+                continue
+            populations += [p for p in getattr(getattr(self, component), 'populations', []) if hasattr(p, 'sed')]
+        return populations
+
     def add_component(self, name, component):
         """Add a already initialized component object to the sky
 
@@ -130,7 +184,15 @@ class Sky(object):
             object that provides a signal(nu, **kwargs) function that returns the emission in uK_RJ
         """
         self.__components.append(name)
-        setattr(self, name, component.signal)
+        def signal(nu, out = None, weights = None, pixels = None, **kwargs):
+            if pixels is not None:
+                return add_to_output(out, signal(nu, weights = weights, **kwargs)[..., pixels])
+            if weights is not None:
+                return weighted_sum(component.signal, nu, weights, out = out, **kwargs)
+            return add_to_output(out, component.signal(nu, **kwargs))
+        # the component is evaluated over the full sky even if pixels are selected.
+        signal.full_sky = True
+        setattr(self, name, signal)
 
 
 class Instrument(object):
@@ -154,6 +216,16 @@ class Instrument(object):
     - `output_directory` : directory to which the files will be written -- str.
     - `output_prefix` : prefix for all output files -- str.
     - `output_units` : output units -- str
+    - `pixel_chunk_size` : optional, if set the maps are computed and written to file this number of pixels at a time, see :meth:`pysm.pysm.Instrument.observe_chunked` -- int.
+    - `smoothing_tolerance` : optional, if set the smoothing of each channel ignores the multipoles at which its beam is below this value, see :meth:`pysm.pysm.Instrument.smoothing_lmax` -- float.
+    - `smoothing_iter` : optional, number of iterations of the spherical harmonic transform of the maps to smooth, 3 by default -- int.
+    - `smoothing_pixel_weights` : optional, whether to use healpy's pixel weights in the transform of the maps to smooth, False by default -- bool.
+    - `local_smoothing` : optional, if True and `pixel_indices` is set, the maps are smoothed by a convolution over the neighbouring pixels rather than in harmonic space, see :meth:`pysm.pysm.Instrument.local_smoother`, False by default -- bool.
+    - `smoothing_kernel` : optional, function of the angular distance and of the beam FWHM, in radians, giving the kernel of the local smoothing, a Gaussian by default -- function.
+    - `smoothing_kernel_radius` : optional, radius at which the kernel of the local smoothing is truncated, in units of the beam FWHM, 2 by default -- float.
+    - `smoothing_threads` : optional, number of threads over which the channels are smoothed, 1 by default, see :meth:`pysm.pysm.Instrument.map_smoothing_batches` -- int.
+    - `smoothing_max_maps` : optional, maximum number of full sky channel maps held at once by the smoothing threads, the number of threads by default -- int.
+    - `smoothing_nsides` : optional, nside at which each channel is smoothed, the maps being degraded to it before their transform, the nside of the instrument by default. The smoothed maps are still at the nside of the instrument -- list of int.
     
     The use of Instrument is with the :class:`pysm.pysm.Sky` class. Given an instance of Sky we can use the :meth:`pysm.pysm.Instrument.obseve` to apply instrumental effects:
     >>> sky = pysm.Sky(sky_config)
@@ -316,6 +388,76 @@ class Instrument(object):
         except AttributeError:
             print("Instrument attribute 'Output_Units not set.'")
             
+    @property
+    def Pixel_Chunk_Size(self):
+        try:
+            return self.__pixel_chunk_size
+        except AttributeError:
+            return None
+
+    @property
+    def Smoothing_Tolerance(self):
+        try:
+            return self.__smoothing_tolerance
+        except AttributeError:
+            return None
+
+    @property
+    def Smoothing_Iter(self):
+        try:
+            return self.__smoothing_iter
+        except AttributeError:
+            return 3
+
+    @property
+    def Smoothing_Pixel_Weights(self):
+        try:
+            return self.__smoothing_pixel_weights
+        except AttributeError:
+            return False
+
+    @property
+    def Smoothing_Nsides(self):
+        try:
+            return self.__smoothing_nsides
+        except AttributeError:
+            return None
+
+    @property
+    def Local_Smoothing(self):
+        try:
+            return self.__local_smoothing
+        except AttributeError:
+            return False
+
+    @property
+    def Smoothing_Kernel(self):
+        try:
+            return self.__smoothing_kernel
+        except AttributeError:
+            return None
+
+    @property
+    def Smoothing_Kernel_Radius(self):
+        try:
+            return self.__smoothing_kernel_radius
+        except AttributeError:
+            return 2.
+
+    @property
+    def Smoothing_Threads(self):
+        try:
+            return self.__smoothing_threads
+        except AttributeError:
+            return 1
+
+    @property
+    def Smoothing_Max_Maps(self):
+        try:
+            return self.__smoothing_max_maps
+        except AttributeError:
+            return None
+
     @property
     def pixel_indices(self):
         try:
@@ -331,15 +473,23 @@ class Instrument(object):
         smooths with a Gaussian beam, if requested. Then adds Gaussian
         white noise, if requested. Finally writes the maps to file.
 
+        If `pixel_chunk_size` is set and the outputs are written, the
+        maps are computed in chunks of pixels with
+        :meth:`pysm.pysm.Instrument.observe_chunked`.
+
         :param Sky: instance of the :class:`pysm.pysm.Sky` class. 
         :type Sky: class
         :return: no return, writes to file.
 
         """
         self.print_info()
-        signal = Sky.signal()
-        output = self.apply_bandpass(signal, Sky) 
-        output = self.smoother(output)
+        if write_outputs and self.Pixel_Chunk_Size is not None:
+            self.observe_chunked(Sky)
+            return
+        if self.Use_Smoothing:
+            output = self.smoothed_signal(Sky)
+        else:
+            output = self.apply_bandpass(Sky.signal(), Sky)
         noise = self.noiser()
         output, noise = self.unit_converter(output, noise)
         if write_outputs:
@@ -348,24 +498,132 @@ class Instrument(object):
             return output, noise
         return 
         
-    def apply_bandpass(self, signal, Sky):
+    def observe_chunked(self, Sky):
+        """Evaluate and add instrument effects to Sky's signal function,
+        processing `pixel_chunk_size` pixels at a time.
+
+        The output files are created at the start, memory mapped, and
+        each chunk of pixels of every channel is written to them as soon
+        as it is computed, so that the full set of maps is never held in
+        memory. Smoothing is the only step requiring the full sky: if
+        requested, the signal is first written to the output files, then
+        each channel is read back, smoothed, and rewritten, one channel
+        at a time, before the noise is added and the units converted.
+
+        The noise of each chunk is drawn independently, and is the same
+        as that of :meth:`pysm.pysm.Instrument.observe` without chunks,
+        see :meth:`pysm.pysm.Instrument.noiser`.
+
+        Populations which cannot evaluate a subset of the pixels, models
+        decorated with :func:`pysm.common.FloatOrArray` and components
+        added with :meth:`pysm.pysm.Sky.add_component`, marked by a
+        `full_sky` attribute, would be evaluated over the full sky for
+        every chunk. They are instead evaluated once, one channel at a
+        time, and written to the output files before the chunks of the
+        other populations are added to them.
+
+        :param Sky: instance of the :class:`pysm.pysm.Sky` class.
+        :type Sky: class
+        :return: no return, writes to file.
+
+        """
+        try:
+            npix = len(self.pixel_indices)
+        except TypeError:
+            npix = hp.nside2npix(self.Nside)
+        if self.Use_Bandpass:
+            paths = lambda extra_info: [self.file_path(channel_name = c, extra_info = extra_info) for c in self.Channel_Names]
+        else:
+            paths = lambda extra_info: [self.file_path(f = f, extra_info = extra_info) for f in self.Frequencies]
+        totals = [create_map_file(path, self.Nside) for path in paths("total")]
+        noises = [create_map_file(path, self.Nside) for path in paths("noise")] if self.Add_Noise else []
+        chunks = [slice(start, min(start + self.Pixel_Chunk_Size, npix)) for start in range(0, npix, self.Pixel_Chunk_Size)]
+        rows = lambda pixels: pixels if self.pixel_indices is None else self.pixel_indices[pixels]
+        Uc_signal, Uc_noise = self.unit_conversion_factors()
+        if self.Add_Noise:
+            # all the chunks draw their noise with the same seed.
+            noise_seed = self.Noise_Seed if self.Noise_Seed is not None else random_noise_seed()
+
+        def write_chunk(i, pixels, output):
+            """Add noise to the signal of chunk i, convert units, and write."""
+            if self.Add_Noise:
+                noise = self.noiser(pixels = pixels, seed = noise_seed)
+            else:
+                noise = np.zeros_like(output)
+            output, noise = Uc_signal[:, None, None] * output, Uc_noise[:, None, None] * noise
+            for c, total in enumerate(totals):
+                for j, name in enumerate(MAP_COLUMNS):
+                    total[name][rows(pixels)] = output[c, j] + noise[c, j]
+            for c, noise_map in enumerate(noises):
+                for j, name in enumerate(MAP_COLUMNS):
+                    noise_map[name][rows(pixels)] = noise[c, j]
+
+        full_sky = [p for p in Sky.populations() if getattr(p, 'full_sky', False)]
+        chunked = [p for p in Sky.populations() if not getattr(p, 'full_sky', False)]
+        # models adding random decorrelation draw from the global random state, which is
+        # reset for every chunk so that they draw the same realisation over the whole sky.
+        random_state = np.random.get_state()
+        if full_sky:
+            full_sky_signal = Sky.signal(exclude = chunked, **({'use_bandpass' : Sky.Uses_HD17} if self.Use_Bandpass else {}))
+            for c, total in enumerate(totals):
+                np.random.set_state(random_state)
+                if self.Use_Bandpass:
+                    f, w = self.Channels[c]
+                    channel_map = full_sky_signal(f, weights = self.integration_weights(f, w))
+                else:
+                    channel_map = full_sky_signal(self.Frequencies[c])
+                for j, name in enumerate(MAP_COLUMNS):
+                    total[name][rows(slice(None))] = channel_map[j]
+                del channel_map
+        signal = Sky.signal(exclude = full_sky)
+        for i, pixels in enumerate(chunks):
+            np.random.set_state(random_state)
+            output = self.apply_bandpass(signal, Sky, pixels = pixels, exclude = full_sky) if chunked else 0.
+            if full_sky:
+                output = output + np.array([[total[name][rows(pixels)] for name in MAP_COLUMNS] for total in totals])
+            if self.Use_Smoothing:
+                for c, total in enumerate(totals):
+                    for j, name in enumerate(MAP_COLUMNS):
+                        total[name][rows(pixels)] = output[c, j]
+            else:
+                write_chunk(i, pixels, output)
+            del output
+        if self.Use_Smoothing:
+            for c, total in enumerate(totals):
+                channel_map = np.array([total[name][rows(slice(None))] for name in MAP_COLUMNS])
+                smoothed = self.smoother(channel_map[np.newaxis], beams = self.Beams[c : c + 1], nsides = self.smoothing_nsides()[c : c + 1])[0]
+                for j, name in enumerate(MAP_COLUMNS):
+                    total[name][rows(slice(None))] = smoothed[j]
+                del channel_map, smoothed
+            for i, pixels in enumerate(chunks):
+                output = np.array([[total[name][rows(pixels)] for name in MAP_COLUMNS] for total in totals])
+                write_chunk(i, pixels, output)
+        for data in totals + noises:
+            data.flush()
+        return
+
+    def apply_bandpass(self, signal, Sky, pixels = None, exclude = None):
         """Function to integrate signal over a bandpass.  Frequencies must be
         evenly spaced, if they are not the function will object. Weights
         must be normalisable.
 
         :param signal: signal function to be integrated of bandpass
         :type param: function
+        :param pixels: if given, subset of the pixels at which to evaluate the signal.
+        :type pixels: slice, numpy.ndarray.
+        :param exclude: populations of Sky left out of the bandpass integrated signal, see :meth:`pysm.pysm.Sky.signal`.
+        :type exclude: list.
         :return: maps after bandpass integration shape either (N_freqs, 3, Npix) or (N_channels, 3, Npix) -- numpy.ndarray
         
         """
         if not self.Use_Bandpass:
-            return signal(self.Frequencies)
+            return signal(self.Frequencies, pixels = pixels)
         elif self.Use_Bandpass:
             #First need to tell the Sky class that we are using bandpass and if we are using the HD17 model.
-            bpass_signal = Sky.signal(use_bandpass = Sky.Uses_HD17)
-            # convert to Jysr in order to integrate over bandpass
-            signal_Jysr = lambda nu: bpass_signal(nu) * convert_units("uK_RJ", "Jysr", nu)
-            bpass_integrated = np.array([bandpass(f, w, signal_Jysr) for (f, w) in self.Channels])
+            bpass_signal = Sky.signal(exclude = exclude, use_bandpass = Sky.Uses_HD17)
+            # the whole bandpass of each channel is passed to the sky at once, with
+            # integration weights including the conversion to Jysr.
+            bpass_integrated = np.array([bpass_signal(f, weights = self.integration_weights(f, w), pixels = pixels) for (f, w) in self.Channels])
             # We now add an exception in for the case of the HD_17 model. This requires that the model be initialised
             # with the bandpass information in order for the model to be computaitonally efficient. Therefore this is
             # evaluated differently from other models. The function HD_17_bandpass() accepts a tuple (freqs, weights)
@@ -373,12 +631,25 @@ class Instrument(object):
             # class was first instantiated, if use_bandpass = True. Note that the dust signal will still contribute
             # to the bpass_integrated sum in the evaluation above, but will be zero.
             if Sky.Uses_HD17:
-                bpass_integrated += np.array(list(map(Sky.HD_17_bpass, self.Channels)))
+                bpass_integrated += np.array([Sky.HD_17_bpass(channel, pixels = pixels) for channel in self.Channels])
             return bpass_integrated
         else:
             print("Please set 'Use_Bandpass' for Instrument object.")
             sys.exit(1)
 
+    def integration_weights(self, frequencies, weights):
+        """Weights with which the sky is summed over the frequencies of a
+        channel to integrate it over the bandpass, including the
+        conversion from uK_RJ to Jysr.
+
+        :param frequencies: frequencies of the channel in GHz.
+        :type frequencies: numpy.ndarray.
+        :param weights: bandpass weights of the channel.
+        :type weights: numpy.ndarray.
+        :return: numpy.ndarray -- integration weights of each frequency.
+        """
+        return bandpass_weights(frequencies, weights) * convert_units("uK_RJ", "Jysr", frequencies)
+
     def normalise_bandpass(self):
         """Function to normalise input bandpasses such that they integrate to one 
         over the stated frequency range.
@@ -387,47 +658,308 @@ class Instrument(object):
         self.Channels = [(freqs, weights / np.trapz(weights, freqs * 1.e9)) for (freqs, weights) in self.Channels]
         return 
             
-    def smoother(self, map_array):
+    def smoother(self, map_array, beams = None, nsides = None):
         """Function to smooth an array of N (T, Q, U) maps with N beams in
-        units of arcmin.
+        units of arcmin. If `local_smoothing` is set and `pixel_indices`
+        is not None, the maps are smoothed over their pixels only, see
+        :meth:`pysm.pysm.Instrument.local_smoother`.
 
         :param map_array:
         :type map_array:
+        :param beams: beams with which to smooth the maps, by default the beams of all the channels.
+        :type beams: numpy.ndarray.
+        :param nsides: nsides at which to smooth the maps, by default those of all the channels, see :meth:`pysm.pysm.Instrument.smoothing_nsides`.
+        :type nsides: list.
         
         """
+        if beams is None:
+            beams = self.Beams
+        if nsides is None:
+            nsides = self.smoothing_nsides()
         if not self.Use_Smoothing:
             return map_array
         elif self.Use_Smoothing:
-            if self.pixel_indices is None:
-                full_map = map_array
-            else:
-                full_map = build_full_map(self.pixel_indices, map_array, self.Nside)
-            smoothed_map_array = np.array([hp.smoothing(m, fwhm = np.pi / 180. * b / 60., verbose = False) for (m, b) in zip(full_map, self.Beams)])
-            if self.pixel_indices is None:
-                return smoothed_map_array
-            else:
-                assert smoothed_map_array.ndim == 3, \
-                    "Assuming map array is 3 dimensional (n_freqs x n_maps x n_pixels)"
-                return smoothed_map_array[..., self.pixel_indices]
+            map_array = np.asarray(map_array)
+            beams, nsides = beams[:len(map_array)], nsides[:len(map_array)]
+            pixel_indices = self.pixel_indices
+
+            def smooth_batch(batch):
+                if self.Local_Smoothing and pixel_indices is not None:
+                    return self.local_smoother(map_array[batch], beams[batch[0]])
+                if pixel_indices is None:
+                    full_map = map_array[batch]
+                else:
+                    full_map = build_full_map(pixel_indices, map_array[batch], self.Nside)
+                lmax = self.smoothing_lmax(beams[batch[0]], nsides[batch[0]])
+                alms = np.array([self.smoothing_analysis(m, nsides[batch[0]], lmax) for m in full_map])
+                smoothed = self.smoothing_synthesis(alms, beams[batch[0]])
+                smoothed[hp.mask_bad(full_map)] = hp.UNSEEN
+                return smoothed if pixel_indices is None else smoothed[..., pixel_indices]
+
+            smoothed_map_array = np.empty(map_array.shape)
+            batches = self.smoothing_batches(beams, nsides)
+            for batch, smoothed in zip(batches, self.map_smoothing_batches(smooth_batch, batches)):
+                smoothed_map_array[batch] = smoothed
+            return smoothed_map_array
         else:
             print("Please set 'Use_Smoothing' in Instrument object.")
             sys.exit(1)
 
-    def noiser(self):
+    def local_smoother(self, maps, beam):
+        """Smooth maps defined on `pixel_indices` with a beam by a
+        convolution over the neighbouring pixels, see
+        :func:`pysm.common.convolution_matrices`, with the kernel
+        `Smoothing_Kernel` truncated at `Smoothing_Kernel_Radius` times
+        the beam FWHM. The cost scales with the number of pixels times
+        the area of the kernel, rather than with the full sky.
+
+        Pixels outside `pixel_indices` or UNSEEN are left out of the
+        average, and UNSEEN pixels stay UNSEEN.
+
+        :param maps: maps to smooth, shape (N, 3, Npix).
+        :type maps: numpy.ndarray.
+        :param beam: FWHM of the beam in arcmin.
+        :type beam: float.
+        :return: numpy.ndarray -- smoothed maps, shape (N, 3, Npix).
+        """
+        if beam <= 0:
+            return np.array(maps, dtype = np.float64)
+        fwhm = np.pi / 180. * beam / 60.
+        T, P = convolution_matrices(self.Nside, self.pixel_indices, fwhm, self.Smoothing_Kernel_Radius * fwhm, self.Smoothing_Kernel)
+        good = ~hp.mask_bad(maps)
+        values = np.where(good, maps, 0.)
+        smoothed = np.empty(maps.shape)
+        smoothed[:, 0] = T.dot(values[:, 0].T).T
+        polarization = P.dot((values[:, 1] + 1j * values[:, 2]).T).T
+        smoothed[:, 1], smoothed[:, 2] = polarization.real, polarization.imag
+        if not good.all():
+            good[:, 1:] &= good[:, 1:2] & good[:, 2:3]
+            weights = T.dot(good.reshape(-1, maps.shape[-1]).T.astype(np.float64)).T.reshape(maps.shape)
+            smoothed[weights > 0] /= weights[weights > 0]
+            smoothed[~good | (weights <= 0)] = hp.UNSEEN
+        return smoothed
+
+    def smoothing_batches(self, beams, nsides):
+        """Group the channels that share a beam and a smoothing nside in
+        batches, which are smoothed together: the beam is applied to the
+        alms of all the channels of a batch at once. The batches have at
+        most `Smoothing_Max_Maps` // `Smoothing_Threads` channels, so that
+        the threads of :meth:`pysm.pysm.Instrument.map_smoothing_batches`
+        hold at most `Smoothing_Max_Maps` full sky maps.
+
+        :param beams: FWHM of the beams of the channels in arcmin.
+        :type beams: numpy.ndarray.
+        :param nsides: smoothing nsides of the channels.
+        :type nsides: list.
+        :return: list -- lists of the indices of the channels of each batch,
+         in the order of their first channel.
+        """
+        threads = self.smoothing_threads()
+        if self.Smoothing_Max_Maps is None:
+            size = 1
+        else:
+            size = max(1, self.Smoothing_Max_Maps // threads)
+        # ordered by the first channel of each group.
+        groups = collections.OrderedDict()
+        for c, key in enumerate(zip(beams, nsides)):
+            groups.setdefault(key, []).append(c)
+        return [group[start : start + size] for group in groups.values() for start in range(0, len(group), size)]
+
+    def smoothing_threads(self):
+        """Returns the number of threads over which the channels are
+        smoothed: `Smoothing_Threads`, but no more than
+        `Smoothing_Max_Maps`.
+
+        :return: int -- number of threads.
+        """
+        threads = max(1, self.Smoothing_Threads)
+        if self.Smoothing_Max_Maps is not None:
+            threads = max(1, min(threads, self.Smoothing_Max_Maps))
+        return threads
+
+    def map_smoothing_batches(self, function, batches):
+        """Evaluate function on each batch of channels, over
+        `Smoothing_Threads` threads. The spherical harmonic transforms
+        of healpy release the GIL, so the batches are smoothed
+        concurrently.
+
+        :param function: function of the list of the indices of the channels of a batch.
+        :type function: function.
+        :param batches: batches of channels, see :meth:`pysm.pysm.Instrument.smoothing_batches`.
+        :type batches: list.
+        :return: list -- values of the function on each batch.
+        """
+        threads = min(self.smoothing_threads(), len(batches))
+        if threads <= 1:
+            return [function(batch) for batch in batches]
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(function, batches)
+        finally:
+            pool.close()
+            pool.join()
+
+    def smoothing_nsides(self):
+        """Returns the nside at which each channel is smoothed,
+        `Smoothing_Nsides` if set, otherwise the nside of the instrument.
+
+        :return: list -- nsides of the channels.
+        """
+        if self.Smoothing_Nsides is None:
+            return [self.Nside] * len(self.Beams)
+        return list(self.Smoothing_Nsides)
+
+    def smoothing_lmax(self, beam, nside):
+        """Returns the maximum multipole of the smoothing of a map at the
+        given nside with a Gaussian beam: 3 * nside - 1, or, if
+        `Smoothing_Tolerance` is set, the multipole beyond which the beam
+        transfer function is below the tolerance, if lower.
+
+        :param beam: FWHM of the beam in arcmin.
+        :type beam: float.
+        :param nside: nside at which the map is smoothed.
+        :type nside: int.
+        :return: int -- maximum multipole.
+        """
+        lmax = 3 * nside - 1
+        if self.Smoothing_Tolerance is not None and beam > 0:
+            sigma = np.pi / 180. * beam / 60. / np.sqrt(8. * np.log(2.))
+            # the beam exp(-l (l + 1) sigma^2 / 2) is below the tolerance beyond this multipole.
+            lmax = min(lmax, int(np.ceil(np.sqrt(-2. * np.log(self.Smoothing_Tolerance)) / sigma)))
+        return lmax
+
+    def smoothing_analysis(self, maps, nside, lmax):
+        """Transform full sky (T, Q, U) maps at the nside of the instrument
+        to alms for smoothing, after degrading them to the given nside,
+        with `Smoothing_Iter` iterations and, if `Smoothing_Pixel_Weights`
+        is set, pixel weights.
+
+        :param maps: maps to transform, shape (3, Npix).
+        :type maps: numpy.ndarray.
+        :param nside: nside at which to transform the maps.
+        :type nside: int.
+        :param lmax: maximum multipole of the alms.
+        :type lmax: int.
+        :return: numpy.ndarray -- T, E, and B alms.
+        """
+        if nside != self.Nside:
+            maps = hp.ud_grade(maps, nside_out = nside)
+        return np.array(hp.map2alm(maps, lmax = lmax, iter = self.Smoothing_Iter, pol = True, use_pixel_weights = self.Smoothing_Pixel_Weights))
+
+    def smoothing_synthesis(self, alms, beam):
+        """Smooth the T, E, and B alms of one or several maps with a
+        Gaussian beam and transform them to (T, Q, U) maps at the nside
+        of the instrument.
+
+        :param alms: alms to smooth, shape (3, Nalm) or (N, 3, Nalm), modified in place.
+        :type alms: numpy.ndarray.
+        :param beam: FWHM of the beam in arcmin.
+        :type beam: float.
+        :return: numpy.ndarray -- smoothed maps, shape (3, Npix) or (N, 3, Npix).
+        """
+        lmax = hp.Alm.getlmax(alms.shape[-1])
+        # the transfer functions of hp.smoothalm, applied to all the maps at once.
+        sigma = np.pi / 180. * beam / 60. / (2. * np.sqrt(2. * np.log(2.)))
+        ell = np.arange(lmax + 1.)
+        transfer = np.exp(-0.5 * (ell * (ell + 1) - np.array([0, 4, 4])[:, None]) * sigma ** 2)
+        alms *= transfer[:, hp.Alm.getlm(lmax)[0]]
+        if alms.ndim == 2:
+            return hp.alm2map(alms, self.Nside, lmax = lmax, pixwin = False, pol = True)
+        return np.array([hp.alm2map(a, self.Nside, lmax = lmax, pixwin = False, pol = True) for a in alms])
+
+    def smoothed_signal(self, Sky):
+        """Evaluate the signal of Sky in each channel and smooth it with
+        the channel beam, as :meth:`pysm.pysm.Instrument.apply_bandpass`
+        followed by :meth:`pysm.pysm.Instrument.smoother`.
+
+        The smoothing is linear, so the populations of Sky with separable
+        emission, see :meth:`pysm.pysm.Sky.separable_populations`, are
+        smoothed in harmonic space: their templates are transformed to
+        alms once, and the alms of each channel are the sum of these,
+        scaled by the SED of the population in the channel, to which
+        the alms of the other populations are added. Only the other
+        populations are evaluated as maps and transformed in each
+        channel, and each channel then takes a single transform back to
+        a map. With `local_smoothing` on a partial sky the maps are
+        smoothed directly, see :meth:`pysm.pysm.Instrument.local_smoother`.
+
+        :param Sky: instance of the :class:`pysm.pysm.Sky` class.
+        :type Sky: class
+        :return: smoothed maps, shape (N_channels, 3, Npix) -- numpy.ndarray.
+        """
+        if self.Local_Smoothing and self.pixel_indices is not None:
+            return self.smoother(self.apply_bandpass(Sky.signal(), Sky))
+        separable = Sky.separable_populations(use_bandpass = self.Use_Bandpass)
+        if self.Use_Bandpass:
+            seds = [np.array([np.dot(self.integration_weights(f, w), population.sed(f)) for (f, w) in self.Channels]) for population in separable]
+        else:
+            seds = [population.sed(np.asarray(self.Frequencies, dtype = np.float64)).reshape(-1, 3) for population in separable]
+        # E and B are only scaled as a whole if Q and U are.
+        scaled = [np.array_equal(sed[:, 1], sed[:, 2]) for sed in seds]
+        separable = [population for population, s in zip(separable, scaled) if s]
+        seds = [sed for sed, s in zip(seds, scaled) if s]
+        if not separable:
+            return self.smoother(self.apply_bandpass(Sky.signal(), Sky))
+
+        pixel_indices = self.pixel_indices
+        full_map = lambda maps: maps if pixel_indices is None else build_full_map(pixel_indices, maps, self.Nside)
+        npix = hp.nside2npix(self.Nside) if pixel_indices is None else len(pixel_indices)
+        nsides = self.smoothing_nsides()
+        lmaxs = [self.smoothing_lmax(beam, nside) for beam, nside in zip(self.Beams, nsides)]
+        # the templates are transformed once, to the highest multipole of all the channels.
+        template_lmax = max(lmaxs)
+        template_alms = [self.smoothing_analysis(full_map(np.array([np.broadcast_to(t, (npix,)) for t in population.templates], dtype = np.float64)), self.Nside, template_lmax) for population in separable]
+        if len(separable) < len(Sky.populations()):
+            others = self.apply_bandpass(Sky.signal(exclude = separable), Sky, exclude = separable)
+        else:
+            others = None
+
+        def smooth_batch(batch):
+            beam, nside, lmax = self.Beams[batch[0]], nsides[batch[0]], lmaxs[batch[0]]
+            alms = np.zeros((len(batch), 3, hp.Alm.getsize(lmax)), dtype = np.complex128)
+            for i, c in enumerate(batch):
+                if others is not None:
+                    alms[i] = self.smoothing_analysis(full_map(others[c]), nside, lmax)
+                for alm, sed in zip(template_alms, seds):
+                    alms[i] += sed[c, [0, 1, 1], None] * np.array([hp.resize_alm(a, template_lmax, template_lmax, lmax, lmax) for a in alm])
+            smoothed_maps = self.smoothing_synthesis(alms, beam)
+            return smoothed_maps if pixel_indices is None else smoothed_maps[..., pixel_indices]
+
+        smoothed = np.zeros((len(self.Beams), 3, npix))
+        batches = self.smoothing_batches(self.Beams, nsides)
+        for batch, smoothed_maps in zip(batches, self.map_smoothing_batches(smooth_batch, batches)):
+            smoothed[batch] = smoothed_maps
+        return smoothed
+
+    def noiser(self, pixels = None, seed = None):
         """Calculate white noise maps for given sensitivities.  Returns signal
         + noise, and noise maps at the given nside in (T, Q, U). Input
         sensitivities are expected to be in uK_CMB amin for the rest of
         PySM.
 
+        The noise of each channel, Stokes parameter and HEALPix pixel
+        only depends on the seed, see :func:`pysm.pysm.noise_realization`,
+        so that it is the same in full sky and partial sky runs, and
+        whichever subset of the pixels is drawn. If neither `seed` nor
+        `Noise_Seed` is set, a random seed is used.
+
         :param map_array: array of maps to which we add noise. 
         :type map_array: numpy.ndarray.
+        :param pixels: if given, the subset of the pixels for which to draw noise.
+        :type pixels: slice, numpy.ndarray.
+        :param seed: seed to use instead of the Noise_Seed attribute.
+        :type seed: int.
         :return: map plus noise, and noise -- numpy.ndarray
 
         """
-        try:
-            npix = len(self.pixel_indices)
-        except TypeError:
-            npix = hp.nside2npix(self.Nside)
+        pixel_indices = self.pixel_indices
+        if pixel_indices is None:
+            healpix_pixels = np.arange(hp.nside2npix(self.Nside))
+        else:
+            healpix_pixels = np.asarray(pixel_indices)
+        if pixels is not None:
+            healpix_pixels = healpix_pixels[pixels]
+        npix = len(healpix_pixels)
 
         if not self.Add_Noise:
             return np.zeros((len(self.Sens_I), 3, npix))
@@ -438,8 +970,11 @@ class Instrument(object):
             equal to the number of input maps."""
             sigma_pix_I = np.sqrt(self.Sens_I ** 2 / pix_amin2)
             sigma_pix_P = np.sqrt(self.Sens_P ** 2 / pix_amin2)
-            np.random.seed(seed = self.Noise_Seed)
-            noise = np.random.randn(len(self.Sens_I), 3, npix)
+            if seed is None:
+                seed = self.Noise_Seed
+            if seed is None:
+                seed = random_noise_seed()
+            noise = noise_realization(seed, len(self.Sens_I), healpix_pixels)
             noise[:, 0, :] *= sigma_pix_I[:, None]
             noise[:, 1, :] *= sigma_pix_P[:, None]
             noise[:, 2, :] *= sigma_pix_P[:, None]
@@ -461,6 +996,16 @@ class Instrument(object):
         :type noise: numpy.ndarray
         :return: signal + noise map converted to output units, noise map converted to output units -- numpy.ndarray
         """
+        Uc_signal, Uc_noise = self.unit_conversion_factors()
+        return Uc_signal[:, None, None] * map_array, Uc_noise[:, None, None] * noise
+
+    def unit_conversion_factors(self):
+        """Function to calculate the factors converting the signal and the
+        noise of each channel to the output units, see
+        :meth:`pysm.pysm.Instrument.unit_converter`.
+
+        :return: signal and noise unit conversion factors, shape (N_channels,) -- numpy.ndarray
+        """
         if not self.Use_Bandpass:
             #If using a delta bandpass just evaluate the standard unit conversion at
             #the frequencies of interest. All the scaling is done in uK_RJ.
@@ -478,7 +1023,7 @@ class Instrument(object):
                 Uc_noise = Uc_signal * np.array([1. / bandpass_convert_units("uK_CMB", channel) for channel in self.Channels])
         elif not self.Add_Noise:
             Uc_noise = np.zeros_like(Uc_signal)
-        return Uc_signal[:, None, None] * map_array, Uc_noise[:, None, None] * noise
+        return Uc_signal, Uc_noise
             
     def file_path(self, channel_name = None, f = None, extra_info = ""):
         """Returns file path for pysm outputs.
@@ -534,12 +1079,108 @@ class Instrument(object):
                 print("%s | %05.2f | %05.2f | %05.2f "%(cn, s_I, s_P, b)) 
         return
     
+NOISE_BLOCK = 2 ** 14
+
+COUNTER_BASED_RNG = hasattr(np.random, "SeedSequence")
+"""Whether numpy (>= 1.17) provides the counter-based Philox generator
+used to draw the noise. Older versions fall back to the legacy
+Mersenne Twister, which gives different realizations for the same
+seed."""
+
+def random_noise_seed():
+    """Draw a seed for the noise when none is given.
+
+    :return: int -- a random seed.
+    """
+    if COUNTER_BASED_RNG:
+        return np.random.SeedSequence().entropy
+    return np.random.randint(2 ** 32)
+
+def noise_stream(seed, channel, stokes, block):
+    """Random generator of the noise of a channel, Stokes parameter
+    and block of pixels.
+
+    With numpy >= 1.17 this is a counter-based Philox stream keyed by a
+    SeedSequence with spawn key (channel, stokes, block). Otherwise it is
+    a legacy RandomState seeded with (seed, channel, stokes, block), for
+    which the seed must be smaller than 2 ** 32.
+
+    :param seed: seed of the realization.
+    :type seed: int.
+    :param channel: index of the channel.
+    :type channel: int.
+    :param stokes: index of the Stokes parameter.
+    :type stokes: int.
+    :param block: index of the block of `NOISE_BLOCK` pixels.
+    :type block: int.
+    :return: numpy.random.Generator or numpy.random.RandomState.
+    """
+    if COUNTER_BASED_RNG:
+        return np.random.Generator(np.random.Philox(np.random.SeedSequence(seed, spawn_key = (channel, stokes, block))))
+    return np.random.RandomState([seed, channel, stokes, block])
+
+def noise_realization(seed, nchannels, pixels):
+    """Draw standard normal white noise in (T, Q, U) for a number of
+    channels on a set of HEALPix pixels.
+
+    The pixels are split in blocks of `NOISE_BLOCK`, and the noise of
+    each channel, Stokes parameter and block is drawn from its own
+    stream, keyed by these and by the seed, see
+    :func:`pysm.pysm.noise_stream`. The
+    noise of a pixel therefore does not depend on which other pixels
+    are drawn, so that any chunk or subset of the sky, e.g. on
+    different processes, can be drawn independently and gives the same
+    noise as the full sky.
+
+    :param seed: seed of the realization.
+    :type seed: int.
+    :param nchannels: number of channels.
+    :type nchannels: int.
+    :param pixels: HEALPix pixels for which to draw noise.
+    :type pixels: numpy.ndarray.
+    :return: numpy.ndarray -- noise, shape (nchannels, 3, len(pixels)).
+    """
+    pixels = np.asarray(pixels, dtype = np.int64)
+    blocks, offsets = np.divmod(pixels, NOISE_BLOCK)
+    order = np.argsort(blocks, kind = "stable")
+    unique_blocks, starts = np.unique(blocks[order], return_index = True)
+    ends = np.append(starts[1:], len(pixels))
+    noise = np.empty((nchannels, 3, len(pixels)))
+    for block, start, end in zip(unique_blocks, starts, ends):
+        indices = order[start:end]
+        # the first draws of a stream do not depend on how many are drawn.
+        size = offsets[indices].max() + 1
+        for channel in range(nchannels):
+            for stokes in range(3):
+                stream = noise_stream(seed, channel, stokes, int(block))
+                noise[channel, stokes, indices] = stream.standard_normal(size)[offsets[indices]]
+    return noise
+
 def bandpass(frequencies, weights, signal):
     """Function to integrate signal over a bandpass.
 
     Frequencies must be evenly spaced, if they are not the function
     will object. Weights must be able to be normalised to integrate to 1.
 
+    """
+    # define the integration: integrand = signal(nu) * w(nu) * d(nu)
+    # signal is already in MJysr.
+    integration_weights = bandpass_weights(frequencies, weights)
+    return sum([signal(nu) * w for (nu, w) in zip(frequencies, integration_weights)])
+
+def bandpass_weights(frequencies, weights):
+    """Function to calculate the weights w(nu) * d(nu) with which to sum
+    a signal over a bandpass.
+
+    Frequencies must be evenly spaced, if they are not the function
+    will object. Weights are normalised in place to integrate to 1.
+
+    :param frequencies: frequencies of the bandpass in GHz.
+    :type frequencies: numpy.ndarray.
+    :param weights: bandpass weights.
+    :type weights: numpy.ndarray.
+    :return: numpy.ndarray -- integration weights of each frequency.
+
     """
     # check that the frequencies are evenly spaced.
     check_bpass_frequencies(frequencies)
@@ -547,9 +1188,7 @@ def bandpass(frequencies, weights, signal):
     # normalise the weights and check that they integrate to 1.
     weights /= np.sum(weights * frequency_separation)
     check_bpass_weights_normalisation(weights, frequency_separation)
-    # define the integration: integrand = signal(nu) * w(nu) * d(nu)
-    # signal is already in MJysr.
-    return sum([signal(nu) * w * frequency_separation for (nu, w) in zip(frequencies, weights)])
+    return weights * frequency_separation
 
 
 def check_bpass_weights_normalisation(weights, spacing):
@@ -597,13 +1236,16 @@ def component_adder(component_class, dictionary_list, **kwargs):
     population_signals = [component_class(dic).signal(**kwargs) for dic in dictionary_list]
     # sigs is now a list of functions. Each function is the emission
     # due to a population of the component.
-    def total_signal(nu, **kwargs):
-        total_component_signal = 0
+    def total_signal(nu, out = None, **kwargs):
         # now sum up the contributions of each population at
-        # frequency nu. 
+        # frequency nu. The first population allocates the output,
+        # and the others add to it in place.
         for population_signal in population_signals:
-            total_component_signal += population_signal(nu, **kwargs)
-        return total_component_signal
+            out = add_population(population_signal, nu, out = out, **kwargs)
+        return out
+    # the populations are kept so that they can be evaluated separately,
+    # see Sky.populations.
+    total_signal.populations = population_signals
     # return the total contribution from all populations
     # as a function of frequency nu. 
     return total_signal
@@ -618,76 +1260,99 @@ def initialise_hd_dust_model_bandpass(hd_unint_signal, mpi_comm, **kwargs):
     :type hd_unint_signal: function
 
     """
-    #Draw map of uval using Commander dust data.
-    uval = Dust.draw_uval(kwargs['draw_uval_seed'], kwargs['nside'], mpi_comm)
-
-    if "pixel_indices" in kwargs and kwargs["pixel_indices"] is not None:
-        uval = uval[kwargs["pixel_indices"]]
+    #Draw map of uval using Commander dust data, at the resolution of these data if the
+    #sky is at a higher one, and find the value in each pixel of the templates.
+    uval = Dust.draw_uval(kwargs['draw_uval_seed'], min(kwargs['nside'], 256), mpi_comm)
+    uval_index = Dust.uval_index(len(uval), kwargs['nside'], kwargs.get('pixel_indices'))[:, 0]
 
     #Read in the precomputed dust emission spectra as a function of lambda and U.
-    data_sil, data_silfe, data_car, wav, uvec = Dust.read_hd_data()
+    hd_data = Dust.read_hd_data(mpi_comm = mpi_comm)
 
-    c = 2.99792458e10
     fcar = kwargs['fcar']
     f_fe = kwargs['f_fe']
 
-    #Interpolate the dust emission properties in uval and freuency, this is necessary to compute the factor to
-    #rescale the dust emission templates to the new model.
-    sil_i = interpolate.RectBivariateSpline(uvec,wav,(data_sil[:,3:84]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
-    car_i = interpolate.RectBivariateSpline(uvec,wav,(data_car[:,3:84]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
-    silfe_i = interpolate.RectBivariateSpline(uvec,wav,(data_silfe[:,3:84]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
-    
-    sil_p = interpolate.RectBivariateSpline(uvec,wav,(data_sil[:,84:165]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
-    car_p = interpolate.RectBivariateSpline(uvec,wav,(data_car[:,84:165]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
-    silfe_p = interpolate.RectBivariateSpline(uvec,wav,(data_silfe[:,84:165]*(wav[:,np.newaxis]*1.e-4/c)*1.e23).T) # to Jy/sr/H
+    #Compute the factor to rescale the dust emission templates to the new model.
+    emission_I, emission_P = Dust.hd_emission(fcar, f_fe, mpi_comm = mpi_comm)
+    A_I = kwargs['A_I'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_I']) / emission_I(np.array([kwargs['nu_0_I']]), uval)[0][uval_index]
+    A_Q = kwargs['A_Q'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_P']) / emission_P(np.array([kwargs['nu_0_P']]), uval)[0][uval_index]
+    A_U = kwargs['A_U'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_P']) / emission_P(np.array([kwargs['nu_0_P']]), uval)[0][uval_index]
+    uval = uval[uval_index]
 
-    nu_to_lambda = lambda x: 1.e-3 * constants.c / x #Note this is in SI units.
-    non_int_model_i = lambda nu: (1. - f_fe) * sil_i.ev(uval, nu_to_lambda(nu)) + fcar * car_i.ev(uval, nu_to_lambda(nu)) + f_fe * silfe_i.ev(uval, nu_to_lambda(nu))
-    non_int_model_p = lambda nu: (1. - f_fe) * sil_p.ev(uval, nu_to_lambda(nu)) + fcar * car_p.ev(uval, nu_to_lambda(nu)) + f_fe * silfe_p.ev(uval, nu_to_lambda(nu)) 
-        
-    A_I = kwargs['A_I'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_I']) / non_int_model_i(kwargs['nu_0_I'])
-    A_Q = kwargs['A_Q'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_P']) / non_int_model_p(kwargs['nu_0_P'])
-    A_U = kwargs['A_U'] * convert_units("uK_RJ", "Jysr", kwargs['nu_0_P']) / non_int_model_p(kwargs['nu_0_P'])
-    
-    def bpass_model(channel):
-        """Note that nu is in GHz, and so we have to multipl by 1.e9 in the following functions.
+    def bpass_model(channel, pixels = None):
+        """If pixels is given, only that subset of the pixels is computed.
         """
-        (nu, t_nu) = channel
-                
-        # Integrate table over bandpass.
-        sil_i_vec = np.zeros(len(uvec))
-        car_i_vec = np.zeros(len(uvec))
-        silfe_i_vec = np.zeros(len(uvec))
-        sil_p_vec = np.zeros(len(uvec))
-        car_p_vec = np.zeros(len(uvec))
-        silfe_p_vec = np.zeros(len(uvec))
-        for i in range(len(uvec)):
-            # Note: Table in terms of wavelength in um, increasing
-            #       and lambda*I_lambda. Thus we reverse the order
-            #       to nu increasing before interpolating to the
-            #       bandpass frequencies, then divide by nu to get
-            #       I_nu.
-            sil_i_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_sil[::-1,3+i]*1.e23)/nu*1.e-9, nu*1.e9)
-            car_i_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_car[::-1,3+i]*1.e23)/nu*1.e-9, nu*1.e9)
-            silfe_i_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_silfe[::-1,3+i]*1.e23)/nu*1.e-9, nu*1.e9)
-        
-            sil_p_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_sil[::-1,84+i]*1.e23)/nu*1.e-9, nu*1.e9)
-            car_p_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_car[::-1,84+i]*1.e23)/nu*1.e-9, nu*1.e9)
-            silfe_p_vec[i] = np.trapz(t_nu*np.interp(nu*1.e9,c/(wav[::-1]*1.e-4),data_silfe[::-1,84+i]*1.e23)/nu*1.e-9, nu*1.e9)
-
-        # Step 2: Interpolate over U values
-        sil_i = interpolate.interp1d(uvec, sil_i_vec)
-        car_i = interpolate.interp1d(uvec, car_i_vec)
-        silfe_i = interpolate.interp1d(uvec, silfe_i_vec)
-        
-        sil_p = interpolate.interp1d(uvec, sil_p_vec)
-        car_p = interpolate.interp1d(uvec, car_p_vec)
-        silfe_p = interpolate.interp1d(uvec, silfe_p_vec)
-
-        #We now compute the final scaling. The integrated quantities sil_i,
-        #car_i silfe_i etc.. are in Jy/sr. Therefore we want to convert the
-        #templates from uK_RJ to Jy/sr.
-        scaling_I = ((1. - f_fe) * sil_i(uval) + fcar * car_i(uval) + f_fe * silfe_i(uval))
-        scaling_P = ((1. - f_fe) * sil_p(uval) + fcar * car_p(uval) + f_fe * silfe_p(uval))
-        return np.array([scaling_I * A_I, scaling_P * A_Q, scaling_P * A_U])
+        uvec, table_I, table_P = hd_bandpass_tables(channel, fcar, f_fe, hd_data)
+
+        #We now compute the final scaling, interpolating the integrated tables linearly in U. The
+        #integrated quantities are in Jy/sr. Therefore we want to convert the templates from uK_RJ
+        #to Jy/sr.
+        uval_pixels = pixel_subset(uval, pixels)
+        scaling_I = np.interp(uval_pixels, uvec, table_I)
+        scaling_P = np.interp(uval_pixels, uvec, table_P)
+        return np.array([scaling_I * pixel_subset(A_I, pixels), scaling_P * pixel_subset(A_Q, pixels), scaling_P * pixel_subset(A_U, pixels)])
     return bpass_model
+
+"""Bandpass integrated tables of the Hensley-Draine 2017 model, by
+channel and grain composition, see :func:`hd_bandpass_tables`."""
+_hd_bandpass_tables = {}
+
+def hd_bandpass_tables(channel, fcar, f_fe, hd_data):
+    """Function to integrate the emission tables of the Hensley-Draine
+    2017 model over a bandpass, for all the values of U in the tables.
+
+    The tables are interpolated linearly to the bandpass frequencies
+    and integrated with the trapezoidal rule, which for all the values
+    of U at once is a single matrix product. The result is memoized by
+    channel and grain composition, so that a channel is only integrated
+    once per process.
+
+    :param channel: frequencies in GHz and weights of the bandpass.
+    :type channel: tuple(numpy.ndarray, numpy.ndarray)
+    :param fcar: mass fraction of carbonaceous grains relative to silicate grains.
+    :type fcar: float.
+    :param f_fe: fraction of silicate grains with iron inclusions.
+    :type f_fe: float.
+    :param hd_data: emission tables, as returned by :meth:`pysm.components.Dust.read_hd_data`.
+    :type hd_data: tuple
+    :return: tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray) -- values of U, and integrated intensity and polarisation emission in Jysr.
+
+    """
+    (nu, t_nu) = channel
+    nu = np.asarray(nu, dtype = np.float64)
+    t_nu = np.asarray(t_nu, dtype = np.float64)
+    key = (nu.tobytes(), t_nu.tobytes(), fcar, f_fe)
+    try:
+        return _hd_bandpass_tables[key]
+    except KeyError:
+        pass
+
+    data_sil, data_silfe, data_car, wav, uvec = hd_data
+
+    # Note: Table in terms of wavelength in um, increasing
+    #       and lambda*I_lambda. Thus we reverse the order
+    #       to nu increasing before interpolating to the
+    #       bandpass frequencies, then divide by nu to get
+    #       I_nu. nu is in GHz, and so we have to multiply
+    #       by 1.e9.
+    c = 2.99792458e10
+    x = nu * 1.e9
+    x_table = c / (wav[::-1] * 1.e-4)
+
+    # matrix of the linear interpolation from the table frequencies to
+    # the bandpass frequencies, constant beyond the ends as np.interp.
+    lower = np.clip(np.searchsorted(x_table, x, side = 'right') - 1, 0, len(x_table) - 2)
+    fraction = np.clip((x - x_table[lower]) / (x_table[lower + 1] - x_table[lower]), 0., 1.)
+    interpolation = np.zeros((len(x), len(x_table)))
+    interpolation[np.arange(len(x)), lower] = 1. - fraction
+    interpolation[np.arange(len(x)), lower + 1] += fraction
+
+    # weights of the trapezoidal rule.
+    trapezoid = np.zeros(len(x))
+    trapezoid[:-1] += 0.5 * np.diff(x)
+    trapezoid[1:] += 0.5 * np.diff(x)
+
+    weights = (trapezoid * t_nu / nu * 1.e-9).dot(interpolation) * 1.e23
+    table = lambda columns: weights.dot((1. - f_fe) * data_sil[::-1, columns] + fcar * data_car[::-1, columns] + f_fe * data_silfe[::-1, columns])
+    tables = (uvec, table(slice(3, 84)), table(slice(84, 165)))
+    _hd_bandpass_tables[key] = tables
+    return tables
@@ -4,6 +4,9 @@ from astropy.io import fits
 import scipy.constants as constants
 from pysm import common
 import os
+import shutil
+import tempfile
+import healpy as hp
 import matplotlib.pyplot as plt
 from . import get_testdata
 
@@ -205,7 +208,253 @@ class test_Bandpass_Convert_Units(unittest.TestCase):
         np.testing.assert_almost_equal(Uc1, self.UcJysr2CMB)
         return
 
-    
+class test_Vectorized_Evaluation(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        self.A = np.random.randn(3, 100)
+        self.beta = np.random.randn(100)
+        self.freqs = np.array([10., 30., 100., 353.])
+
+        @common.FloatOrArray
+        def loop_model(nu):
+            scaling = (nu / 30.) ** self.beta
+            return np.array([self.A[0] * scaling, self.A[1] * scaling, self.A[2] * scaling])
+
+        @common.FloatOrArrayVectorized
+        def vectorized_model(nu, out=None):
+            scaling = (nu / 30.) ** self.beta
+            return common.scale_templates(self.A, (scaling, scaling, scaling), out=out)
+
+        self.loop_model = loop_model
+        self.vectorized_model = vectorized_model
+        return
+
+    def tearDown(self):
+        self.A = None
+        self.beta = None
+        return
+
+    def test_vectorized_matches_loop(self):
+        np.testing.assert_array_almost_equal(self.vectorized_model(self.freqs), self.loop_model(self.freqs))
+        self.assertEqual(self.vectorized_model(self.freqs).shape, (4, 3, 100))
+        return
+
+    def test_vectorized_float(self):
+        np.testing.assert_array_almost_equal(self.vectorized_model(30.), self.A)
+        self.assertEqual(self.vectorized_model(30.).shape, (3, 100))
+        return
+
+    def test_accumulate_out(self):
+        for model in (self.loop_model, self.vectorized_model):
+            out = np.ones((4, 3, 100))
+            result = model(self.freqs, out=out)
+            self.assertTrue(result is out)
+            np.testing.assert_array_almost_equal(out, 1. + self.loop_model(self.freqs))
+            out = np.ones((3, 100))
+            model(30., out=out)
+            np.testing.assert_array_almost_equal(out, 1. + self.A)
+        return
+
+class CacheTestCase(unittest.TestCase):
+    """Base of the tests of the caches of pysm.common: each test runs in
+    a temporary directory, with empty caches, and with the cache
+    directory in it, or no cache directory if `disk_cache` is False. The
+    cache settings are restored afterwards.
+    """
+    disk_cache = True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache') if self.disk_cache else None
+        self.previous_cache_dir = common.TEMPLATE_CACHE_DIR
+        self.previous_budget = common.TEMPLATE_MEMORY_BUDGET
+        common.TEMPLATE_CACHE_DIR = self.cache_dir
+        common.clear_template_cache()
+
+    def tearDown(self):
+        common.TEMPLATE_CACHE_DIR = self.previous_cache_dir
+        common.TEMPLATE_MEMORY_BUDGET = self.previous_budget
+        common.clear_template_cache()
+        shutil.rmtree(self.directory)
+
+    def write_template(self):
+        """Write random (T, Q, U) maps at nside 16 to a fits file."""
+        np.random.seed(1234)
+        self.fname = os.path.join(self.directory, 'template.fits')
+        self.maps = np.random.randn(3, hp.nside2npix(16))
+        hp.write_map(self.fname, self.maps, overwrite = True)
+
+class test_Template_Cache(CacheTestCase):
+    def setUp(self):
+        super(test_Template_Cache, self).setUp()
+        self.write_template()
+
+    def test_cache(self):
+        expected = hp.ud_grade(self.maps, nside_out = 8)
+        first = common.read_map(self.fname, 8, field = (0, 1, 2))
+        second = common.read_map(self.fname, 8, field = (0, 1, 2))
+        np.testing.assert_array_almost_equal(first, expected)
+        np.testing.assert_array_almost_equal(second, expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+        self.assertFalse(second.flags.writeable)
+        common.read_map(self.fname, 16, field = 0)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 4)
+
+    def test_overlapping_fields(self):
+        expected = hp.ud_grade(self.maps, nside_out = 8)
+        common.read_map(self.fname, 8, field = (0,))
+        common.clear_template_cache()
+        np.testing.assert_array_almost_equal(common.read_map(self.fname, 8, field = (1, 2)), expected[1:])
+        common.clear_template_cache()
+        np.testing.assert_array_almost_equal(common.read_map(self.fname, 8, field = (0, 1, 2)), expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_modified_file(self):
+        common.read_map(self.fname, 16, field = 0)
+        hp.write_map(self.fname, 2. * self.maps, overwrite = True)
+        stat = os.stat(self.fname)
+        os.utime(self.fname, (stat.st_atime, stat.st_mtime + 10.))
+        np.testing.assert_array_almost_equal(common.read_map(self.fname, 16, field = 0), 2. * self.maps[0])
+
+class test_Template_Memory_Cache(CacheTestCase):
+    disk_cache = False
+
+    def setUp(self):
+        super(test_Template_Memory_Cache, self).setUp()
+        self.write_template()
+        # count the reads of fits files.
+        self.reads = []
+        self.hp_read_map = hp.read_map
+        def read_map(*args, **kwargs):
+            self.reads.append(kwargs.get('field'))
+            return self.hp_read_map(*args, **kwargs)
+        hp.read_map = read_map
+
+    def tearDown(self):
+        hp.read_map = self.hp_read_map
+        super(test_Template_Memory_Cache, self).tearDown()
+
+    def test_shared_fields(self):
+        maps = common.read_map(self.fname, 16, field = (0, 1, 2))
+        np.testing.assert_array_almost_equal(maps, self.maps)
+        np.testing.assert_array_almost_equal(common.read_map(self.fname, 16, field = 1), self.maps[1])
+        np.testing.assert_array_almost_equal(common.read_map(self.fname, 16, field = (2, 0)), self.maps[[2, 0]])
+        self.assertEqual(self.reads, [(0, 1, 2)])
+        with self.assertRaises(ValueError):
+            maps[0, 0] = 0.
+        with self.assertRaises(ValueError):
+            common.read_map(self.fname, 16, field = 1)[0] = 0.
+
+    def test_invalidation(self):
+        common.read_map(self.fname, 16, field = 0)
+        common.clear_template_cache(self.fname)
+        common.read_map(self.fname, 16, field = 0)
+        self.assertEqual(len(self.reads), 2)
+
+    def test_budget(self):
+        common.TEMPLATE_MEMORY_BUDGET = self.maps[0].nbytes
+        common.read_map(self.fname, 16, field = 0)
+        common.read_map(self.fname, 16, field = 1)
+        common.read_map(self.fname, 16, field = 1)
+        common.read_map(self.fname, 16, field = 0)
+        self.assertEqual(self.reads, [(0,), (1,), (0,)])
+
+class test_Cached_Arrays(CacheTestCase):
+    def setUp(self):
+        super(test_Cached_Arrays, self).setUp()
+        self.fname = os.path.join(self.directory, 'table.txt')
+        np.savetxt(self.fname, np.arange(12.).reshape(3, 4))
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        table = np.loadtxt(self.fname)
+        return {'table' : table, 'total' : table.sum()}
+
+    def test_cache(self):
+        first = common.cached_arrays([self.fname], self.compute, 'test')
+        self.assertIs(common.cached_arrays([self.fname], self.compute, 'test'), first)
+        self.assertFalse(first['table'].flags.writeable)
+        # after clearing the memory the arrays are read from disk.
+        common.clear_template_cache(self.fname)
+        second = common.cached_arrays([self.fname], self.compute, 'test')
+        np.testing.assert_array_equal(second['table'], first['table'])
+        self.assertEqual(second['total'], 66.)
+        self.assertEqual(self.calls, 1)
+        common.cached_arrays([self.fname], self.compute, 'other')
+        self.assertEqual(self.calls, 2)
+
+    def test_modified_file(self):
+        common.cached_arrays([self.fname], self.compute, 'test')
+        np.savetxt(self.fname, np.ones((3, 4)))
+        stat = os.stat(self.fname)
+        os.utime(self.fname, (stat.st_atime, stat.st_mtime + 10.))
+        self.assertEqual(common.cached_arrays([self.fname], self.compute, 'test')['total'], 12.)
+
+class test_Cached_Realization(CacheTestCase):
+    def setUp(self):
+        super(test_Cached_Realization, self).setUp()
+        self.spectra = np.arange(12.).reshape(3, 4)
+        self.calls = 0
+
+    def compute(self, seed = 10):
+        def realization():
+            self.calls += 1
+            np.random.seed(seed)
+            return np.random.randn(3, 48)
+        return realization
+
+    def test_cache(self):
+        first = common.cached_realization('test', [16, 10, self.spectra], self.compute())
+        self.assertFalse(first.flags.writeable)
+        after_first = np.random.randn()
+        np.random.seed(1)
+        # the random state is restored both from memory and from disk.
+        second = common.cached_realization('test', [16, 10, self.spectra], self.compute())
+        self.assertEqual(np.random.randn(), after_first)
+        common.clear_template_cache()
+        third = common.cached_realization('test', [16, 10, self.spectra], self.compute())
+        self.assertIsInstance(third, np.memmap)
+        self.assertEqual(np.random.randn(), after_first)
+        np.testing.assert_array_equal(second, first)
+        np.testing.assert_array_equal(third, first)
+        self.assertEqual(self.calls, 1)
+
+    def test_parameters(self):
+        first = common.cached_realization('test', [16, 10, self.spectra], self.compute())
+        common.cached_realization('test', [16, 10, self.spectra + 1.], self.compute())
+        self.assertEqual(self.calls, 2)
+        other = common.cached_realization('test', [16, 11, self.spectra], self.compute(11))
+        self.assertEqual(self.calls, 3)
+        self.assertFalse(np.all(other == first))
+
+class test_Partial_Read(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        np.random.seed(1234)
+        self.maps = np.random.randn(3, hp.nside2npix(16))
+        self.maps[:, :100] = hp.UNSEEN
+        self.fname = os.path.join(self.directory, 'template.fits')
+        hp.write_map(self.fname, hp.reorder(self.maps, r2n = True), nest = True, overwrite = True)
+        self.pixel_indices = lambda nside: np.random.randint(0, hp.nside2npix(nside), 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resolutions(self):
+        for nside in [4, 16, 64]:
+            pixel_indices = self.pixel_indices(nside)
+            expected = hp.ud_grade(self.maps, nside_out = nside)[:, pixel_indices]
+            np.testing.assert_array_equal(common.read_map(self.fname, nside, field = (0, 1, 2), pixel_indices = pixel_indices), expected)
+            np.testing.assert_array_equal(common.read_map(self.fname, nside, field = 1, pixel_indices = pixel_indices), expected[1])
+
+    def test_single_field(self):
+        # a single field in a tuple gives a single map, as in healpy.
+        pixel_indices = self.pixel_indices(16)
+        self.assertEqual(common.read_map(self.fname, 16, field = (0,)).shape, (hp.nside2npix(16),))
+        np.testing.assert_array_equal(common.read_map(self.fname, 16, field = (0,), pixel_indices = pixel_indices), self.maps[0, pixel_indices])
+
+
 def main():
     unittest.main()
 
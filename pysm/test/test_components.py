@@ -9,6 +9,7 @@ except ImportError:
 import numpy as np, healpy as hp
 import matplotlib.pyplot as plt
 import scipy.constants as constants
+from scipy.interpolate import interp1d
 from pysm.nominal import models
 
 from . import get_testdata
@@ -28,6 +29,171 @@ class ComponentsTests(unittest.TestCase):
         pysm = components.black_body(90., 30., 100.)
         self.assertAlmostEqual(astropy, pysm)
 
+class test_Constant_Spectral_Parameters(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        npix = hp.nside2npix(8)
+        self.config = {
+            'model' : 'modified_black_body',
+            'nu_0_I' : 545.,
+            'nu_0_P' : 353.,
+            'A_I' : np.random.rand(npix),
+            'A_Q' : np.random.randn(npix),
+            'A_U' : np.random.randn(npix),
+            'spectral_index' : np.ones(npix) * 1.54,
+            'temp' : np.ones(npix) * 20.,
+            'add_decorrelation' : False,
+            'nside' : 8,
+            'pixel_indices' : None,
+            }
+        self.frequencies = np.array([100., 353., 545.])
+
+    def test_constant_map_is_separable(self):
+        model = components.Dust(self.config).signal()
+        sed = model.sed(self.frequencies)
+        self.assertEqual(sed.shape, (3, 3))
+        expected = np.array(model.templates)[np.newaxis] * sed[..., np.newaxis]
+        np.testing.assert_array_almost_equal(model(self.frequencies), expected)
+        np.testing.assert_array_almost_equal(model.sed(353.)[1:], 1.)
+
+    def test_constant_matches_float(self):
+        config = dict(self.config, spectral_index = 1.54, temp = 20.)
+        np.testing.assert_array_almost_equal(components.Dust(self.config).signal()(self.frequencies),
+                                             components.Dust(config).signal()(self.frequencies))
+
+    def test_varying_not_separable(self):
+        self.config['spectral_index'] = 1.54 + 0.1 * np.random.randn(len(self.config['A_I']))
+        self.assertFalse(hasattr(components.Dust(self.config).signal(), 'sed'))
+
+class test_Low_Rank_SED(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        npix = hp.nside2npix(8)
+        self.config = {
+            'model' : 'power_law',
+            'nu_0_I' : 0.408,
+            'nu_0_P' : 23.,
+            'A_I' : np.random.rand(npix),
+            'A_Q' : np.random.randn(npix),
+            'A_U' : np.random.randn(npix),
+            'spectral_index' : -3. + 0.2 * np.random.randn(npix),
+            }
+        self.frequencies = np.geomspace(20., 300., 25)
+
+    def test_approximation(self):
+        exact = components.Synchrotron(self.config).signal()
+        config = dict(self.config, sed_approximation_rank = 8, sed_approximation_range = (10., 400.))
+        approximate = components.Synchrotron(config).signal()
+        np.testing.assert_allclose(approximate(self.frequencies), exact(self.frequencies), rtol = 1e-4)
+        weights = np.linspace(1., 2., len(self.frequencies))
+        np.testing.assert_allclose(approximate(self.frequencies, weights = weights), exact(self.frequencies, weights = weights), rtol = 1e-4)
+        # outside of the approximated range the exact SED is used.
+        np.testing.assert_array_equal(approximate(500.), exact(500.))
+
+    def test_max_relative_error(self):
+        frequencies = np.geomspace(10., 400., 200)
+        exact = components.Synchrotron(self.config).signal()(frequencies)
+        for rank in (5, 8):
+            config = dict(self.config, sed_approximation_rank = rank, sed_approximation_range = (10., 400.))
+            approximate = components.Synchrotron(config).signal()
+            error = np.max(np.abs(approximate(frequencies) - exact) / np.abs(exact))
+            # the error is estimated between the frequencies sampled by the approximation.
+            self.assertTrue(0.5 * error < approximate.max_relative_error < 2. * error)
+
+class test_Hensley_Draine_2017_Resolution(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        self.config = lambda nside, uval: {
+            'model' : 'hensley_draine_2017',
+            'draw_uval' : False,
+            'uval' : uval,
+            'fcar' : 1.,
+            'f_fe' : 0.44,
+            'nu_0_I' : 545.,
+            'nu_0_P' : 353.,
+            'A_I' : np.ones(hp.nside2npix(nside)),
+            'A_Q' : np.ones(hp.nside2npix(nside)),
+            'A_U' : np.ones(hp.nside2npix(nside)),
+            'add_decorrelation' : False,
+            'nside' : nside,
+            'pixel_indices' : None,
+            }
+        self.uval = np.random.uniform(-1., 2., hp.nside2npix(16))
+        self.frequencies = np.array([5., 100., 857.])
+
+    def test_lower_resolution_uval(self):
+        signal = components.Dust(self.config(32, self.uval)).signal()
+        upgraded = components.Dust(self.config(32, hp.ud_grade(self.uval, 32))).signal()
+        np.testing.assert_array_almost_equal(signal(self.frequencies), upgraded(self.frequencies))
+
+    def test_higher_resolution_uval(self):
+        signal = components.Dust(self.config(8, self.uval)).signal()
+        native = components.Dust(self.config(16, self.uval)).signal()
+        degraded = hp.ud_grade(native(self.frequencies).reshape(9, -1), 8).reshape(3, 3, -1)
+        np.testing.assert_array_almost_equal(signal(self.frequencies), degraded)
+
+    def test_uval_index(self):
+        np.testing.assert_array_equal(components.Dust.uval_index(hp.nside2npix(4), 8)[:, 0], hp.ud_grade(np.arange(hp.nside2npix(4), dtype = np.float64), 8))
+        index = components.Dust.uval_index(hp.nside2npix(8), 4, pixel_indices = np.array([3, 7]))
+        self.assertEqual(index.shape, (2, 4))
+        np.testing.assert_array_equal(hp.ud_grade(np.arange(hp.nside2npix(8), dtype = np.float64), 4)[[3, 7]], index.mean(axis = 1))
+
+    def test_constant_uval_is_separable(self):
+        signal = components.Dust(self.config(8, 0.2)).signal()
+        constant_map = components.Dust(self.config(8, np.ones(hp.nside2npix(8)) * 0.2)).signal()
+        self.assertTrue(hasattr(signal, 'sed'))
+        np.testing.assert_array_almost_equal(signal(self.frequencies), constant_map(self.frequencies))
+
+class test_Decorrelation_Matrices(unittest.TestCase):
+    def setUp(self):
+        self.frequencies = np.array([30., 100., 352., 857.])
+
+    def test_memoized(self):
+        matrices = components.get_decorrelation_matrices(self.frequencies, 353., 1.)
+        self.assertIs(components.get_decorrelation_matrices(self.frequencies.copy(), 353., 1.), matrices)
+        self.assertFalse(matrices[0].flags.writeable)
+        expected = components.compute_decorrelation_matrices(self.frequencies, 353., 1.)
+        np.testing.assert_array_equal(matrices[0], expected[0])
+        np.testing.assert_array_equal(matrices[1], expected[1])
+
+    def test_weighted_signal(self):
+        npix = hp.nside2npix(8)
+        np.random.seed(1234)
+        config = {
+            'model' : 'modified_black_body',
+            'nu_0_I' : 545.,
+            'nu_0_P' : 353.,
+            'A_I' : np.random.rand(npix),
+            'A_Q' : np.random.randn(npix),
+            'A_U' : np.random.randn(npix),
+            'spectral_index' : 1.54,
+            'temp' : 20.,
+            'add_decorrelation' : True,
+            'corr_len' : 1.,
+            'nside' : 8,
+            'pixel_indices' : None,
+            }
+        signal = components.Dust(config).signal()
+        frequencies = np.linspace(340., 360., 21)
+        weights = np.linspace(1., 2., len(frequencies))
+        np.random.seed(1)
+        expected = np.sum(signal(frequencies) * weights[:, None, None], axis = 0)
+        np.random.seed(1)
+        np.testing.assert_array_almost_equal(signal(frequencies, weights = weights), expected)
+
+    def test_full_sky(self):
+        # a legacy model keeps its full_sky mark when decorrelated.
+        config = components.Dust({'add_decorrelation' : True, 'corr_len' : 1.})
+        legacy = components.Add_Decorrelation(config)(common.FloatOrArray(lambda nu: np.ones((3, 12))))
+        self.assertTrue(legacy.full_sky)
+        vectorized = components.Add_Decorrelation(config)(common.FloatOrArrayVectorized(lambda nu, out = None: np.ones((len(nu), 3, 12))))
+        self.assertFalse(vectorized.full_sky)
+
+    def test_reference_frequency(self):
+        rho_covar, rho_mean = components.get_decorrelation_matrices(np.array([353.]), 353., 1.)
+        np.testing.assert_array_equal(rho_covar, 0.)
+        np.testing.assert_array_equal(rho_mean, 1.)
+
 class test_Dust(unittest.TestCase):
     def setUp(self):
         data_dir = get_template_dir()
@@ -167,6 +333,33 @@ class test_AME(unittest.TestCase):
         np.testing.assert_array_almost_equal(self.frac_diff_100GHz, np.zeros_like(self.frac_diff_30GHz), decimal = 6)
         np.testing.assert_array_almost_equal(self.frac_diff_353GHz, np.zeros_like(self.frac_diff_30GHz), decimal = 6)
                                 
+class test_AME_Precomputation(unittest.TestCase):
+    def setUp(self):
+        self.config = models("a2", 16)[0]
+        self.frequencies = np.array([10., 23., 30., 100.])
+
+    def test_interpolator_built_once(self):
+        ame = components.AME(self.config)
+        signal = ame.signal()
+        interpolator = ame.emissivity_interpolator()
+        signal(self.frequencies)
+        signal(40.)
+        self.assertIs(ame.emissivity_interpolator(), interpolator)
+        self.assertIs(ame.pol_templates(), ame.pol_templates())
+
+    def test_vector_matches_scalar(self):
+        signal = components.AME(self.config).signal()
+        vector = signal(self.frequencies)
+        for i, nu in enumerate(self.frequencies):
+            np.testing.assert_allclose(vector[i], signal(nu), rtol = 1e-12)
+
+    def test_spdust_scaling(self):
+        ame = components.AME(self.config)
+        nu_peak = ame.Nu_Peak
+        J = interp1d(ame.Emissivity[0], ame.Emissivity[1], bounds_error = False, fill_value = 0)
+        expected = (ame.Nu_0_I / 30.) ** 2 * J(30. * ame.Nu_Peak_0 / nu_peak) / J(ame.Nu_0_I * ame.Nu_Peak_0 / nu_peak)
+        np.testing.assert_allclose(ame.spdust_scaling(30.), expected, rtol = 1e-12)
+
 class test_Freefree(unittest.TestCase):
     def setUp(self):
         data_dir = get_template_dir()
@@ -194,6 +387,85 @@ class test_Freefree(unittest.TestCase):
         np.testing.assert_array_almost_equal(self.frac_diff_100GHz, np.zeros_like(self.frac_diff_30GHz), decimal = 6)
         np.testing.assert_array_almost_equal(self.frac_diff_353GHz, np.zeros_like(self.frac_diff_30GHz), decimal = 6)
 
+class test_Lens_Maps(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        self.nside = 32
+        cl = 1. / (np.arange(3 * self.nside) + 10.) ** 2
+        self.maps = np.array([hp.synfast(cl, self.nside, verbose = False) for i in range(3)])
+        _, self.dtheta, self.dphi = hp.alm2map_der1(hp.synalm(1e-6 * cl), self.nside)
+        ipos = np.array(hp.pix2ang(self.nside, np.arange(hp.nside2npix(self.nside))))
+        opos, rot = components.offset_pos(ipos, self.dtheta, self.dphi, pol = True)
+        lensed = []
+        for m in self.maps:
+            for res in components.taylor_interpol_iter(m, opos, 3):
+                pass
+            lensed.append(res)
+        self.expected = components.apply_rotation(lensed, rot)
+
+    def test_serial(self):
+        lensed = components.lens_maps(self.maps, self.dtheta, self.dphi, threads = 1)
+        np.testing.assert_array_equal(lensed, self.expected)
+
+    def test_threads_and_memory_budget(self):
+        lensed = components.lens_maps(self.maps, self.dtheta, self.dphi, threads = 3)
+        np.testing.assert_array_equal(lensed, self.expected)
+        # too small a budget to keep the lensed positions, one map at a time.
+        budget = 8 * 8 * hp.nside2npix(self.nside)
+        lensed = components.lens_maps(self.maps, self.dtheta, self.dphi, threads = 3, memory_budget = budget)
+        np.testing.assert_array_equal(lensed, self.expected)
+
+    def test_pixels(self):
+        pixels = np.array([5, 1000, 1001, 3000, 12287])
+        lensed = components.lens_maps(self.maps, self.dtheta, self.dphi, pixels = pixels)
+        np.testing.assert_array_equal(lensed, self.expected[:, pixels])
+        lensed = components.lens_maps(self.maps, self.dtheta, self.dphi, memory_budget = 0, pixels = pixels)
+        np.testing.assert_array_equal(lensed, self.expected[:, pixels])
+
+    def test_higher_order(self):
+        ipos = np.array(hp.pix2ang(self.nside, np.arange(hp.nside2npix(self.nside))))
+        opos, rot = components.offset_pos(ipos, self.dtheta, self.dphi, pol = True)
+        lensed = []
+        for m in self.maps:
+            for res in components.taylor_interpol_iter(m, opos, 5):
+                pass
+            lensed.append(res)
+        expected = components.apply_rotation(lensed, rot)
+        np.testing.assert_array_equal(components.lens_maps(self.maps, self.dtheta, self.dphi, order = 5), expected)
+
+class test_Grid_Lensing(unittest.TestCase):
+    def setUp(self):
+        self.nside = 16
+        np.random.seed(1234)
+
+    def test_pixel_centres(self):
+        maps = np.random.randn(3, hp.nside2npix(self.nside))
+        pos = np.array(hp.pix2ang(self.nside, np.arange(hp.nside2npix(self.nside))))
+        for order in (1, 3, 5):
+            np.testing.assert_allclose(components.ring_interpolate(maps, pos, order), maps, atol = 1e-12)
+
+    def test_smooth_field(self):
+        theta, phi = hp.pix2ang(self.nside, np.arange(hp.nside2npix(self.nside)))
+        field = lambda theta, phi: np.cos(theta) + np.sin(theta) ** 2 * np.cos(2 * phi)
+        pos = np.array([np.random.uniform(0., np.pi, 1000), np.random.uniform(-np.pi, 3 * np.pi, 1000)])
+        # including positions between the poles and the first rings.
+        pos[0, :10] = np.linspace(0., 0.01, 10)
+        pos[0, 10:20] = np.pi - np.linspace(0., 0.01, 10)
+        interpolated = components.ring_interpolate(field(theta, phi), pos, 5)
+        # the rings closest to the poles have too few pixels to resolve m = 2.
+        caps = np.abs(np.cos(pos[0])) > 0.99
+        np.testing.assert_allclose(interpolated[~caps], field(pos[0], pos[1])[~caps], atol = 1e-3)
+        np.testing.assert_allclose(interpolated[caps], field(pos[0], pos[1])[caps], atol = 1e-2)
+
+    def test_partial_sky(self):
+        config = models("c1", self.nside)[0]
+        config['model'] = 'grid_lensing'
+        full = components.CMB(config).signal()(100.)
+        pixel_indices = np.arange(100, 400)
+        config['pixel_indices'] = pixel_indices
+        partial = components.CMB(config).signal()(100.)
+        np.testing.assert_array_equal(partial, full[:, pixel_indices])
+
 class test_models_partial_sky(unittest.TestCase):
     """All models have same implementation, just testing freefree"""
 
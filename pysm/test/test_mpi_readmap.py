@@ -101,5 +101,24 @@ def test_mpi_read():
             local_map[0],
             complete_map[0][:, :, pixel_indices])
 
+def test_mpi_distributed_read():
+
+    comm = MPI.COMM_WORLD
+
+    nside = 64
+    npix = hp.nside2npix(nside)
+
+    # interleaved pixels of different sizes on each process
+    pixel_indices = np.arange(comm.rank, npix, comm.size + comm.rank)
+
+    fname = pysm.nominal.template('lensed_cmb.fits')
+    for read_nside in [nside // 2, nside, nside * 2]:
+        local_pixels = pixel_indices[pixel_indices < hp.nside2npix(read_nside)]
+        local_map = pysm.read_map(fname, read_nside, field=(0, 1, 2),
+                                  pixel_indices=local_pixels, mpi_comm=comm)
+        complete_map = hp.ud_grade(hp.read_map(fname, field=(0, 1, 2)), nside_out=read_nside)
+        np.testing.assert_array_almost_equal(local_map, complete_map[:, local_pixels])
+
 if __name__ == "__main__":
     test_mpi_read()
+    test_mpi_distributed_read()
@@ -5,6 +5,8 @@ import scipy.constants as constants
 import pysm
 from pysm.nominal import models, template
 import os
+import shutil
+import tempfile
 from subprocess import call
 
 import pytest
@@ -132,6 +134,211 @@ class TestNoise(unittest.TestCase):
         np.testing.assert_almost_equal(Q_std, self.expected_P_std, decimal = 2)
         np.testing.assert_almost_equal(U_std, self.expected_P_std, decimal = 2)
 
+class TestNoiseRealization(unittest.TestCase):
+
+    def test_subset(self):
+        pixels = np.arange(3 * pysm.pysm.NOISE_BLOCK)
+        subset = pixels[::7][::-1]
+        counter_based = pysm.pysm.COUNTER_BASED_RNG
+        try:
+            # also check the fallback for numpy without SeedSequence.
+            for pysm.pysm.COUNTER_BASED_RNG in sorted(set([counter_based, False])):
+                noise = pysm.pysm.noise_realization(1234, 2, pixels)
+                np.testing.assert_array_equal(pysm.pysm.noise_realization(1234, 2, subset), noise[..., subset])
+                np.testing.assert_almost_equal(np.std(noise), 1., decimal = 2)
+        finally:
+            pysm.pysm.COUNTER_BASED_RNG = counter_based
+
+class TestSignalAccumulation(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        npix = hp.nside2npix(16)
+        self.freefree_config = [{
+            'model' : 'power_law',
+            'nu_0_I' : 30.,
+            'A_I' : np.random.rand(npix),
+            'spectral_index' : -2.14,
+            } for i in range(2)]
+        self.sky = pysm.Sky({'freefree' : self.freefree_config})
+        self.frequencies = np.array([20., 30., 40.])
+
+    def test_signal_out(self):
+        expected = self.sky.signal()(self.frequencies)
+        out = np.ones_like(expected)
+        result = self.sky.signal()(self.frequencies, out=out)
+        self.assertTrue(result is out)
+        np.testing.assert_array_almost_equal(out, expected + 1.)
+
+    def test_populations_summed(self):
+        expected_T = sum(c['A_I'] for c in self.freefree_config) * (20. / 30.) ** -2.14
+        np.testing.assert_array_almost_equal(self.sky.signal()(20.)[0], expected_T)
+
+    def test_shared_output(self):
+        # a component returning the same read-only array on every call
+        # is not modified when the others are added to it.
+        class Component(object):
+            def __init__(self, maps):
+                self.maps = maps
+            def signal(self, nu, **kwargs):
+                return self.maps
+        shared = np.ones((3, hp.nside2npix(16)))
+        shared.setflags(write = False)
+        sky = pysm.Sky({})
+        sky.add_component('shared', Component(shared))
+        sky.add_component('other', Component(np.ones((3, hp.nside2npix(16)))))
+        for i in range(2):
+            np.testing.assert_array_equal(sky.signal()(20.), 2.)
+        np.testing.assert_array_equal(shared, 1.)
+
+class TestFusedBandpass(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        npix = hp.nside2npix(16)
+        self.sky = pysm.Sky({
+            'synchrotron' : [{
+                'model' : 'power_law',
+                'nu_0_I' : 0.408,
+                'nu_0_P' : 23.,
+                'A_I' : np.random.rand(npix),
+                'A_Q' : np.random.randn(npix),
+                'A_U' : np.random.randn(npix),
+                'spectral_index' : -3. + 0.1 * np.random.randn(npix),
+                }],
+            'freefree' : [{
+                'model' : 'power_law',
+                'nu_0_I' : 30.,
+                'A_I' : np.random.rand(npix),
+                'spectral_index' : -2.14,
+                }],
+            })
+        self.frequencies = np.linspace(20., 40., 21)
+
+    def test_weighted_signal(self):
+        weights = np.linspace(1., 2., len(self.frequencies))
+        expected = np.sum(self.sky.signal()(self.frequencies) * weights[:, None, None], axis = 0)
+        np.testing.assert_array_almost_equal(self.sky.signal()(self.frequencies, weights = weights), expected)
+
+    def test_bandpass(self):
+        signal = self.sky.signal()
+        signal_Jysr = lambda nu: signal(nu) * pysm.convert_units("uK_RJ", "Jysr", nu)
+        expected = pysm.pysm.bandpass(self.frequencies, np.ones_like(self.frequencies), signal_Jysr)
+        instrument = pysm.Instrument({
+            'use_bandpass' : True,
+            'channels' : [(self.frequencies, np.ones_like(self.frequencies))],
+            'channel_names' : ['channel'],
+            'nside' : 16,
+            'add_noise' : False,
+            'use_smoothing' : False,
+            'output_units' : 'uK_RJ',
+            })
+        integrated = instrument.apply_bandpass(signal, self.sky)
+        np.testing.assert_array_almost_equal(integrated[0] / expected, 1.)
+
+class TestHDBandpassTables(unittest.TestCase):
+    def setUp(self):
+        self.hd_data = pysm.Dust.read_hd_data()
+        self.channel = (np.linspace(140., 160., 21), np.linspace(1., 2., 21))
+
+    def test_tables(self):
+        data_sil, data_silfe, data_car, wav, uvec = self.hd_data
+        (nu, t_nu) = self.channel
+        c = 2.99792458e10
+        integrate = lambda data, column: np.trapz(t_nu * np.interp(nu * 1.e9, c / (wav[::-1] * 1.e-4), data[::-1, column] * 1.e23) / nu * 1.e-9, nu * 1.e9)
+        expected_I = [0.56 * integrate(data_sil, 3 + i) + integrate(data_car, 3 + i) + 0.44 * integrate(data_silfe, 3 + i) for i in range(len(uvec))]
+        expected_P = [0.56 * integrate(data_sil, 84 + i) + integrate(data_car, 84 + i) + 0.44 * integrate(data_silfe, 84 + i) for i in range(len(uvec))]
+        _, table_I, table_P = pysm.pysm.hd_bandpass_tables(self.channel, 1., 0.44, self.hd_data)
+        np.testing.assert_allclose(table_I, expected_I, rtol = 1e-12)
+        np.testing.assert_allclose(table_P, expected_P, rtol = 1e-12)
+
+    def test_memoized(self):
+        tables = pysm.pysm.hd_bandpass_tables(self.channel, 1., 0.44, self.hd_data)
+        channel = (self.channel[0].copy(), self.channel[1].copy())
+        self.assertIs(pysm.pysm.hd_bandpass_tables(channel, 1., 0.44, self.hd_data), tables)
+        self.assertIsNot(pysm.pysm.hd_bandpass_tables(channel, 1., 0.2, self.hd_data), tables)
+
+class TestChunkedObserve(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        self.nside = 16
+        npix = hp.nside2npix(self.nside)
+        self.sky_config = {
+            'synchrotron' : [{
+                'model' : 'power_law',
+                'nu_0_I' : 0.408,
+                'nu_0_P' : 23.,
+                'A_I' : np.random.rand(npix),
+                'A_Q' : np.random.randn(npix),
+                'A_U' : np.random.randn(npix),
+                'spectral_index' : -3. + 0.1 * np.random.randn(npix),
+                }],
+            }
+        self.output_directory = tempfile.mkdtemp()
+        self.instrument_config = {
+            'frequencies' : np.array([30., 90.]),
+            'beams' : np.array([120., 60.]),
+            'nside' : self.nside,
+            'add_noise' : False,
+            'output_units' : 'uK_CMB',
+            'use_smoothing' : True,
+            'use_bandpass' : False,
+            'output_directory' : self.output_directory,
+            'output_prefix' : 'test',
+            'pixel_indices' : None,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def observe(self, pixel_chunk_size = None, pixel_indices = None):
+        instrument_config = dict(self.instrument_config, pixel_indices = pixel_indices)
+        sky_config = self.sky_config
+        if pixel_chunk_size is not None:
+            instrument_config['pixel_chunk_size'] = pixel_chunk_size
+        if pixel_indices is not None:
+            sky_config = {'synchrotron' : [dict((k, v[pixel_indices] if k in ('A_I', 'A_Q', 'A_U', 'spectral_index') else v) for (k, v) in self.sky_config['synchrotron'][0].items())]}
+        instrument = pysm.Instrument(instrument_config)
+        instrument.observe(pysm.Sky(sky_config))
+        return np.array([hp.read_map(instrument.file_path(f = f, extra_info = "total"), field = (0, 1, 2), verbose = False) for f in instrument.Frequencies])
+
+    def test_chunked(self):
+        np.testing.assert_array_almost_equal(self.observe(pixel_chunk_size = 1000), self.observe())
+
+    def test_chunked_partial_sky(self):
+        pixel_indices = np.arange(500, 2500)
+        np.testing.assert_array_almost_equal(self.observe(pixel_chunk_size = 300, pixel_indices = pixel_indices),
+                                             self.observe(pixel_indices = pixel_indices))
+
+    def test_chunked_noise(self):
+        self.instrument_config.update(add_noise = True, sens_I = np.array([1., 2.]), sens_P = np.array([1., 2.]), noise_seed = 5678, use_smoothing = False)
+        full_sky = self.observe()
+        np.testing.assert_array_almost_equal(self.observe(pixel_chunk_size = 1000), full_sky)
+        pixel_indices = np.arange(500, 2500)
+        np.testing.assert_array_almost_equal(self.observe(pixel_chunk_size = 300, pixel_indices = pixel_indices)[..., pixel_indices],
+                                             full_sky[..., pixel_indices])
+
+    def test_chunked_full_sky_component(self):
+        # a component added with add_component cannot evaluate a subset of
+        # the pixels, and is evaluated once per channel rather than per chunk.
+        npix = hp.nside2npix(self.nside)
+        calls = []
+        class Component(object):
+            def signal(self, nu):
+                calls.append(nu)
+                return np.outer(np.ones(3), np.arange(npix)) * (np.asarray(nu)[..., None, None] / 30.)
+        def observe(pixel_chunk_size):
+            instrument_config = dict(self.instrument_config)
+            if pixel_chunk_size is not None:
+                instrument_config['pixel_chunk_size'] = pixel_chunk_size
+            instrument = pysm.Instrument(instrument_config)
+            sky = pysm.Sky(self.sky_config)
+            sky.add_component('custom', Component())
+            instrument.observe(sky)
+            return np.array([hp.read_map(instrument.file_path(f = f, extra_info = "total"), field = (0, 1, 2), verbose = False) for f in instrument.Frequencies])
+        expected = observe(None)
+        del calls[:]
+        np.testing.assert_array_almost_equal(observe(1000), expected)
+        self.assertEqual(len(calls), len(self.instrument_config['frequencies']))
+
 class TestSmoothing(unittest.TestCase):
 
     def setUp(self):
@@ -176,6 +383,132 @@ class TestSmoothing(unittest.TestCase):
         smoothed = instrument.smoother(self.synch_1_30GHz[..., pixel_indices])
         np.testing.assert_almost_equal(smoothed[0, 0, 10000:10100], self.synch_1_30GHz_smoothed[20000:20100], decimal=1)
 
+    def test_smoothing_lmax(self):
+        instrument = pysm.Instrument(self.instrument_config)
+        self.assertEqual(instrument.smoothing_lmax(300., 64), 191)
+        instrument = pysm.Instrument(dict(self.instrument_config, smoothing_tolerance = 1e-6))
+        lmax = instrument.smoothing_lmax(300., 64)
+        self.assertTrue(lmax < 191)
+        sigma = np.radians(5.) / np.sqrt(8. * np.log(2.))
+        self.assertTrue(np.exp(-0.5 * lmax * (lmax + 1) * sigma ** 2) < 1e-6)
+        self.assertEqual(instrument.smoothing_lmax(0., 64), 191)
+
+    def test_smoothing_tolerance(self):
+        instrument = pysm.Instrument(dict(self.instrument_config, beams = np.array([300., 300.]), smoothing_tolerance = 1e-6))
+        smoothed = instrument.smoother(self.synch_1_30GHz)
+        expected = hp.smoothing(self.synch_1_30GHz[0], fwhm = np.radians(5.), pol = True)
+        np.testing.assert_allclose(smoothed[0], expected, rtol = 0., atol = 1e-4 * np.abs(expected).max())
+
+    def test_smoothing_nsides(self):
+        instrument = pysm.Instrument(dict(self.instrument_config, beams = np.array([300., 300.]), smoothing_nsides = [32, 64]))
+        smoothed = instrument.smoother(np.repeat(self.synch_1_30GHz, 2, axis = 0))
+        self.assertEqual(smoothed.shape, (2, 3, hp.nside2npix(64)))
+        np.testing.assert_allclose(smoothed[0], smoothed[1], rtol = 0., atol = 5e-2 * np.abs(smoothed[1]).max())
+
+    def test_smoothing_batches(self):
+        instrument = pysm.Instrument(dict(self.instrument_config, smoothing_threads = 2, smoothing_max_maps = 4))
+        self.assertEqual(instrument.smoothing_batches(np.array([60., 30., 60., 60., 60.]), [64] * 5), [[0, 2], [3, 4], [1]])
+        self.assertEqual(instrument.smoothing_batches(np.array([60., 60.]), [32, 64]), [[0], [1]])
+        instrument = pysm.Instrument(dict(self.instrument_config, smoothing_threads = 4, smoothing_max_maps = 2))
+        self.assertEqual(instrument.smoothing_threads(), 2)
+
+    def test_smoothing_threads(self):
+        maps = np.concatenate([self.synch_1_30GHz, 2. * self.synch_1_30GHz, -self.synch_1_30GHz])
+        beams = np.array([60., 120., 60.])
+        expected = pysm.Instrument(dict(self.instrument_config, beams = beams)).smoother(maps)
+        instrument = pysm.Instrument(dict(self.instrument_config, beams = beams, smoothing_threads = 2, smoothing_max_maps = 4))
+        np.testing.assert_array_equal(instrument.smoother(maps), expected)
+
+class TestSeparableSmoothing(unittest.TestCase):
+    def setUp(self):
+        nside = 16
+        np.random.seed(1234)
+        npix = hp.nside2npix(nside)
+        separable = {
+            'model' : 'power_law',
+            'nu_0_I' : 30.,
+            'nu_0_P' : 30.,
+            'A_I' : np.random.rand(npix),
+            'A_Q' : np.random.randn(npix),
+            'A_U' : np.random.randn(npix),
+            'spectral_index' : -3.,
+            }
+        varying = dict(separable, spectral_index = -3. + 0.1 * np.random.randn(npix))
+        self.sky = pysm.Sky({'synchrotron' : [separable, varying]})
+        self.instrument_config = {
+            'frequencies' : np.array([20., 30., 40.]),
+            'beams' : np.array([120., 60., 30.]),
+            'nside' : nside,
+            'add_noise' : False,
+            'output_units' : 'uK_RJ',
+            'use_smoothing' : True,
+            'use_bandpass' : False,
+            'pixel_indices' : None,
+        }
+
+    def test_separable_populations(self):
+        self.assertEqual(len(self.sky.populations()), 2)
+        separable = self.sky.separable_populations()
+        self.assertEqual(len(separable), 1)
+        self.assertTrue(separable[0] is self.sky.populations()[0])
+        np.testing.assert_array_almost_equal(self.sky.signal(exclude = separable)(20.), self.sky.populations()[1](20.))
+
+    def test_smoothed_signal(self):
+        instrument = pysm.Instrument(self.instrument_config)
+        expected = instrument.smoother(instrument.apply_bandpass(self.sky.signal(), self.sky))
+        np.testing.assert_allclose(instrument.smoothed_signal(self.sky), expected, rtol = 1e-10, atol = 1e-10 * np.abs(expected).max())
+
+    def test_smoothed_signal_bandpass(self):
+        instrument_config = dict(self.instrument_config, use_bandpass = True, channel_names = ['a', 'b', 'c'],
+                                 channels = [(np.linspace(f - 5., f + 5., 11), np.ones(11)) for f in (20., 30., 40.)])
+        instrument = pysm.Instrument(instrument_config)
+        expected = instrument.smoother(instrument.apply_bandpass(self.sky.signal(), self.sky))
+        np.testing.assert_allclose(instrument.smoothed_signal(self.sky), expected, rtol = 1e-10, atol = 1e-10 * np.abs(expected).max())
+
+class TestLocalSmoothing(unittest.TestCase):
+    def setUp(self):
+        nside = 64
+        np.random.seed(1234)
+        cl = np.zeros((4, 3 * nside))
+        cl[:3, 2:] = np.arange(2, 3 * nside) ** -2.5
+        self.full_map = hp.synfast(cl, nside, new = True)
+        centre = hp.ang2vec(np.radians(60.), np.radians(30.))
+        self.pixel_indices = hp.query_disc(nside, centre, np.radians(30.))
+        self.inner = np.searchsorted(self.pixel_indices, hp.query_disc(nside, centre, np.radians(22.)))
+        self.instrument_config = {
+            'frequencies' : np.array([30., 40.]),
+            'beams' : np.array([180., 180.]),
+            'nside' : nside,
+            'add_noise' : False,
+            'output_units' : 'uK_RJ',
+            'use_smoothing' : True,
+            'use_bandpass' : False,
+            'pixel_indices' : self.pixel_indices,
+            'local_smoothing' : True,
+        }
+
+    def test_harmonic_smoothing(self):
+        instrument = pysm.Instrument(self.instrument_config)
+        maps = np.array([self.full_map, -self.full_map])[..., self.pixel_indices]
+        smoothed = instrument.smoother(maps)
+        expected = hp.smoothing(self.full_map, fwhm = np.radians(3.), pol = True)[..., self.pixel_indices]
+        np.testing.assert_allclose(smoothed[0][:, self.inner], expected[:, self.inner], rtol = 0., atol = 1e-2 * np.abs(expected).max())
+        np.testing.assert_array_almost_equal(smoothed[1], -smoothed[0])
+
+    def test_cache(self):
+        fwhm = np.radians(3.)
+        matrices = pysm.common.convolution_matrices(64, self.pixel_indices, fwhm, 2. * fwhm)
+        self.assertTrue(pysm.common.convolution_matrices(64, self.pixel_indices.copy(), fwhm, 2. * fwhm) is matrices)
+        np.testing.assert_array_almost_equal(np.asarray(matrices[0].sum(axis = 1)).ravel(), 1.)
+
+    def test_unseen(self):
+        instrument = pysm.Instrument(self.instrument_config)
+        maps = self.full_map[np.newaxis][..., self.pixel_indices]
+        maps[0, 0, 0] = hp.UNSEEN
+        smoothed = instrument.smoother(maps)
+        self.assertEqual(smoothed[0, 0, 0], hp.UNSEEN)
+        self.assertTrue(np.all(np.abs(smoothed[0, :, 1:]) < np.abs(self.full_map).max()))
+
 def main():
     unittest.main()
 